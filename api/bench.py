@@ -0,0 +1,395 @@
+"""End-to-end latency benchmark of the api. It drives `hear.app` against
+the emulated arduino and measures the time from the HTTP request to the
+response, therefore it includes `hear.do_cmd`, `Brain.call`, the
+`LockAdapter` of the legs and the ack of the emulator.
+
+The api can be reached either through the Flask test client(in process),
+through a real gunicorn bind with a single worker or through gunicorn with
+a worker for each core sharing the body of a spine. For each circuit,
+concurrency level and baudrate it reports p50/p95/p99 latency and commands
+per second and it saves the results as JSON so that runs can be compared.
+
+Example:
+    $ python3 bench.py --baudrates 9600 115200 --concurrency 1 4 16 \\
+        --output today.json --compare yesterday.json
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import platform
+import threading
+import subprocess
+import http.client
+
+from emulator import ArduinoEmulator
+
+# circuit name -> query string of the request
+CIRCUITS = {
+    'forward': 'async=1',
+    'left': 'async=1',
+    'stop': '',
+    'set_speed': 'speed_value=200',
+}
+
+REGRESSION_THRESHOLD = 0.10
+
+
+def percentile(values, p):
+    """Utility function that returns the `p` percentile of an already
+    sorted list using the nearest-rank method.
+
+    Args:
+        values (list of float): sorted values
+        p (float): percentile between 0 and 100
+
+    Returns:
+        float: the percentile or None if `values` is empty
+    """
+    if not values:
+        return None
+    rank = max(0, math.ceil(p / 100 * len(values)) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+def run_load(make_sender, path, concurrency, requests):
+    """Sends `requests` requests to `path` from `concurrency` threads.
+
+    Args:
+        make_sender (callable): factory of senders, a sender takes a path
+            and returns True if the request succeeded. Each thread uses
+            its own sender.
+        path (str): path of the request
+        concurrency (int): number of concurrent clients
+        requests (int): total number of requests
+
+    Returns:
+        dict: latency percentiles in ms, commands per second and errors
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    barrier = threading.Barrier(concurrency + 1)
+    share = [requests // concurrency + (i < requests % concurrency)
+             for i in range(concurrency)]
+
+    def client(n):
+        send = make_sender()
+        local, failed = [], 0
+        barrier.wait()
+        for _ in range(n):
+            start = time.perf_counter()
+            ok = send(path)
+            local.append(time.perf_counter() - start)
+            failed += not ok
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client, args=(n, )) for n in share]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'errors': errors[0],
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'cmds_per_s': requests / elapsed,
+    }
+
+
+def flask_senders(app):
+    """Returns a factory of senders that use the Flask test client.
+
+    Args:
+        app (Flask): the api
+
+    Returns:
+        callable: factory of senders
+    """
+
+    def make_sender():
+        client = app.test_client()
+
+        def send(path):
+            resp = client.get(path)
+            return resp.status_code == 200 and resp.get_json()['success']
+
+        return send
+
+    return make_sender
+
+
+def http_senders(host, port):
+    """Returns a factory of senders that use a keep-alive HTTP connection
+    for each client.
+
+    Args:
+        host (str): host of the api
+        port (int): port of the api
+
+    Returns:
+        callable: factory of senders
+    """
+
+    def make_sender():
+        conn = http.client.HTTPConnection(host, port)
+
+        def send(path):
+            conn.request('GET', path)
+            resp = conn.getresponse()
+            body = resp.read()
+            return resp.status == 200 and json.loads(body.decode())['success']
+
+        return send
+
+    return make_sender
+
+
+def free_port():
+    """Utility function that returns a free TCP port on localhost.
+
+    Returns:
+        int: the port
+    """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(env, threads, workers=1, timeout=10):
+    """Starts gunicorn serving `hear:app` on a free port and waits until
+    it accepts connections.
+
+    Args:
+        env (dict): environment of the server
+        threads (int): number of threads of each worker
+        workers (int): number of workers
+        timeout (float): seconds to wait for the server
+
+    Returns:
+        (Popen, int): the process and the port
+
+    Raises:
+        RuntimeError: if the server doesn't start in time
+    """
+    port = free_port()
+    proc = subprocess.Popen(
+        ['gunicorn', '--bind', '127.0.0.1:{:d}'.format(port), '--workers',
+         str(workers), '--threads', str(threads), 'hear:app'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.1).close()
+            return proc, port
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError('gunicorn did not start in {}s'.format(timeout))
+
+
+def start_spine(env, path, timeout=10):
+    """Starts the spine on `path` and waits until it's listening.
+
+    Args:
+        env (dict): environment of the spine
+        path (str): path of the socket
+        timeout (float): seconds to wait for the spine
+
+    Returns:
+        Popen: the process
+
+    Raises:
+        RuntimeError: if the spine doesn't start in time
+    """
+    proc = subprocess.Popen(
+        [sys.executable, 'spine.py', '--socket', path],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if os.path.exists(path):
+            return proc
+        time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError('the spine did not start in {}s'.format(timeout))
+
+
+def bench(make_sender, mode, arduino, args):
+    """Runs every combination of baudrate, circuit and concurrency.
+
+    Args:
+        make_sender (callable): factory of senders
+        mode (str): name of the way the api is reached
+        arduino (ArduinoEmulator): the emulated arduino
+        args (Namespace): parsed command line arguments
+
+    Returns:
+        list of dict: one result for each combination
+    """
+    results = []
+    for baudrate in args.baudrates:
+        arduino.set_baudrate(baudrate)
+        for circuit in args.circuits:
+            query = CIRCUITS[circuit]
+            path = '/api/{}{}'.format(circuit, '?' + query if query else '')
+            make_sender()(path)  # warm up
+            for concurrency in args.concurrency:
+                res = run_load(make_sender, path, concurrency, args.requests)
+                res.update(mode=mode,
+                           circuit=circuit,
+                           baudrate=baudrate,
+                           concurrency=concurrency)
+                results.append(res)
+                print('{mode:8} {circuit:10} {baudrate:>7} baud '
+                      'c={concurrency:<3} p50={p50_ms:7.2f}ms '
+                      'p95={p95_ms:7.2f}ms p99={p99_ms:7.2f}ms '
+                      '{cmds_per_s:8.1f} cmd/s errors={errors}'.format(**res),
+                      flush=True)
+    return results
+
+
+def result_key(res):
+    """Returns the key that identifies a result across runs.
+    """
+    return (res['mode'], res['circuit'], res['baudrate'], res['concurrency'])
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """Prints the comparison between `results` and a previous run.
+
+    Args:
+        results (list of dict): results of this run
+        baseline (list of dict): results of the previous run
+        threshold (float): relative slowdown considered a regression
+
+    Returns:
+        int: number of regressions
+    """
+    old = {result_key(r): r for r in baseline}
+    regressions = 0
+    for res in results:
+        prev = old.get(result_key(res))
+        if not prev:
+            continue
+        p99 = res['p99_ms'] / prev['p99_ms'] - 1
+        tput = res['cmds_per_s'] / prev['cmds_per_s'] - 1
+        regressed = p99 > threshold or tput < -threshold
+        regressions += regressed
+        print('{:8} {:10} {:>7} baud c={:<3} p99 {:+7.1%} '
+              'cmd/s {:+7.1%}{}'.format(*result_key(res), p99, tput,
+                                        '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='End-to-end latency benchmark of the XM api')
+    parser.add_argument('--modes', nargs='+',
+                        default=['flask', 'gunicorn', 'spine'],
+                        choices=['flask', 'gunicorn', 'spine'])
+    parser.add_argument('--circuits', nargs='+', default=sorted(CIRCUITS),
+                        choices=sorted(CIRCUITS))
+    parser.add_argument('--baudrates', nargs='+', type=int,
+                        default=[9600, 115200])
+    parser.add_argument('--concurrency', nargs='+', type=int,
+                        default=[1, 4, 16])
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests for each combination')
+    parser.add_argument('--latency', type=float, default=0.002,
+                        help='latency of the emulated arduino in seconds')
+    parser.add_argument('--output', default=None,
+                        help='file where to save the results as JSON')
+    parser.add_argument('--compare', default=None,
+                        help='JSON file of a previous run to compare with')
+    args = parser.parse_args()
+
+    arduino = ArduinoEmulator(latency=args.latency)
+    arduino.start()
+    logdir = tempfile.mkdtemp(prefix='xm-bench-')
+    env = dict(os.environ, XM_PORT=arduino.port, XM_LOGDIR=logdir,
+               XM_CACHEDIR=logdir)
+
+    results = []
+    try:
+        if 'flask' in args.modes:
+            os.environ.update(env)
+            import hear
+            try:
+                results += bench(flask_senders(hear.app), 'flask', arduino,
+                                 args)
+            finally:
+                hear.brain.call('shutup')
+                hear.brain.body.safe_legs.close()
+
+        has_gunicorn = shutil.which('gunicorn')
+        if not has_gunicorn:
+            print('gunicorn not found, skipping', file=sys.stderr)
+
+        if 'gunicorn' in args.modes and has_gunicorn:
+            proc, port = start_gunicorn(env, max(args.concurrency))
+            try:
+                results += bench(http_senders('127.0.0.1', port), 'gunicorn',
+                                 arduino, args)
+            finally:
+                proc.terminate()
+                proc.wait()
+
+        if 'spine' in args.modes and has_gunicorn:
+            path = os.path.join(logdir, 'spine.sock')
+            spine = start_spine(env, path)
+            proc, port = start_gunicorn(dict(env, XM_SPINE=path),
+                                        max(args.concurrency),
+                                        workers=os.cpu_count())
+            try:
+                results += bench(http_senders('127.0.0.1', port), 'spine',
+                                 arduino, args)
+            finally:
+                proc.terminate()
+                proc.wait()
+                spine.terminate()
+                spine.wait()
+    finally:
+        arduino.close()
+        shutil.rmtree(logdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'meta': {
+                    'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'python': platform.python_version(),
+                    'machine': platform.machine(),
+                    'requests': args.requests,
+                    'latency': args.latency,
+                },
+                'results': results
+            }, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
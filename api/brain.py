@@ -5,82 +5,325 @@ body.
 Attributes:
     DEFAULT_PORT (str): default serial port `Legs` will use.
         By default it is '/dev/ttyACM0'
+    DEFAULT_LOGDIR (str): default directory where logs are stored.
+        By default it is '/var/log/xm'
+    DEFAULT_CACHEDIR (str): default directory where the rendered sentences
+        are cached. By default it is '/var/cache/xm/speech'
+    PRIORITY_LEGS (tuple of str): methods of `Legs` that jump the queue of
+        the lock.
+    PRE_TIME, TARGET_TIME (metrics.Family): histograms of the time spent
+        by each circuit in the pre-workers and in the target(including the
+        post-workers, e.g. the wait for the ack).
+    LOCK_WAIT (metrics.Family): histograms of the time each method of the
+        legs waits for the lock.
+    PART_STARTUP (metrics.Family): histograms of the time each part of the
+        body takes to start.
 
 Example:
     $ body = Body()
     $ brain = Brain(Body)
-    $ brain.call('forward', async=True)
+    $ brain.call('forward', **{'async': True})
 """
 
 import os
+import json
+import time
+import shutil
+import inspect
+import hashlib
 import datetime
+import threading
+
+from collections import OrderedDict
+from functools import partial
 
 from leg import Legs
+from cerebellum import Cerebellum, MOVES
 from eyes import Eyes
-from mouth import Mouth
-from util import LockAdapter, str_to_bool, str_to_int
+from cortex import Cortex
+from mouth import Mouth, SpeechCache, Synthesizer
+from iris import PROFILES, AUTO
+from metrics import REGISTRY
+from schema import Param, compile_schema
+from util import LockAdapter, XMException, XMValueError
 
 DEFAULT_PORT = '/dev/ttyACM0'
-
-
-def move_synapse(async=None):
-    """Synapse to adapt an async string to a boolean. Internally it calls
-    `str_to_bool` so refer to it for a general overview.
+DEFAULT_LOGDIR = '/var/log/xm'
+DEFAULT_CACHEDIR = '/var/cache/xm/speech'
+
+# longest text the mouth accepts
+MAX_TEXT = 4096
+
+# methods of the legs that jump the queue of the lock
+PRIORITY_LEGS = ('stop', 'set_speed')
+
+PRE_TIME = REGISTRY.histogram('xm_circuit_pre_seconds',
+                              'Time spent in the pre-workers of a circuit',
+                              ('circuit', ))
+TARGET_TIME = REGISTRY.histogram(
+    'xm_circuit_target_seconds',
+    'Time spent in the target and in the post-workers of a circuit',
+    ('circuit', ))
+LOCK_WAIT = REGISTRY.histogram('xm_legs_lock_wait_seconds',
+                               'Time a method of the legs waits for the lock',
+                               ('method', ))
+PART_STARTUP = REGISTRY.histogram('xm_part_startup_seconds',
+                                  'Time a part of the body takes to start',
+                                  ('part', ),
+                                  buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2,
+                                           5, 10, 30))
+
+# seconds a circuit waits for a part that is starting
+PART_WAIT = 2
+# seconds before a part that failed to start is tried again
+PART_RETRY = 5
+
+
+def compile_circuit(name, target, pre, post, part, validate=None):
+    """Compiles a circuit into fused callables, so that calling it doesn't
+    look anything up: the validator, the pre-workers, the target, the
+    post-workers, the part and the timers are bound once here.
 
     Args:
-        async (str, default None): string either containing a boolean or an
-            integer.
+        name (str): name of the circuit
+        target (callable): core function to call
+        pre (tuple of callables): pre-workers
+        post (tuple of callables): post-workers
+        part (Part): the part the circuit needs or None
+        validate (callable, optional): validator of the parameters, see
+            `schema.compile_schema`
 
     Returns:
-        ([bool], {}): a tuple of args and kwargs. The last one is always empty
+        (callable, callable, callable): `prepare(args, kwargs)` that
+            validates the parameters, calls the pre-workers and returns the
+            args and kwargs of the target,
+            `run(args, kwargs)` that calls the target and the post-workers
+            and `call(*args, **kwargs)` that does both
     """
-    res = [str_to_bool(async)] if async else []
-    return res, {}
+    perf_counter = time.perf_counter
+    pre_time = PRE_TIME.labels(name).observe
+    target_time = TARGET_TIME.labels(name).observe
+    require = part.require if part else None
+
+    def prepare(args, kwargs):
+        start = perf_counter()
+        if validate:
+            args, kwargs = (), validate(args, kwargs)
+        for p in pre:
+            args, kwargs = p(*args, **kwargs)
+        pre_time(perf_counter() - start)
+        return args, kwargs
+
+    def run(args, kwargs):
+        if require:
+            require()
+        start = perf_counter()
+        try:
+            r = target(*args, **kwargs)
+            for p in post:
+                p(r) if r else p()
+        finally:
+            target_time(perf_counter() - start)
+        return r
+
+    if not pre and not validate:
+        def call(*args, **kwargs):
+            return run(args, kwargs)
+    else:
+        def call(*args, **kwargs):
+            return run(*prepare(args, kwargs))
 
+    return prepare, run, call
 
-def speedvalue_synapse(speed_value):
-    """Synapse to adapt a speed value string to an integer. Internally it calls
-    `str_to_int` so refer to it for a general overview.
+
+def circuit_params(fn):
+    """Utility function that returns the parameters a circuit without
+    declared parameters accepts, i.e. the ones of its first pre-worker or
+    of its target.
 
     Args:
-        speed_value (str): string representation of an integer.
+        fn (callable): the first pre-worker or the target
 
     Returns:
-        ([bool], {}): a tuple of args and kwargs. The last one is always empty.
+        list of dict: the `name` of each parameter
     """
-    res = [str_to_int(speed_value)] if speed_value else []
-    return res, {}
+    try:
+        sig = inspect.signature(fn)
+    except (TypeError, ValueError):
+        return []
+    return [{'name': p.name} for p in sig.parameters.values()
+            if p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY)]
 
 
-def movetime_synapse(time):
-    """Synapse to adapt a time string to an integer. Internally it calls
-    `str_to_int` so refer to it for a general overview.
+class PartUnavailable(XMException):
+    """Exception raised if a circuit needs a part of the body that is
+    still starting or that failed to start.
+    """
+    pass
 
-    Args:
-        speed_value (str): string representation of an integer.
+
+class Part:
+    """Readiness of a part of the body. The part is started in a thread
+    of its own, so that the parts start in parallel and a slow or missing
+    one doesn't hold up the others. If it fails it's tried again in the
+    background, at most every `PART_RETRY` seconds, when a circuit needs
+    it: the circuits fail right away until the part is ready.
+
+    Attributes:
+        name (str): name of the part
+        state (str): 'starting', 'ready' or 'failed'
+        error (str): why the part failed to start
+        startup_time (float): seconds the last start took
+    """
+
+    def __init__(self, name, probe):
+        """Creates the readiness of a part, it's started by `start`.
+
+        Args:
+            name (str): name of the part
+            probe (callable): function that starts the part, it raises an
+                exception if the part can't work
+        """
+        self.name = name
+        self.state = 'starting'
+        self.error = None
+        self.startup_time = None
+        self._probe = probe
+        self._checked = 0
+        self._retrying = False
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        # not `_lock`, that is held while the part is starting
+        self._retry_lock = threading.Lock()
+
+    def _run(self):
+        """Helper function that starts the part and records the outcome.
+        """
+        with self._lock:
+            start = time.monotonic()
+            try:
+                self._probe()
+                self.state, self.error = 'ready', None
+            except Exception as exc:
+                self.state = 'failed'
+                self.error = str(exc) or type(exc).__name__
+            self._checked = time.monotonic()
+            self.startup_time = self._checked - start
+            PART_STARTUP.labels(self.name).observe(self.startup_time)
+            self._retrying = False
+            self._done.set()
+
+    def start(self):
+        """Starts the part in the background.
+        """
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def require(self):
+        """Checks that the part is ready, waiting a bit if it's starting.
+        If it failed a while ago it's started again in the background and
+        this call fails without waiting for it.
+
+        Raises:
+            PartUnavailable: if the part isn't ready
+        """
+        if self.state == 'ready':
+            return
+        self._done.wait(PART_WAIT)
+        if self.state == 'starting':
+            raise PartUnavailable('{} still starting'.format(self.name))
+        if self.state == 'failed':
+            if time.monotonic() - self._checked > PART_RETRY:
+                self._retry()
+            raise PartUnavailable('{} unavailable{}: {}'.format(
+                self.name, ', retrying' if self._retrying else '',
+                self.error))
+
+    def _retry(self):
+        """Helper function that starts the part again in the background,
+        unless it's already being started.
+        """
+        with self._retry_lock:
+            if self._retrying:
+                return
+            self._retrying = True
+        self.start()
+
+    def status(self):
+        """Returns the readiness of the part.
+
+        Returns:
+            dict: the `state`, the `error` if it failed and the `startup_ms`
+                of the last start.
+        """
+        return {
+            'state': self.state,
+            'error': self.error,
+            'startup_ms': (int(self.startup_time * 1000)
+                           if self.startup_time is not None else None),
+        }
+
+
+MOVE_PARAMS = (
+    Param('async', bool, required=False, arg='asynchronous',
+          doc='if true it returns immediatly instead of when the rover '
+              'stops'),
+)
+TIMEDMOVE_PARAMS = (
+    Param('direction', str, choices=MOVES),
+    Param('time', int, required=False, min=0, max=0xFFFF,
+          doc='duration in ms, by default the move time of the legs'),
+)
+DRIVE_PARAMS = (
+    Param('x', int, min=-100, max=100, doc='turn, positive to the right'),
+    Param('y', int, min=-100, max=100,
+          doc='throttle, negative to go backward'),
+)
+MOVEID_PARAMS = (Param('id', int, min=1, doc='identifier of the movement'), )
+SPEED_PARAMS = (Param('speed_value', int, min=0, max=0xFF), )
+MOVETIME_PARAMS = (Param('time', int, min=0, max=0xFFFF,
+                         doc='duration of a synchronous movement in ms'), )
+SAY_PARAMS = (
+    Param('text', str, min=1, max=MAX_TEXT),
+    Param('amplitude', int, required=False, min=0, max=200),
+    Param('wpm', int, required=False, min=80, max=450,
+          doc='words per minute'),
+    Param('priority', int, required=False, min=-100, max=100,
+          doc='texts with higher priority are said first'),
+)
+PROFILE_PARAMS = (Param('profile', str, choices=tuple(PROFILES) + (AUTO, )), )
+WATCHMOTION_PARAMS = (
+    Param('threshold', int, required=False, min=0, max=255,
+          doc='difference in gray levels above which a pixel is moving'),
+    Param('trigger', str, required=False,
+          doc='circuit without parameters to call at each motion'),
+)
+
+
+def nowait_synapse(*args, **kwargs):
+    """Synapse that asks the target to return the `Future` of its ack
+    instead of waiting for it. In this way the lock of the legs is held
+    only while the command is written and several commands can be on the
+    wire at the same time.
 
     Returns:
-        ([bool], {}): a tuple of args and kwargs. The last one is always empty.
+        (list, dict): a tuple of args and kwargs with `wait` set to False.
     """
-    res = [str_to_int(time)] if time else []
-    return res, {}
+    kwargs['wait'] = False
+    return args, kwargs
 
 
-def say_synapse(text, amplitude=None, wpm=None):
-    """Synapse to adapt the parameters of say.
+def ack_synapse(future=None):
+    """Post-worker synapse that waits for the ack of a pipelined command.
 
     Args:
-        text (str): text to reproduce.
-		amplitude(int, optional): string representation of an integer.
-		wpm(int, optional): string representation of an integer.
+        future (Future, optional): future returned by the target. It's
+            None if the command has been scheduled instead of sent.
 
-    Returns:
-        ([str, int, int], {}): a tuple of args and kwargs. The last one is always empty.
+    Raises:
+        LegsException: if the ack isn't the expected one.
     """
-    res = [text]
-    res += [str_to_int(amplitude)] if amplitude else []
-    res += [str_to_int(wpm)] if wpm else []
-    return res, {}
+    if future:
+        future.result()
 
 
 class Body:
@@ -93,49 +336,210 @@ class Body:
     create the desired objects in `Body` and add the desidered synapses.
     """
 
-    def __init__(self, port=DEFAULT_PORT, logdir='/var/log/xm'):
+    def __init__(self, port=DEFAULT_PORT, logdir=DEFAULT_LOGDIR,
+                 cachedir=DEFAULT_CACHEDIR):
         """Creates a new istance of the body. By default it's composed by
-        a thread-safe version of `Legs`, `Mouth` and `Eyes`.
+        a thread-safe version of `Legs`, `Mouth` and `Eyes`. The movements
+        are scheduled by a `Cerebellum` so that only the newest asynchronous
+        movement is executed.
+        The parts are started in parallel in the background, so the body is
+        ready to answer right away: the circuits of a part that is starting
+        or missing fail with `PartUnavailable`, the others work.
 
         Args:
             port (str): serial port `Legs` will connect to.
             logdir (str): path where to store logs.
+            cachedir (str): path where to cache the rendered sentences.
         """
-        self.safe_legs = LockAdapter(Legs(port))
-
-        eye_log = '{}-eyes.log'.format(str(datetime.date.today()))
-        self.safe_mouth = Mouth()
-        self.safe_eye = Eyes(log=open(os.path.join(logdir, eye_log), 'w'))
-
+        start = time.monotonic()
+        legs = Legs(port, connect=False)
+        # a stop waiting for the lock cuts short the running movement
+        preempt = {'stop': partial(legs.stop, wait=False)}
+        self.safe_legs = LockAdapter(legs,
+                                     priority=PRIORITY_LEGS,
+                                     preempt=preempt,
+                                     wait_histogram=LOCK_WAIT)
+        self.cerebellum = Cerebellum(self.safe_legs)
+        # read without the lock of the legs
+        self.recorder = legs.recorder
+
+        self.safe_mouth = Mouth(cache=SpeechCache(cachedir),
+                                synthesizer=Synthesizer())
+        self.safe_eye = Eyes()
+        self.cortex = Cortex(self.safe_eye)
+        REGISTRY.gauge('xm_mouth_queue_depth',
+                       'Sentences waiting to be said',
+                       self.safe_mouth.sentences.qsize)
+        REGISTRY.gauge('xm_serial_baudrate', 'Speed of the serial link',
+                       lambda: legs.baudrate)
+        cerebellum = self.cerebellum
+        REGISTRY.gauge('xm_moves_dropped',
+                       'Asynchronous movements replaced before being sent',
+                       lambda: cerebellum.dropped)
+        REGISTRY.gauge('xm_moves_executed',
+                       'Asynchronous movements sent and acknowledged',
+                       lambda: cerebellum.executed)
+        REGISTRY.gauge('xm_moves_failed', 'Asynchronous movements that failed',
+                       lambda: cerebellum.errors)
+
+        self.parts = OrderedDict([
+            ('legs', Part('legs', legs.connect)),
+            ('mouth', Part('mouth', self._start_mouth)),
+            ('eyes', Part('eyes', partial(self._start_eyes, logdir))),
+        ])
         self.circuits = {}
+        # changes whenever a circuit is added, see `Brain.help_payload`
+        self.circuits_version = 0
 
+        legs_post = [ack_synapse]
         self.add_circuit('forward',
-                         target=self.safe_legs.forward,
-                         pre=[move_synapse])
+                         target=self.cerebellum.forward,
+                         pre=[nowait_synapse],
+                         post=legs_post,
+                         params=MOVE_PARAMS,
+                         part='legs')
         self.add_circuit('backward',
-                         target=self.safe_legs.backward,
-                         pre=[move_synapse])
+                         target=self.cerebellum.backward,
+                         pre=[nowait_synapse],
+                         post=legs_post,
+                         params=MOVE_PARAMS,
+                         part='legs')
         self.add_circuit('left',
-                         target=self.safe_legs.left,
-                         pre=[move_synapse])
+                         target=self.cerebellum.left,
+                         pre=[nowait_synapse],
+                         post=legs_post,
+                         params=MOVE_PARAMS,
+                         part='legs')
         self.add_circuit('right',
-                         target=self.safe_legs.right,
-                         pre=[move_synapse])
-        self.add_circuit('stop', target=self.safe_legs.stop)
+                         target=self.cerebellum.right,
+                         pre=[nowait_synapse],
+                         post=legs_post,
+                         params=MOVE_PARAMS,
+                         part='legs')
+        self.add_circuit('stop',
+                         target=self.cerebellum.stop,
+                         pre=[nowait_synapse],
+                         post=legs_post,
+                         params=(),
+                         part='legs')
+        self.add_circuit('drive',
+                         target=self.cerebellum.steer,
+                         params=DRIVE_PARAMS,
+                         part='legs')
+        self.add_circuit('move',
+                         target=self.cerebellum.move,
+                         params=TIMEDMOVE_PARAMS,
+                         part='legs')
+        self.add_circuit('move_status',
+                         target=self.cerebellum.move_status,
+                         params=MOVEID_PARAMS)
+        self.add_circuit('cancel_move',
+                         target=self.cerebellum.cancel_move,
+                         params=MOVEID_PARAMS,
+                         part='legs')
         self.add_circuit('set_speed',
                          target=self.safe_legs.set_speed,
-                         pre=[speedvalue_synapse])
+                         pre=[nowait_synapse],
+                         post=legs_post,
+                         params=SPEED_PARAMS,
+                         part='legs')
         self.add_circuit('set_movetime',
                          target=self.safe_legs.set_movetime,
-                         pre=[movetime_synapse])
-
-        self.add_circuit('say', target=self.safe_mouth.say, pre=[say_synapse])
+                         pre=[nowait_synapse],
+                         post=legs_post,
+                         params=MOVETIME_PARAMS,
+                         part='legs')
+        # read without the lock of the legs
+        self.add_circuit('link_status', target=legs.link_status, params=())
+
+        self.add_circuit('say',
+                         target=self.safe_mouth.say,
+                         params=SAY_PARAMS,
+                         part='mouth')
         self.add_circuit('shutup', target=self.safe_mouth.shutup)
+        self.add_circuit('interrupt', target=self.safe_mouth.interrupt)
+        self.add_circuit('clear_speech', target=self.safe_mouth.clear)
 
-        self.add_circuit('open_eyes', target=self.safe_eye.open)
+        self.add_circuit('open_eyes', target=self.safe_eye.open, part='eyes')
         self.add_circuit('close_eyes', target=self.safe_eye.close)
+        self.add_circuit('eyes_status', target=self.safe_eye.status)
+        self.add_circuit('set_eyes_profile',
+                         target=self.safe_eye.set_profile,
+                         part='eyes',
+                         params=PROFILE_PARAMS)
+        self.add_circuit('watch_motion',
+                         target=self.watch_motion,
+                         params=WATCHMOTION_PARAMS,
+                         part='eyes')
+        self.add_circuit('unwatch_motion', target=self.cortex.stop)
+        self.add_circuit('motion_status', target=self.cortex.status)
+
+        for part in self.parts.values():
+            part.start()
+        self.startup_time = time.monotonic() - start
+
+    def _start_mouth(self):
+        """Helper function that checks the mouth can speak.
+        """
+        synthesizer = self.safe_mouth.synthesizer
+        prog = synthesizer.prog if synthesizer else 'espeak'
+        if shutil.which(prog) is None:
+            raise PartUnavailable('{} not found'.format(prog))
+
+    def _start_eyes(self, logdir):
+        """Helper function that checks the eyes can see and opens their log.
+
+        Args:
+            logdir (str): path where to store the log of the backend
+        """
+        eyes = self.safe_eye
+        if shutil.which(eyes.mjpg_streamer) is None:
+            raise PartUnavailable('{} not found'.format(eyes.mjpg_streamer))
+        if not os.path.exists(eyes.dev):
+            raise PartUnavailable('no camera on {}'.format(eyes.dev))
+        eye_log = '{}-eyes.log'.format(str(datetime.date.today()))
+        try:
+            eyes.log = open(os.path.join(logdir, eye_log), 'w')
+        except OSError:
+            eyes.log = None  # the backend logs on stdout
+
+    def hold(self):
+        """Context manager that holds the lock of the legs, so that a
+        sequence of circuits can't be interleaved by other clients. The
+        asynchronous movements of the sequence are sent in order with the
+        other commands instead of being scheduled, see `Cerebellum.hold`.
+
+        Raises:
+            UnableToLock: if locking was impossible.
+        """
+        return self.cerebellum.hold()
+
+    def watch_motion(self, threshold=None, trigger=None):
+        """Starts looking for motion in the frames of the camera. See
+        `Cortex.start`.
+
+        Args:
+            threshold (int, optional): difference in gray levels, between 0
+                and 255, above which a pixel is moving
+            trigger (str, optional): name of a circuit without parameters to
+                call at each motion, e.g. 'stop'
+
+        Returns:
+            dict: the status of the cortex
+        """
+        callback = None
+        if trigger:
+            if trigger not in self.circuits:
+                raise XMValueError('Unknown circuit {}'.format(trigger))
+            call = self.circuits[trigger]['call']
+
+            def callback(event):
+                call()
 
-    def add_circuit(self, name, target, pre=None, post=None):
+        return self.cortex.start(threshold, callback)
+
+    def add_circuit(self, name, target, pre=None, post=None, part=None,
+                    params=None):
         """Method to add a new cirtcuit made by synapses.
         You have to give it a name and specify the target(aka core function)
         of the synapse. Optionally you can give functions which will be
@@ -144,18 +548,46 @@ class Body:
         functions which will be called after `target` and they should take
         the result of `target`(or nothing if the function returns None).
         The returned value of the `post-workers` is ignored.
+        The time spent in the pre-workers and in the rest of the circuit is
+        recorded in `PRE_TIME` and `TARGET_TIME`.
+        The parameters can be declared with `params`: they are converted and
+        checked before anything else, so invalid input never takes a lock.
+        The circuit is compiled once here, see `compile_circuit`.
+        If the circuit needs a part of the body the target isn't called
+        until the part is ready.
 
         Args:
             name (str): name of the circuit
             target (callable): core function to call
             pre (iterable of callables): pre-workers synapses called before `target`
             post (iterable of callables): post-workers synapses called after `target`
+            part (str, optional): name of the part of the body the circuit
+                needs
+            params (iterable of schema.Param, optional): declarations of the
+                parameters, see `schema.compile_schema`
         """
+        pre = tuple(pre or ())
+        post = tuple(post or ())
+        part = self.parts[part] if part else None
+        if params is not None:
+            validate = compile_schema(params)
+            described = [p.describe() for p in params]
+        else:
+            validate = None
+            described = circuit_params(pre[0] if pre else target)
+        prepare, run, call = compile_circuit(name, target, pre, post, part,
+                                             validate)
         self.circuits[name] = {
-            'pre-work': pre or [],
+            'pre-work': pre,
             'target': target,
-            'post-work': post or []
+            'post-work': post,
+            'part': part,
+            'params': described,
+            'prepare': prepare,
+            'run': run,
+            'call': call,
         }
+        self.circuits_version += 1
 
 
 class Brain:
@@ -171,6 +603,8 @@ class Brain:
             body (Body): body object to manage
         """
         self.body = body
+        self._help = None
+        self._help_lock = threading.Lock()
 
     def get_help(self):
         """Utility function that returns the docstring for each
@@ -183,11 +617,101 @@ class Brain:
                 new features will be definitely added.
         """
         ret = {}
-        for name in self.body.circuits:
-            ret[name] = {'doc': self.body.circuits[name]['target'].__doc__}
+        for name, syn in self.body.circuits.items():
+            ret[name] = {'doc': syn['target'].__doc__,
+                         'params': syn['params']}
 
         return ret
 
+    def help_version(self):
+        """Utility function that returns the version of the circuits, it
+        changes whenever the help changes.
+
+        Returns:
+            int: the version
+        """
+        return self.body.circuits_version
+
+    def help_payload(self):
+        """Utility function that returns the response of the help already
+        serialized. It's built again only when the circuits change.
+
+        Returns:
+            (str, bytes): the etag and the json representation of the
+                response with the help as data
+        """
+        version = self.body.circuits_version
+        cached = self._help
+        if cached is None or cached[0] != version:
+            with self._help_lock:
+                payload = json.dumps({'success': True,
+                                      'data': self.get_help()},
+                                     sort_keys=True).encode()
+                cached = (version, hashlib.sha1(payload).hexdigest(),
+                          payload)
+                self._help = cached
+        return cached[1:]
+
+    def metrics(self):
+        """Utility function that returns the metrics of the body, e.g. the
+        latency of each circuit and of the serial link.
+
+        Returns:
+            str: the metrics in the Prometheus text format
+        """
+        return REGISTRY.render()
+
+    def flight_record(self):
+        """Utility function that returns the last events of the serial link
+        of the legs. See `FlightRecorder.dump`.
+
+        Returns:
+            dict: the dump of the flight recorder
+        """
+        return self.body.recorder.dump()
+
+    def frame(self, after=0):
+        """Utility function that returns the latest frame of the camera,
+        starting the stream if needed. See `Eyes.frame`.
+
+        Args:
+            after (int, optional): sequence number of the last frame seen,
+                to wait for a newer one
+
+        Returns:
+            (int, bytes): the sequence number and the JPEG frame
+        """
+        self.body.parts['eyes'].require()
+        return self.body.safe_eye.frame(after)
+
+    def motion(self, after=0):
+        """Utility function that waits for the next motion seen by the
+        camera. See `Cortex.wait`.
+
+        Args:
+            after (int, optional): id of the last event seen
+
+        Returns:
+            dict: the event or None if no motion happened in time
+        """
+        return self.body.cortex.wait(after)
+
+    def health(self):
+        """Utility function that returns the readiness of the parts of the
+        body.
+
+        Returns:
+            dict: whether every part is `ready`, the `startup_ms` of the body
+                and the readiness of each one of the `parts`, see
+                `Part.status`
+        """
+        parts = self.body.parts
+        return {
+            'ready': all(p.state == 'ready' for p in parts.values()),
+            'startup_ms': int(self.body.startup_time * 1000),
+            'parts': {name: p.status() for name, p in parts.items()},
+        }
+
     def call(self, name, *args, **kwargs):
         """Executes the circuit identified by `name` with
         the given arguments.
@@ -199,11 +723,57 @@ class Brain:
 
         Returns:
             Whatever 'target' returns.
+
+        Raises:
+            PartUnavailable: if the circuit needs a part that isn't ready
+            InvalidParams: if the parameters don't match the declarations
         """
-        syn = self.body.circuits[name]
-        for p in syn['pre-work']:
-            args, kwargs = p(*args, **kwargs)
-        r = syn['target'](*args, **kwargs)
-        for p in syn['post-work']:
-            p(r) if r else p()
-        return r
+        return self.body.circuits[name]['call'](*args, **kwargs)
+
+    def call_many(self, calls):
+        """Executes a sequence of circuits as a whole. First of all the
+        pre-workers of every circuit are called, so that invalid inputs are
+        rejected before anything is executed, then the targets are called
+        in order while holding the lock of the legs. The execution stops
+        at the first circuit that fails.
+
+        Args:
+            calls (iterable of (str, dict)): name and keyword arguments of
+                each circuit to execute
+
+        Returns:
+            list of dict: the result of each circuit as a dict with the
+                name of the circuit(`cmd`), whether it succeeded(`success`)
+                and the error message(`error`) if it failed. Circuits not
+                executed because of a previous failure are marked as
+                `skipped`.
+
+        Raises:
+            KeyError: if a circuit doesn't exist
+            TypeError: if the arguments of a circuit are wrong
+            InvalidParams: if the parameters of a circuit don't match its
+                declarations
+            XMException: if a pre-worker rejects its input or the lock of
+                the legs can't be held
+        """
+        prepared = []
+        for name, kwargs in calls:
+            syn = self.body.circuits[name]
+            prepared.append((name, syn) + syn['prepare']((), kwargs))
+
+        results = []
+        with self.body.hold():
+            for name, syn, args, kwargs in prepared:
+                if results and not results[-1]['success']:
+                    results.append({'cmd': name,
+                                    'success': False,
+                                    'skipped': True})
+                    continue
+                try:
+                    syn['run'](args, kwargs)
+                    results.append({'cmd': name, 'success': True})
+                except (XMException, TypeError) as exc:
+                    results.append({'cmd': name,
+                                    'success': False,
+                                    'error': str(exc)})
+        return results
@@ -0,0 +1,546 @@
+"""The cerebellum coordinates the movements of the legs. It sits in front
+of `Legs` and schedules the asynchronous movements so that only the most
+recent intent is executed: when a client floods the rover with movements
+the ones that haven't been sent yet are replaced by the newest one instead
+of being replayed in order. `stop` is never dropped and it always preempts
+the pending movement.
+
+The future of an asynchronous movement is resolved once it has been
+acknowledged, so that its failure reaches the caller, or once it has been
+replaced by a newer movement. While a sequence of calls holds the legs with
+`hold` the working thread waits and the asynchronous movements of the
+holder are sent right away, in order with the other commands of the
+sequence.
+
+Timed movements are timed by the host instead of the firmware: the
+asynchronous movement is sent immediatly and the stop is scheduled on a
+monotonic clock, so that the caller gets back a handle to poll or cancel
+the movement without waiting for it. Any newer movement preempts the
+running timed one.
+
+Example:
+    $ cerebellum = Cerebellum(LockAdapter(Legs(port)))
+    $ cerebellum.forward(asynchronous=True)
+    $ cerebellum.left(asynchronous=True)      # may replace forward
+    $ cerebellum.steer(x=20, y=80)     # may replace left
+    $ cerebellum.stop()
+    $ handle = cerebellum.move('forward', 500)
+    $ cerebellum.move_status(handle['id'])
+    $ with cerebellum.hold():
+    $     cerebellum.forward(asynchronous=True)  # sent immediatly
+    $     cerebellum.legs.set_speed(100)
+"""
+
+import heapq
+import time
+import threading
+
+from collections import OrderedDict
+from functools import partial
+from concurrent.futures import Future
+from contextlib import contextmanager, ExitStack
+from util import (XMException, XMValueError, assert_int, assert_in_range,
+                  assert_uint16)
+
+MOVES = ('forward', 'backward', 'left', 'right')
+
+# number of finished timed movements whose status is kept
+MAX_FINISHED_MOVES = 64
+
+
+class UnknownMove(XMException):
+    """Exception raised if a timed movement can't be found.
+    """
+    pass
+
+
+class TimedMove:
+    """Handle of a movement timed by the host.
+
+    Attributes:
+        id (int): identifier of the movement
+        direction (str): name of the movement
+        duration (int): duration in ms
+        deadline (float): monotonic time at which the rover stops
+        state (str): 'running', 'done', 'cancelled', 'preempted' or
+            'failed'
+        error (str): the error if the movement failed
+    """
+
+    __slots__ = ('id', 'direction', 'duration', 'deadline', 'state', 'error')
+
+    def __init__(self, mid, direction, duration):
+        self.id = mid
+        self.direction = direction
+        self.duration = duration
+        self.deadline = time.monotonic() + duration / 1000
+        self.state = 'running'
+        self.error = None
+
+    def status(self):
+        """Returns the status of the movement.
+
+        Returns:
+            dict: id, direction, duration, state, remaining time in ms and
+                the error if any.
+        """
+        remaining = 0
+        if self.state == 'running':
+            remaining = max(0, int((self.deadline - time.monotonic()) * 1000))
+        return {
+            'id': self.id,
+            'direction': self.direction,
+            'duration': self.duration,
+            'state': self.state,
+            'remaining': remaining,
+            'error': self.error,
+        }
+
+
+class Cerebellum:
+    """Latest-wins scheduler of the movements of the legs.
+    Asynchronous movements are stored in a single slot and a working
+    thread sends them one at a time waiting for each ack, so that the
+    movements arriving meanwhile are coalesced into the newest one.
+    Synchronous movements and `stop` are sent immediatly after having
+    dropped the pending movement.
+    A single timer thread sends the stops of the timed movements.
+
+    Attributes:
+        legs (Legs): the legs to move, usually wrapped in a `LockAdapter`
+        dropped (int): number of movements replaced before being sent
+        executed (int): number of asynchronous movements acknowledged
+        errors (int): number of asynchronous movements that failed
+        last_error (Exception): the error of the last failed asynchronous
+            movement
+    """
+
+    def __init__(self, legs):
+        """Creates a new scheduler and starts its working thread.
+
+        Args:
+            legs (Legs): the legs to move
+        """
+        self.legs = legs
+        self.dropped = 0
+        self.executed = 0
+        self.errors = 0
+        self.last_error = None
+        self._pending = None
+        self._holder = None
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._timers_changed = threading.Condition(self._lock)
+        self._timers = []
+        self._moves = OrderedDict()
+        self._current = None
+        self._next_id = 1
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._timer = threading.Thread(target=self._run_timers, daemon=True)
+        self._timer.start()
+
+    def _run(self):
+        """Function the working thread uses to send the pending movements.
+        The write happens while holding the condition so that a `stop`
+        can't be overtaken by a movement taken before it. Nothing is sent
+        while the legs are held with `hold`.
+        """
+        while True:
+            with self._cond:
+                while self._pending is None or self._holder is not None:
+                    self._cond.wait()
+                (move, kwargs, result), self._pending = self._pending, None
+                self._preempt_current()
+                try:
+                    fut = getattr(self.legs, move)(wait=False, **kwargs)
+                except Exception as exc:
+                    self._failed(result, exc)
+                    continue
+            fut.exception()  # waits for the ack, one movement at a time
+            self._sent(result, fut)
+
+    def _sent(self, result, fut):
+        """Helper function that reports the ack of an asynchronous
+        movement to its caller.
+
+        Args:
+            result (Future): the future of the movement
+            fut (Future): the future of the ack
+        """
+        if fut.exception():
+            self._failed(result, fut.exception())
+        else:
+            self.executed += 1
+            result.set_result(None)
+
+    def _failed(self, result, exc):
+        """Helper function that records a failed asynchronous movement
+        and reports it to its caller.
+
+        Args:
+            result (Future): the future of the movement
+            exc (Exception): the error
+        """
+        self.errors += 1
+        self.last_error = exc
+        result.set_exception(exc)
+
+    def _run_timers(self):
+        """Function the timer thread uses to stop the timed movements once
+        their deadline is reached.
+        """
+        with self._lock:
+            while True:
+                if not self._timers:
+                    self._timers_changed.wait()
+                    continue
+                deadline, mid = self._timers[0]
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self._timers_changed.wait(delay)
+                    continue
+                heapq.heappop(self._timers)
+                move = self._moves.get(mid)
+                if move is None or move is not self._current:
+                    continue  # cancelled or preempted meanwhile
+                self._current = None
+                self._stop_timed(move, 'done')
+
+    def _stop_timed(self, move, state):
+        """Helper function that stops the rover at the end of a timed
+        movement. It must be called while holding the lock, the ack is
+        checked by a callback.
+
+        Args:
+            move (TimedMove): the movement
+            state (str): the state of the movement if the stop succeeds
+        """
+        def acked(fut):
+            if fut.exception():
+                move.state = 'failed'
+                move.error = str(fut.exception())
+
+        move.state = state
+        try:
+            self.legs.stop(wait=False).add_done_callback(acked)
+        except Exception as exc:
+            move.state = 'failed'
+            move.error = str(exc)
+
+    def _preempt_current(self):
+        """Helper function that marks the running timed movement, if any,
+        as preempted so that its stop isn't sent. It must be called while
+        holding the lock.
+        """
+        if self._current is not None:
+            self._current.state = 'preempted'
+            self._current = None
+
+    def _remember(self, move):
+        """Helper function that stores a timed movement forgetting the
+        oldest finished ones. It must be called while holding the lock.
+
+        Args:
+            move (TimedMove): the movement
+        """
+        self._moves[move.id] = move
+        finished = [mid for mid, m in self._moves.items()
+                    if m.state != 'running']
+        for mid in finished[:max(0, len(finished) - MAX_FINISHED_MOVES)]:
+            del self._moves[mid]
+
+    def _drop_pending(self):
+        """Helper function that drops the pending movement, if any.
+        It must be called while holding the condition.
+        """
+        if self._pending is not None:
+            self._pending[2].set_result(None)
+            self._pending = None
+            self.dropped += 1
+
+    def _schedule(self, move, kwargs, wait):
+        """Helper function that replaces the pending movement with a new
+        one, or sends it right away if the caller holds the legs.
+
+        Args:
+            move (str): name of the method of the legs
+            kwargs (dict): its keyword arguments
+            wait (bool): if False it returns the `Future` of the movement
+                without waiting for it.
+
+        Returns:
+            Future: the future of the movement if `wait` is False, it's
+                resolved once the movement has been acknowledged or
+                replaced by a newer one.
+
+        Raises:
+            LegsException: if `wait` is True and the movement failed
+        """
+        with self._cond:
+            self._drop_pending()
+            self._preempt_current()
+            if self._holder == threading.get_ident():
+                fut = getattr(self.legs, move)(wait=False, **kwargs)
+            else:
+                fut = Future()
+                self._pending = (move, kwargs, fut)
+                self._cond.notify()
+        if not wait:
+            return fut
+        fut.result()
+
+    @contextmanager
+    def hold(self):
+        """Context manager that holds the lock of the legs, so that a
+        sequence of calls can't be interleaved by other clients. The
+        pending movement is sent first, then the asynchronous movements of
+        the sequence are sent by the caller instead of the working thread.
+
+        Raises:
+            UnableToLock: if locking was impossible.
+        """
+        held = ExitStack()
+        with self._cond:
+            held.enter_context(self.legs.hold())
+            if self._pending is not None:
+                (move, kwargs, result), self._pending = self._pending, None
+                self._preempt_current()
+                try:
+                    fut = getattr(self.legs, move)(wait=False, **kwargs)
+                    fut.add_done_callback(partial(self._sent, result))
+                except Exception as exc:
+                    self._failed(result, exc)
+            self._holder = threading.get_ident()
+        try:
+            yield self
+        finally:
+            with self._cond:
+                self._holder = None
+                held.close()
+                self._cond.notify()
+
+    def _move(self, move, asynchronous, wait):
+        """Helper function that schedules a movement.
+
+        Args:
+            move (str): name of the movement
+            asynchronous (bool): if True the movement replaces the pending one
+                and it will be sent by the working thread, otherwise it's
+                sent immediatly.
+            wait (bool): if False it returns the `Future` of the movement
+                without waiting for it.
+
+        Returns:
+            Future: the future of the movement if `wait` is False, see
+                `_schedule` for the asynchronous ones.
+        """
+        if asynchronous:
+            return self._schedule(move, {'asynchronous': True}, wait)
+        with self._cond:
+            self._drop_pending()
+            self._preempt_current()
+            fut = getattr(self.legs, move)(asynchronous=False, wait=False)
+        if not wait:
+            return fut
+        fut.result()
+
+    def forward(self, asynchronous=False, wait=True):
+        """Makes the rover move forward. See `Legs.forward`.
+        Asynchronous movements are scheduled and may be replaced by newer
+        ones.
+
+        Args:
+            asynchronous(bool): if True it will return immediatly, otherwise
+                it will wait until the rover stops.
+            wait(bool): if False it returns the `Future` of the ack of a
+                synchronous movement without waiting for it.
+        """
+        return self._move('forward', asynchronous, wait)
+
+    def backward(self, asynchronous=False, wait=True):
+        """Makes the rover move backward. See `Legs.backward`.
+        Asynchronous movements are scheduled and may be replaced by newer
+        ones.
+
+        Args:
+            asynchronous(bool): if True it will return immediatly, otherwise
+                it will wait until the rover stops.
+            wait(bool): if False it returns the `Future` of the ack of a
+                synchronous movement without waiting for it.
+        """
+        return self._move('backward', asynchronous, wait)
+
+    def left(self, asynchronous=False, wait=True):
+        """Makes the rover move left. See `Legs.left`.
+        Asynchronous movements are scheduled and may be replaced by newer
+        ones.
+
+        Args:
+            asynchronous(bool): if True it will return immediatly, otherwise
+                it will wait until the rover stops.
+            wait(bool): if False it returns the `Future` of the ack of a
+                synchronous movement without waiting for it.
+        """
+        return self._move('left', asynchronous, wait)
+
+    def right(self, asynchronous=False, wait=True):
+        """Makes the rover move right. See `Legs.right`.
+        Asynchronous movements are scheduled and may be replaced by newer
+        ones.
+
+        Args:
+            asynchronous(bool): if True it will return immediatly, otherwise
+                it will wait until the rover stops.
+            wait(bool): if False it returns the `Future` of the ack of a
+                synchronous movement without waiting for it.
+        """
+        return self._move('right', asynchronous, wait)
+
+    def drive(self, left, right, wait=True):
+        """Sets the speed of each motor, see `Legs.drive`. Like the
+        asynchronous movements it replaces the pending one, so that a
+        joystick sending a command per tick never queues stale speeds.
+
+        Args:
+            left(int): speed of the left motor between -255 and 255,
+                negative to go backward.
+            right(int): speed of the right motor between -255 and 255.
+            wait(bool): if False it returns the `Future` of the movement
+                without waiting for it.
+
+        Raises:
+            XMValueError: if `left` or `right` aren't valid
+        """
+        for speed in (left, right):
+            assert_int(speed)
+            assert_in_range(speed, -0xFF, 0xFF)
+        return self._schedule('drive', {'left': left, 'right': right}, wait)
+
+    def steer(self, x, y, wait=True):
+        """Drives the rover with the vector of a joystick: `y` is the
+        throttle and `x` the turn, positive to the right. The motors get
+        `y + x` and `y - x`, scaled down together when one of them exceeds
+        100 so that the direction of the vector is kept, see `drive`.
+
+        Args:
+            x(int): turn between -100 and 100
+            y(int): throttle between -100 and 100, negative to go backward
+            wait(bool): if False it returns the `Future` of the movement
+                without waiting for it.
+
+        Raises:
+            XMValueError: if `x` or `y` aren't valid
+        """
+        for axis in (x, y):
+            assert_int(axis)
+            assert_in_range(axis, -100, 100)
+        left, right = y + x, y - x
+        peak = max(abs(left), abs(right), 100)
+        return self.drive(int(left * 0xFF / peak), int(right * 0xFF / peak),
+                          wait)
+
+    def stop(self, wait=True):
+        """Stops the rover dropping the pending movement. It's sent
+        immediatly and it's never dropped.
+
+        Args:
+            wait(bool): if False it returns the `Future` of the ack
+                without waiting for it.
+        """
+        with self._cond:
+            self._drop_pending()
+            self._preempt_current()
+            fut = self.legs.stop(wait=False)
+        if not wait:
+            return fut
+        fut.result()
+
+    def move(self, direction, time=None):
+        """Starts a movement timed by the host: the asynchronous movement is
+        sent and the stop is scheduled after `time` ms. It returns as soon
+        as the movement has been acknowledged.
+
+        Args:
+            direction (str): 'forward', 'backward', 'left' or 'right'
+            time (int, optional): duration in ms between 0 and 65535. By
+                default it's the move time of the legs.
+
+        Returns:
+            dict: the status of the movement, see `move_status`
+
+        Raises:
+            XMValueError: if `direction` or `time` aren't valid
+            LegsException: if the movement can't be sent
+        """
+        if direction not in MOVES:
+            raise XMValueError('{} must be one of {}'.format(
+                direction, ', '.join(MOVES)))
+        if time is None:
+            time = self.legs.get_movetime()
+        assert_uint16(time)
+
+        with self._cond:
+            self._drop_pending()
+            self._preempt_current()
+            fut = getattr(self.legs, direction)(asynchronous=True, wait=False)
+            move = TimedMove(self._next_id, direction, time)
+            self._next_id += 1
+            self._current = move
+            self._remember(move)
+            heapq.heappush(self._timers, (move.deadline, move.id))
+            self._timers_changed.notify()
+        try:
+            fut.result()
+        except Exception as exc:
+            with self._lock:
+                if self._current is move:
+                    self._current = None
+                move.state = 'failed'
+                move.error = str(exc)
+            raise
+        return move.status()
+
+    def move_status(self, id):
+        """Returns the status of a timed movement.
+
+        Args:
+            id (int): identifier of the movement
+
+        Returns:
+            dict: id, direction, duration in ms, state('running', 'done',
+                'cancelled', 'preempted' or 'failed'), remaining time in ms
+                and error.
+
+        Raises:
+            UnknownMove: if the movement doesn't exist or it has been
+                forgotten
+        """
+        with self._lock:
+            move = self._moves.get(id)
+            if move is None:
+                raise UnknownMove('Unknown move {}'.format(id))
+            return move.status()
+
+    def cancel_move(self, id):
+        """Cancels a timed movement stopping the rover immediatly. If the
+        movement isn't running anymore nothing is sent.
+
+        Args:
+            id (int): identifier of the movement
+
+        Returns:
+            dict: the status of the movement, see `move_status`
+
+        Raises:
+            UnknownMove: if the movement doesn't exist or it has been
+                forgotten
+        """
+        with self._lock:
+            move = self._moves.get(id)
+            if move is None:
+                raise UnknownMove('Unknown move {}'.format(id))
+            if move is self._current:
+                self._current = None
+                self._stop_timed(move, 'cancelled')
+            return move.status()
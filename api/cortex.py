@@ -0,0 +1,400 @@
+"""The visual cortex spots the motion in the frames of the eyes. While it's
+watching it reads the latest frames with `Eyes.frame`, so the camera stays
+on, and it compares each one with a running average of the previous ones
+(the background): the pixels that differ more than a threshold are moving.
+
+The frames are decoded by libjpeg at a reduced resolution(1/8 by default),
+which is much cheaper than decoding them whole, and the comparison is a
+handful of vectorized NumPy operations on buffers allocated once, so it
+keeps up with the camera on a Raspberry PI. If it's slower than the camera
+the frames in between are skipped, never queued.
+
+Each motion is an event with the bounding box of the moving pixels and an
+activity score(the fraction of moving pixels). The events can be waited
+for with `wait` and the callbacks given to `subscribe` are called with
+each of them, e.g. to stop the rover.
+
+NumPy and Pillow are optional, without them the rest of the body works
+but the cortex can't be started.
+
+Running this file benchmarks the detector on synthetic frames:
+    $ python3 cortex.py --resolution 640x480 --frames 300
+"""
+
+import io
+import sys
+import time
+import argparse
+import threading
+
+from metrics import REGISTRY
+from util import XMException, XMValueError
+
+try:
+    import numpy as np
+    from PIL import Image
+except ImportError:
+    np = Image = None
+
+DEFAULT_SCALE = 8
+DEFAULT_THRESHOLD = 25
+DEFAULT_MIN_SCORE = 0.01
+DEFAULT_ALPHA = 0.05
+DEFAULT_COOLDOWN = 1
+EVENT_TIMEOUT = 30
+
+DETECT_TIME = REGISTRY.histogram('xm_motion_detect_seconds',
+                                 'Time spent looking for motion in a frame')
+EVENTS = REGISTRY.counter('xm_motion_events', 'Motion events published')
+
+
+class MotionUnavailable(XMException):
+    """Exception raised if the motion detection needs NumPy and Pillow
+    but they aren't installed.
+    """
+    pass
+
+
+class MotionDetector:
+    """Detector of the motion in a sequence of JPEG frames.
+
+    Attributes:
+        scale (int): how much the frames are scaled down before looking at
+            them
+        threshold (int): difference in gray levels, between 0 and 255,
+            above which a pixel is moving
+        min_score (float): fraction of moving pixels above which there's
+            motion
+        alpha (float): weight of each frame in the background
+    """
+
+    def __init__(self, scale=DEFAULT_SCALE, threshold=DEFAULT_THRESHOLD,
+                 min_score=DEFAULT_MIN_SCORE, alpha=DEFAULT_ALPHA):
+        if np is None:
+            raise MotionUnavailable('Motion detection needs numpy and Pillow')
+        self.scale = scale
+        self.threshold = threshold
+        self.min_score = min_score
+        self.alpha = alpha
+        self._background = None
+
+    def _allocate(self, shape):
+        """Helper function that allocates the buffers for frames of the
+        given shape, e.g. at the start or when the camera changes profile.
+
+        Args:
+            shape ((int, int)): height and width of the scaled frames
+        """
+        self._background = np.empty(shape, np.float32)
+        self._diff = np.empty(shape, np.float32)
+        self._abs = np.empty(shape, np.float32)
+        self._mask = np.empty(shape, np.bool_)
+        self._rows = np.empty(shape[0], np.bool_)
+        self._cols = np.empty(shape[1], np.bool_)
+
+    def reset(self):
+        """Forgets the background, the next frame becomes the new one.
+        """
+        self._background = None
+
+    def detect(self, frame):
+        """Looks for motion in a frame and adds it to the background.
+
+        Args:
+            frame (bytes-like): the JPEG frame
+
+        Returns:
+            (float, (int, int, int, int)): the score and the bounding box
+                (left, top, right, bottom) of the motion, in pixels of the
+                frame, or None if there's no motion
+
+        Raises:
+            OSError: if the frame can't be decoded
+        """
+        img = Image.open(io.BytesIO(frame))
+        width, height = img.size
+        img.draft('L', (width // self.scale, height // self.scale))
+        if img.mode != 'L':
+            img = img.convert('L')
+        gray = np.asarray(img)
+
+        if self._background is None or self._background.shape != gray.shape:
+            self._allocate(gray.shape)
+            np.copyto(self._background, gray)
+            return None
+
+        np.subtract(gray, self._background, out=self._diff)
+        np.absolute(self._diff, out=self._abs)
+        np.greater(self._abs, self.threshold, out=self._mask)
+        # running average: background += alpha * (frame - background)
+        np.multiply(self._diff, self.alpha, out=self._diff)
+        np.add(self._background, self._diff, out=self._background)
+
+        score = np.count_nonzero(self._mask) / self._mask.size
+        if score < self.min_score:
+            return None
+        np.any(self._mask, axis=1, out=self._rows)
+        np.any(self._mask, axis=0, out=self._cols)
+        top = int(np.argmax(self._rows))
+        bottom = self._rows.size - int(np.argmax(self._rows[::-1]))
+        left = int(np.argmax(self._cols))
+        right = self._cols.size - int(np.argmax(self._cols[::-1]))
+        sx = width / self._cols.size
+        sy = height / self._rows.size
+        return float(score), (int(left * sx), int(top * sy),
+                              int(right * sx), int(bottom * sy))
+
+
+class Cortex:
+    """Watches the frames of the eyes for motion in a thread of its own.
+
+    Attributes:
+        eyes (Eyes): the eyes to watch
+        cooldown (float): minimum seconds between two events
+        processed (int): frames looked at
+        skipped (int): frames skipped because the detector was busy
+        errors (int): frames that couldn't be decoded and callbacks that
+            failed
+    """
+
+    def __init__(self, eyes, cooldown=DEFAULT_COOLDOWN):
+        """Creates a new cortex, it doesn't watch until `start` is called.
+
+        Args:
+            eyes (Eyes): the eyes to watch
+            cooldown (float, optional): minimum seconds between two events
+        """
+        self.eyes = eyes
+        self.cooldown = cooldown
+        self.processed = 0
+        self.skipped = 0
+        self.errors = 0
+        self._detector = None
+        self._token = None
+        self._trigger = None
+        self._subscribers = []
+        self._last = None
+        self._last_time = 0
+        self._fps = 0.0
+        self._cond = threading.Condition()
+
+    def _run(self, token, detector):
+        """Function the watching thread uses to look at the frames until
+        it's stopped.
+
+        Args:
+            token (object): identifier of this run of the thread
+            detector (MotionDetector): the detector to use
+        """
+        seq = 0
+        while self._token is token:
+            try:
+                new, frame = self.eyes.frame(seq)
+            except XMException:
+                time.sleep(1)  # the camera is down, try again later
+                continue
+            if seq:
+                self.skipped += max(0, new - seq - 1)
+            seq = new
+            start = time.perf_counter()
+            try:
+                found = detector.detect(frame)
+            except (OSError, ValueError):
+                self.errors += 1
+                continue
+            elapsed = time.perf_counter() - start
+            DETECT_TIME.labels().observe(elapsed)
+            self.processed += 1
+            self._fps = 0.9 * self._fps + 0.1 / max(elapsed, 1e-6)
+            if found and time.monotonic() - self._last_time > self.cooldown:
+                self._publish(seq, *found)
+
+    def _publish(self, seq, score, box):
+        """Helper function that publishes a motion event.
+
+        Args:
+            seq (int): sequence number of the frame
+            score (float): fraction of moving pixels
+            box ((int, int, int, int)): bounding box of the motion
+        """
+        with self._cond:
+            event = {
+                'id': self._last['id'] + 1 if self._last else 1,
+                't': time.time(),
+                'frame': seq,
+                'score': round(score, 4),
+                'box': list(box),
+            }
+            self._last = event
+            self._last_time = time.monotonic()
+            self._cond.notify_all()
+            callbacks = list(self._subscribers)
+        EVENTS.labels().inc()
+        for callback in callbacks:
+            try:
+                callback(event)
+            except Exception:
+                self.errors += 1
+
+    def subscribe(self, callback):
+        """Registers a function called with each motion event, in the
+        watching thread.
+
+        Args:
+            callback (callable): function taking the event
+        """
+        with self._cond:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """Removes a function registered with `subscribe`.
+
+        Args:
+            callback (callable): the function
+        """
+        with self._cond:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def wait(self, after=0, timeout=EVENT_TIMEOUT):
+        """Returns the latest motion event, waiting for one newer than
+        `after`.
+
+        Args:
+            after (int, optional): id of the last event seen
+            timeout (float, optional): seconds to wait
+
+        Returns:
+            dict: the event or None if no motion happened in time, see
+                `status`
+        """
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._last and self._last['id'] > after, timeout)
+            if self._last and self._last['id'] > after:
+                return self._last
+            return None
+
+    def start(self, threshold=None, trigger=None):
+        """Starts watching for motion, starting the camera if needed. If
+        it's already watching the settings are replaced.
+
+        Args:
+            threshold (int, optional): difference in gray levels, between 0
+                and 255, above which a pixel is moving
+            trigger (callable, optional): function called with each event,
+                it replaces the one of the previous start
+
+        Returns:
+            dict: the status of the cortex, see `status`
+
+        Raises:
+            MotionUnavailable: if NumPy or Pillow aren't installed
+            XMValueError: if `threshold` isn't valid
+        """
+        if threshold is not None and not 0 <= threshold <= 255:
+            raise XMValueError('threshold must be between 0 and 255')
+        detector = MotionDetector(
+            threshold=DEFAULT_THRESHOLD if threshold is None else threshold)
+        with self._cond:
+            if self._trigger:
+                self._subscribers.remove(self._trigger)
+            self._trigger = trigger
+            if trigger:
+                self._subscribers.append(trigger)
+            self._detector = detector
+            self._token = object()
+            threading.Thread(target=self._run,
+                             args=(self._token, detector),
+                             daemon=True).start()
+            return self.status()
+
+    def stop(self):
+        """Stops watching for motion, so that the camera can be stopped when
+        nobody else is watching. The trigger is removed.
+        """
+        with self._cond:
+            self._token = None
+            self._detector = None
+            if self._trigger:
+                self._subscribers.remove(self._trigger)
+                self._trigger = None
+
+    def status(self):
+        """Returns the status of the cortex.
+
+        Returns:
+            dict: whether it's `watching`, the `threshold`, the frames per
+                second the detector can handle(`fps`), the numbers of frames
+                `processed` and `skipped`, the number of
+                `errors` and the `last` event. Each event has an `id`, the
+                unix time `t`, the sequence number of the `frame`, the
+                `score` and the bounding `box` as [left, top, right,
+                bottom].
+        """
+        detector = self._detector
+        return {
+            'watching': detector is not None,
+            'threshold': detector.threshold if detector else None,
+            'fps': round(self._fps, 1),
+            'processed': self.processed,
+            'skipped': self.skipped,
+            'errors': self.errors,
+            'last': self._last,
+        }
+
+
+def synthetic_frames(resolution, count, size=40):
+    """Generates JPEG frames of a square moving on a noisy background.
+
+    Args:
+        resolution ((int, int)): width and height of the frames
+        count (int): number of frames
+        size (int, optional): side of the square in pixels
+
+    Returns:
+        list of bytes: the frames
+    """
+    width, height = resolution
+    rng = np.random.RandomState(0)
+    frames = []
+    for i in range(count):
+        pixels = rng.randint(90, 110, (height, width), np.uint8)
+        x = (i * 7) % max(1, width - size)
+        pixels[height // 3:height // 3 + size, x:x + size] = 250
+        out = io.BytesIO()
+        Image.fromarray(pixels).save(out, 'JPEG', quality=80)
+        frames.append(out.getvalue())
+    return frames
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measures how many frames per second the motion '
+                    'detector of XM handles')
+    parser.add_argument('--resolution', default='320x240',
+                        help='resolution of the frames, e.g. 640x480')
+    parser.add_argument('--frames', type=int, default=300,
+                        help='number of frames to process')
+    parser.add_argument('--scale', type=int, default=DEFAULT_SCALE,
+                        help='how much the frames are scaled down')
+    args = parser.parse_args()
+
+    if np is None:
+        sys.exit('The benchmark needs numpy and Pillow')
+    resolution = tuple(int(v) for v in args.resolution.split('x'))
+    frames = synthetic_frames(resolution, args.frames)
+    detector = MotionDetector(scale=args.scale)
+    events = 0
+    start = time.perf_counter()
+    for frame in frames:
+        events += detector.detect(frame) is not None
+    elapsed = time.perf_counter() - start
+    print('{} frames {}x{} at 1/{}: {:.1f} fps, {:.2f} ms per frame, '
+          '{} with motion'.format(len(frames), resolution[0], resolution[1],
+                                  args.scale, len(frames) / elapsed,
+                                  elapsed / len(frames) * 1000, events))
+
+
+if __name__ == '__main__':
+    main()
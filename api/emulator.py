@@ -0,0 +1,553 @@
+"""This module emulates the Arduino side of the XM-Legs protocol on a
+pseudo-terminal, so that `Legs`, `Body` and the api can be used without
+the real hardware. It follows `arduino/XM-Legs/XM-Legs.ino` as closely
+as possible: synchronous moves block for `moveTime` milliseconds unless
+the next command is a stop, the
+setters read their arguments with `readFirstValid` and unsupported
+commands are answered with a NACK. It speaks the v2 protocol as well, with
+its frames and its version request, and v3, with the pings and the switch
+of the speed of the link, unless it's told to emulate an older firmware.
+Speeds above `max_baudrate` corrupt bytes, like a cable that can't carry
+them, and so does a host that opens the port at a speed different from the
+one arduino has switched to.
+
+The speed of the link can be emulated with a given baudrate, moreover it's
+possible to add latency to each response and to lose bytes randomly.
+
+If you run this file the emulator is started and the path of its port
+is printed.
+
+Example:
+    $ arduino = ArduinoEmulator(baudrate=9600)
+    $ arduino.start()
+    $ legs = Legs(arduino.port)
+    $ legs.forward(asynchronous=True)
+    $ arduino.close()
+"""
+
+import os
+import pty
+import tty
+import time
+import random
+import select
+import termios
+import argparse
+import threading
+
+from queue import Queue
+
+UNSUPPORTED_CMD = 0xFE  # createNack(UNSUPPORTED_CMD) on a signed char
+ACK = 0x01
+
+LOW = 0
+HIGH = 1
+
+# direction of the motors (m1dir, m2dir) for each movement
+MOVES = {
+    ord('F'): (LOW, LOW),
+    ord('B'): (HIGH, HIGH),
+    ord('L'): (HIGH, LOW),
+    ord('R'): (LOW, HIGH),
+}
+
+# non-blocking version of the movements
+ASYNC_MOVES = {ord(chr(cmd).lower()): dirs for cmd, dirs in MOVES.items()}
+
+ASYNC_STOP = ord('z')
+SET_SPEED = ord('X')
+SET_MOVE_TIME = ord('T')
+VERSION = ord('V')
+SET_BAUDRATE = ord('N')
+PING = ord('P')
+DRIVE = ord('D')
+
+PROTOCOL_VERSION = 3
+BAUDRATES = (9600, 19200, 38400, 57600, 115200)
+BASE_BAUDRATE = 9600
+# speed the host opened the pseudo-terminal at, by termios constant
+HOST_BAUDRATES = {getattr(termios, 'B{}'.format(b)): b for b in BAUDRATES}
+# seconds after which a speed that hasn't been confirmed is given up
+TRIAL_TIMEOUT = 1
+# seconds to wait for each byte of a frame before dropping it
+FRAME_TIMEOUT = 0.1
+STX = 0x02
+MAX_FRAME = 64
+
+POLL_TIMEOUT = 0.1
+
+
+def crc8(data):
+    """Emulates `crc8`: the CRC-8 with polynomial 0x07 and initial value 0.
+
+    Args:
+        data(bytes-like): the bytes to check
+
+    Returns:
+        int: the CRC
+    """
+    crc = 0
+    for b in data:
+        crc ^= b
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07 if crc & 0x80 else crc << 1) & 0xFF
+    return crc
+
+
+class ArduinoEmulator:
+    """Emulator of the Arduino that controls the motors. Once started
+    it serves the protocol on a pseudo-terminal whose path is `port`.
+
+    Attributes:
+        port(str): path of the pseudo-terminal to give to `Legs`
+        baudrate(int): speed of the emulated link
+        move_time(int): the emulated `moveTime` in ms
+        motor_speed(int): the emulated `motorSpeed`
+        motors((int, int, int, int)): direction and speed of the two
+            motors as (m1dir, m1speed, m2dir, m2speed)
+        commands(int): number of commands that have been dispatched
+        protocol(int): highest version of the protocol spoken
+        frames(int): number of frames that have been received
+        corrupted(int): number of frames rejected because of their CRC
+        max_baudrate(int): fastest speed that doesn't corrupt bytes, None
+            for no limit
+        noise(float): probability that a byte is corrupted above
+            `max_baudrate`
+    """
+
+    def __init__(self, baudrate=9600, latency=0, loss=0, seed=None,
+                 protocol=PROTOCOL_VERSION, max_baudrate=None, noise=0.2):
+        """Creates a new emulator. To start serving call `start`.
+
+        Args:
+            baudrate(int, optional): speed of the emulated link. Each byte
+                takes 10 bits(8N1) to be transmitted. If None or 0 the
+                bytes are transmitted instantly. By default it's 9600.
+            latency(float, optional): seconds to wait before each response.
+            loss(float, optional): probability in [0, 1] that a byte, in
+                both directions, is lost.
+            seed(int, optional): seed for the random generator used to lose
+                bytes, to get repeatable runs.
+            protocol(int, optional): highest version of the protocol spoken,
+                1 to emulate a firmware that doesn't know frames.
+            max_baudrate(int, optional): fastest speed that doesn't corrupt
+                bytes, None for no limit.
+            noise(float, optional): probability that a byte is corrupted
+                above `max_baudrate`.
+        """
+        self.set_baudrate(baudrate)
+        self.latency = latency
+        self.loss = loss
+        self.port = None
+        self.move_time = 1000
+        self.motor_speed = 255
+        self.motors = (LOW, 0, LOW, 0)
+        self.commands = 0
+        self.protocol = protocol
+        self.frames = 0
+        self.corrupted = 0
+        self.max_baudrate = max_baudrate
+        self.noise = noise
+        self._trial = None
+        self._frame = None
+        self._frame_pos = 0
+        self._random = random.Random(seed)
+        self._peeked = None
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._tx_thread = None
+        self._tx = Queue()
+        self._running = threading.Event()
+
+    def set_baudrate(self, baudrate, switched=False):
+        """Changes the speed of the emulated link.
+
+        Args:
+            baudrate(int): new speed, if None or 0 the bytes are
+                transmitted instantly.
+            switched(bool, optional): True if arduino switched to it, in
+                that case the host has to be at the same speed, otherwise
+                the speed of the host doesn't matter.
+        """
+        self.baudrate = baudrate
+        self.byte_time = 10 / baudrate if baudrate else 0
+        self._switched = switched
+
+    def start(self):
+        """Opens the pseudo-terminal and starts serving the protocol in
+        a background thread.
+
+        Returns:
+            str: the path of the port
+        """
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._running.set()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        self._tx_thread = threading.Thread(target=self._transmit, daemon=True)
+        self._tx_thread.start()
+        return self.port
+
+    def close(self):
+        """Stops the emulator and closes the pseudo-terminal.
+        """
+        self._running.clear()
+        self._tx.put(None)
+        for thread in (self._thread, self._tx_thread):
+            if thread:
+                thread.join()
+        self._thread = self._tx_thread = None
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    def _lost(self):
+        """Helper function that decides if a byte has to be lost.
+
+        Returns:
+            bool: True if the byte is lost
+        """
+        return self.loss and self._random.random() < self.loss
+
+    def _mismatched(self):
+        """Helper function that checks if the host opened the port at a
+        speed different from the one arduino switched to.
+
+        Returns:
+            bool: True if the two ends of the link can't understand each
+                other
+        """
+        if not self._switched:
+            return False
+        speed = termios.tcgetattr(self._master)[5]
+        return HOST_BAUDRATES.get(speed, self.baudrate) != self.baudrate
+
+    def _garble(self, value):
+        """Helper function that corrupts a byte if the link is faster than
+        `max_baudrate` or if the host is at another speed, in which case
+        every byte is corrupted.
+
+        Args:
+            value(int): the byte
+
+        Returns:
+            int: the byte as it's received
+        """
+        if self._mismatched() or (
+                self.max_baudrate and self.baudrate and
+                self.baudrate > self.max_baudrate and
+                self._random.random() < self.noise):
+            return value ^ self._random.randint(1, 0xFF)
+        return value
+
+    def _check_trial(self):
+        """Emulates the end of the trial of a speed: if it hasn't been
+        confirmed in time the link goes back to `BASE_BAUDRATE`.
+        """
+        if self._trial is not None and time.monotonic() > self._trial:
+            self._trial = None
+            self.set_baudrate(BASE_BAUDRATE, True)
+
+    def _available(self, timeout=0):
+        """Helper function that checks if there is something to read.
+
+        Args:
+            timeout(float): seconds to wait for data
+
+        Returns:
+            bool: True if there is at least a byte to read
+        """
+        return bool(select.select([self._master], [], [], timeout)[0])
+
+    def _read(self, timeout=None):
+        """Helper function that reads a single byte like `Serial.read`.
+        It waits until a byte arrives, paying the transmission time, and
+        skips the lost ones.
+
+        Args:
+            timeout(float, optional): seconds to wait, like `readByte`,
+                None to wait forever like `readFirstValid`
+
+        Returns:
+            int: the byte or None if the emulator has been closed or the
+                timeout expired
+        """
+        if self._peeked is not None:
+            value, self._peeked = self._peeked, None
+            return value
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._running.is_set():
+            if not self._available(POLL_TIMEOUT if timeout is None else
+                                   max(0, deadline - time.monotonic())):
+                self._check_trial()
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None
+                continue
+            b = os.read(self._master, 1)
+            if not b:
+                return None
+            time.sleep(self.byte_time)
+            if not self._lost():
+                return self._garble(b[0])
+        return None
+
+    def _peek(self):
+        """Helper function that emulates `Serial.peek`: it returns the next
+        byte without consuming it.
+
+        Returns:
+            int: the next byte or None if there is nothing to read
+        """
+        if self._peeked is None and self._available():
+            b = os.read(self._master, 1)
+            time.sleep(self.byte_time)
+            if b and not self._lost():
+                self._peeked = self._garble(b[0])
+        return self._peeked
+
+    def _write(self, value):
+        """Helper function that writes a single byte like `Serial.write`.
+        It returns immediatly, the byte is delivered by the transmitter
+        thread after the latency.
+
+        Args:
+            value(int): byte to write
+        """
+        self._tx.put((time.monotonic() + self.latency, value))
+
+    def _transmit(self):
+        """Function the transmitter thread uses to deliver the written
+        bytes once their latency is elapsed, paying the transmission time.
+        The latency of different bytes overlaps like on a real link.
+        """
+        while True:
+            item = self._tx.get()
+            if item is None:
+                self._tx.task_done()
+                return
+            due, value = item
+            time.sleep(max(0, due - time.monotonic()) + self.byte_time)
+            if not self._lost():
+                os.write(self._master, bytes([self._garble(value) & 0xFF]))
+            self._tx.task_done()
+
+    def _set_motors(self, m1dir, m1speed, m2dir, m2speed):
+        """Emulates `setMotors`.
+        """
+        self.motors = (m1dir, m1speed, m2dir, m2speed)
+
+    def _stop_motors(self):
+        """Emulates `stopMotors`.
+        """
+        self.motors = (self.motors[0], 0, self.motors[2], 0)
+
+    def _wait_move(self):
+        """Emulates `waitMove`: it waits for `move_time` ms returning as
+        soon as the next command is a stop.
+        """
+        deadline = time.monotonic() + self.move_time / 1000
+        remaining = self.move_time / 1000
+        while remaining > 0 and self._running.is_set():
+            head = self._peek()
+            if head == ASYNC_STOP:
+                return
+            if head is not None:
+                # the stop can't be seen behind another command
+                time.sleep(remaining)
+                return
+            self._available(min(remaining, POLL_TIMEOUT))
+            remaining = deadline - time.monotonic()
+
+    def _arg(self):
+        """Emulates `readArg`: it returns the next argument of a command,
+        from the frame being executed or from the serial.
+
+        Returns:
+            int: the argument or None if the frame has no more bytes or the
+                emulator has been closed
+        """
+        if self._frame is None:
+            return self._read()
+        if self._frame_pos >= len(self._frame):
+            return None
+        value = self._frame[self._frame_pos]
+        self._frame_pos += 1
+        return value
+
+    def _loop(self):
+        """Function the emulator thread uses to dispatch the commands.
+        """
+        while self._running.is_set():
+            self._check_trial()
+            cmd = self._read()
+            if cmd is not None:
+                self._dispatch(cmd)
+
+    def _dispatch(self, cmd):
+        """Emulates `dispatch` for a single command or frame.
+
+        Args:
+            cmd(int): command byte that has been read
+        """
+        if self.protocol >= 2 and cmd == STX:
+            self._dispatch_frame()
+            return
+        if self.protocol >= 2 and cmd == VERSION:
+            self._write(cmd | ACK)
+            self._write(self.protocol)
+            return
+        if self.protocol >= 3 and cmd == PING:
+            value = self._read()
+            if value is not None:
+                self._write(cmd | ACK)
+                self._write(value)
+            return
+        if self.protocol >= 3 and cmd == SET_BAUDRATE:
+            self._switch_baudrate(cmd)
+            return
+        resp = self._execute(cmd)
+        if resp is not None:
+            self._write(resp)
+
+    def _switch_baudrate(self, cmd):
+        """Emulates SET_BAUDRATE: the speed is changed once the ack has
+        been sent and it's on trial until it's requested again at the new
+        speed. Requesting the current speed just confirms it.
+
+        Args:
+            cmd(int): command byte that has been read
+        """
+        index = self._read()
+        if index is None:
+            return
+        if index >= len(BAUDRATES):
+            self._write(cmd)  # NACK
+            return
+        self._write(cmd | ACK)
+        if BAUDRATES[index] == self.baudrate:
+            self._trial = None
+            return
+        self._tx.join()  # like Serial.flush
+        self.set_baudrate(BAUDRATES[index], True)
+        self._trial = time.monotonic() + TRIAL_TIMEOUT
+
+    def _dispatch_frame(self):
+        """Emulates `dispatchFrame`: it reads a frame whose STX has been
+        read, executes its commands and answers with a frame carrying the
+        ack of each one, or none if the frame is corrupted. A frame whose
+        bytes stop arriving is dropped, e.g. if the STX was a corrupted
+        byte.
+        """
+        length = self._read(FRAME_TIMEOUT)
+        if length is None:
+            return
+        body = bytearray()
+        for _ in range(length + 1):  # sequence number, commands and CRC
+            b = self._read(FRAME_TIMEOUT)
+            if b is None:
+                return
+            body.append(b)
+        self.frames += 1
+        seq = body[0] if body else 0
+        acks = bytearray()
+        if (0 < length <= MAX_FRAME - 3 and
+                crc8(bytes([length]) + body[:-1]) == body[-1]):
+            self._frame, self._frame_pos = body[:-1], 1
+            try:
+                while self._frame_pos < len(self._frame):
+                    cmd = self._arg()
+                    resp = self._execute(cmd)
+                    acks.append(cmd if resp is None else resp)
+            finally:
+                self._frame = None
+        else:
+            self.corrupted += 1
+        resp = bytes([len(acks) + 1, seq]) + acks
+        for b in bytes([STX]) + resp + bytes([crc8(resp)]):
+            self._write(b)
+
+    def _execute(self, cmd):
+        """Emulates the execution of a single command in `dispatch`.
+
+        Args:
+            cmd(int): command byte that has been read
+
+        Returns:
+            int: the response or None if the arguments are missing
+        """
+        resp = cmd | ACK
+        if cmd in MOVES:
+            m1dir, m2dir = MOVES[cmd]
+            self._set_motors(m1dir, self.motor_speed, m2dir, self.motor_speed)
+            self._wait_move()
+            self._stop_motors()
+        elif cmd in ASYNC_MOVES:
+            m1dir, m2dir = ASYNC_MOVES[cmd]
+            self._set_motors(m1dir, self.motor_speed, m2dir, self.motor_speed)
+        elif cmd == ASYNC_STOP:
+            self._stop_motors()
+        elif cmd == SET_SPEED:
+            value = self._arg()
+            if value is None:
+                return None
+            self.motor_speed = value
+        elif cmd == SET_MOVE_TIME:
+            b1 = self._arg()
+            b2 = self._arg()
+            if b1 is None or b2 is None:
+                return None
+            self.move_time = (b1 << 8) + b2
+        elif cmd == DRIVE:
+            dirs = self._arg()
+            m1speed = self._arg()
+            m2speed = self._arg()
+            if dirs is None or m1speed is None or m2speed is None:
+                return None
+            self._set_motors(HIGH if dirs & 1 else LOW, m1speed,
+                             HIGH if dirs & 2 else LOW, m2speed)
+        else:
+            resp = UNSUPPORTED_CMD
+        self.commands += 1
+        return resp
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Emulates the XM-Legs arduino on a pseudo-terminal')
+    parser.add_argument('--baudrate', type=int, default=9600,
+                        help='speed of the emulated link, 0 for no delay')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds to wait before each response')
+    parser.add_argument('--loss', type=float, default=0,
+                        help='probability that a byte is lost')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed for the byte loss')
+    parser.add_argument('--protocol', type=int, default=PROTOCOL_VERSION,
+                        help='highest version of the protocol, 1 to emulate '
+                             'an older firmware')
+    parser.add_argument('--max-baudrate', type=int, default=None,
+                        help='fastest speed that does not corrupt bytes')
+    parser.add_argument('--link', default=None,
+                        help='optional symlink to create to the port')
+    args = parser.parse_args()
+
+    arduino = ArduinoEmulator(args.baudrate, args.latency, args.loss,
+                              args.seed, args.protocol, args.max_baudrate)
+    port = arduino.start()
+    if args.link:
+        os.symlink(port, args.link)
+    print(args.link or port, flush=True)
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.link:
+            os.remove(args.link)
+        arduino.close()
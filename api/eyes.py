@@ -1,9 +1,185 @@
 """This module provides control on the streaming backend.
 In particular it uses `mjpg-streamer` as its backend because
 it's lightweight and it has good performance.
+
+The backend is started lazily, when the first viewer asks for the stream
+with `open`, and it's stopped when nobody has been watching for a while.
+The viewers connect straight to the backend, so they are counted looking
+at the established connections on its port.
+
+The stream can be shared as well: when somebody asks for a `frame` a
+reader pulls the stream once and keeps the latest frames in a
+preallocated `FrameRing` and each frame is copied once into immutable bytes
+shared by all the viewers, so that many viewers cost a single connection
+to the backend and a single copy of each frame.
+
+The framerate and the resolution are adapted to the load of the rover by
+the `Iris`, restarting the backend when the profile changes. The backend
+runs with a lower priority, so that it doesn't starve the control path.
 """
 
+import os
+import time
+import socket
+import threading
 import subprocess
+import http.client
+
+from iris import Iris
+from metrics import REGISTRY
+from util import XMException
+
+DEFAULT_IDLE_TIMEOUT = 60
+DEFAULT_NICENESS = 10
+STARTUP_TIMEOUT = 5
+WATCH_INTERVAL = 1
+RETRY_INTERVAL = 0.05
+
+DEFAULT_SLOTS = 8
+DEFAULT_SLOT_SIZE = 256 * 1024
+FRAME_TIMEOUT = 5
+
+# files listing the tcp sockets, see proc(5)
+PROC_TCP = ('/proc/net/tcp', '/proc/net/tcp6')
+TCP_ESTABLISHED = '01'
+
+STARTUP_TIME = REGISTRY.histogram(
+    'xm_eyes_startup_seconds',
+    'Time from the start of the streaming backend to its first connection',
+    buckets=(0.1, 0.25, 0.5, 1, 2, 3, 5, 10))
+RESTART_TIME = REGISTRY.histogram(
+    'xm_eyes_restart_seconds',
+    'Time the stream is down when the profile of the camera changes',
+    buckets=(0.1, 0.25, 0.5, 1, 2, 3, 5, 10))
+CRASHES = REGISTRY.counter('xm_eyes_crashes',
+                           'Streaming backends found dead by the watchdog')
+
+
+class NoFrame(XMException):
+    """Exception raised if no frame arrives in time.
+    """
+    pass
+
+
+class FrameRing:
+    """Ring of preallocated buffers keeping the latest JPEG frames. The
+    writer reads each frame straight into the buffer of the oldest one,
+    the readers get memoryviews of the buffers without copying them,
+    valid until `slots - 1` newer frames arrive, or the latest frame
+    copied once into bytes shared by every reader.
+
+    Attributes:
+        seq (int): sequence number of the latest frame, 0 if none
+        oversized (int): frames dropped because larger than a slot
+    """
+
+    def __init__(self, slots=DEFAULT_SLOTS, slot_size=DEFAULT_SLOT_SIZE):
+        """Creates an empty ring.
+
+        Args:
+            slots (int, optional): number of frames kept
+            slot_size (int, optional): maximum size of a frame in bytes
+        """
+        self.seq = 0
+        self.oversized = 0
+        self._slots = [bytearray(slot_size) for _ in range(slots)]
+        self._lengths = [0] * slots
+        self._shared = (0, None)
+        self._cond = threading.Condition()
+
+    def writable(self, length):
+        """Returns the buffer where to write the next frame.
+
+        Args:
+            length (int): size of the frame
+
+        Returns:
+            memoryview: the buffer or None if the frame is too large
+        """
+        slot = self._slots[(self.seq + 1) % len(self._slots)]
+        if length > len(slot):
+            self.oversized += 1
+            return None
+        return memoryview(slot)[:length]
+
+    def commit(self, length):
+        """Publishes the frame written in the buffer given by `writable`.
+
+        Args:
+            length (int): size of the frame
+        """
+        with self._cond:
+            self._lengths[(self.seq + 1) % len(self._slots)] = length
+            self.seq += 1
+            self._cond.notify_all()
+
+    def wait(self, after=0, timeout=FRAME_TIMEOUT):
+        """Returns the latest frame, waiting for one newer than `after`.
+
+        Args:
+            after (int, optional): sequence number of the last frame seen
+            timeout (float, optional): seconds to wait
+
+        Returns:
+            (int, memoryview): the sequence number and the frame or None
+                if no frame arrived in time
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.seq > after, timeout):
+                return None
+            i = self.seq % len(self._slots)
+            return self.seq, memoryview(self._slots[i])[:self._lengths[i]]
+
+    def wait_shared(self, after=0, timeout=FRAME_TIMEOUT):
+        """Like `wait` but the frame is copied into bytes the first time
+        it's asked for and the same bytes are returned to every reader, so
+        they can be kept as long as needed.
+
+        Args:
+            after (int, optional): sequence number of the last frame seen
+            timeout (float, optional): seconds to wait
+
+        Returns:
+            (int, bytes): the sequence number and the frame or None if no
+                frame arrived in time
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.seq > after, timeout):
+                return None
+            if self._shared[0] != self.seq:
+                i = self.seq % len(self._slots)
+                self._shared = (self.seq, bytes(
+                    memoryview(self._slots[i])[:self._lengths[i]]))
+            return self._shared
+
+
+def connection_stats(port):
+    """Utility function that counts the established tcp connections whose
+    local port is `port` and the bytes queued to be sent on them.
+
+    Args:
+        port (int): the local port
+
+    Returns:
+        (int, int): the number of connections and the send backlog or None
+            if they can't be counted
+    """
+    suffix = ':{:04X}'.format(port)
+    found = None
+    backlog = 0
+    for path in PROC_TCP:
+        try:
+            with open(path) as f:
+                lines = f.readlines()[1:]
+        except OSError:
+            continue
+        found = found or 0
+        for line in lines:
+            fields = line.split()
+            if fields[1].endswith(suffix) and fields[3] == TCP_ESTABLISHED:
+                found += 1
+                backlog += int(fields[4].partition(':')[0], 16)
+    return None if found is None else (found, backlog)
 
 
 class Eyes:
@@ -11,6 +187,23 @@ class Eyes:
     backend. A bunch of options are available for istance you
     can set the path for the binary, the resolution, port, etc...
     To start the backend call `open` and to close it call `close`.
+
+    While the backend runs a watchdog checks it every second: if it died
+    it's forgotten, so that the next `open` starts it again, and if it
+    has had no viewers for `idle_timeout` seconds it's stopped. It also
+    lets the `iris` adapt the profile of the camera, restarting the backend
+    when it changes.
+
+    Attributes:
+        iris (Iris): the controller of the framerate and the resolution
+        idle_timeout (float): seconds without viewers before stopping the
+            backend, None to never stop it
+        frames (FrameRing): the latest frames pulled by the reader
+        viewers (int): viewers connected at the last check, both to the
+            backend and waiting for a `frame`
+        startup_time (float): seconds the last backend took to accept
+            connections
+        crashes (int): number of backends found dead
     """
 
     def __init__(self,
@@ -24,7 +217,9 @@ class Eyes:
                  commands=False,
                  yuv=True,
                  port=8090,
-                 www='/usr/local/www'):
+                 www='/usr/local/www',
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 niceness=DEFAULT_NICENESS):
         """Creates a new manager for the streaming backend.
 
         Args:
@@ -41,7 +236,9 @@ class Eyes:
                 '/dev/video0'.
             framerate(int, optional): frames per second, by default it's 5.
             resolution((int, int), optional): resolution of the stream. It's a
-                tuple of widthxheight integers.
+                tuple of widthxheight integers. The camera starts with the
+                most expensive profile of the `Iris` that doesn't exceed
+                `framerate` and `resolution` and it never steps above it.
             commands(bool, optional): whether to use commands or not. By defaul
                 it's False.
             yuv(bool, optional): whether to use YUV format or not. By default
@@ -49,45 +246,299 @@ class Eyes:
             port(int, optional): which port to stream on. By default it's 8090.
             www(str, optional): path where to store images and backup stuff.
                 By default it's '/usr/local/www'.
+            idle_timeout(float, optional): seconds without viewers before
+                stopping the backend. By default it's 60, None to never
+                stop it.
+            niceness(int, optional): niceness added to the backend, so that
+                it gets the CPU after the api. By default it's 10.
         """
         self.mjpg_streamer = mjpg_streamer
         self.log = log
         self.in_lib = in_lib
         self.out_lib = out_lib
         self.dev = dev
-        self.framerate = framerate
-        self.resolution = resolution
+        self.iris = Iris(framerate, resolution)
+        self.framerate, self.resolution = self.iris.settings()
         self.commands = commands
         self.yuv = yuv
         self.port = port
         self.www = www
+        self.idle_timeout = idle_timeout
+        self.niceness = niceness
+        self.frames = FrameRing()
+        self.viewers = 0
+        self.startup_time = None
+        self.crashes = 0
         self._process = None
+        self._last_seen = 0
+        self._lock = threading.RLock()
+        self._watchdog = None
+        self._reader = None
+        self._reader_conn = None
+        self._waiting = 0
+        REGISTRY.gauge('xm_eyes_viewers', 'Viewers of the stream',
+                       lambda: self.viewers)
+
+    def _wait_ready(self, process):
+        """Helper function that waits until the backend accepts
+        connections, recording how long it took.
+
+        Args:
+            process (Popen): the backend
+        """
+        start = time.monotonic()
+        deadline = start + STARTUP_TIMEOUT
+        while time.monotonic() < deadline and process.poll() is None:
+            try:
+                socket.create_connection(('127.0.0.1', self.port),
+                                         0.1).close()
+            except OSError:
+                time.sleep(0.05)
+                continue
+            self.startup_time = time.monotonic() - start
+            STARTUP_TIME.labels().observe(self.startup_time)
+            return
+
+    def _watch(self, process):
+        """Function the watchdog thread uses to check the backend until
+        it's stopped.
+
+        Args:
+            process (Popen): the backend to check
+        """
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            with self._lock:
+                if self._process is not process:
+                    return  # closed meanwhile
+                if not self.poll():
+                    return
+                stats = connection_stats(self.port)
+                viewers, backlog = stats or (None, 0)
+                if viewers is not None:
+                    # the reader isn't a viewer, its clients are
+                    viewers += self._waiting - bool(self._reader_conn)
+                self.viewers = viewers or 0
+                now = time.monotonic()
+                if viewers is None or viewers:
+                    # can't tell if somebody is watching, keep it open
+                    self._last_seen = now
+                elif (self.idle_timeout is not None and
+                      now - self._last_seen > self.idle_timeout):
+                    self.close()
+                    return
+                if self.iris.update(self.viewers, backlog):
+                    self._restart()
+                    return
+
+    def _read_frames(self, process):
+        """Function the reader thread uses to pull the stream of the
+        backend into `frames` until it's stopped. Each part of the stream
+        has a 'Content-Length' header, so the JPEG is read straight into
+        the ring.
+
+        Args:
+            process (Popen): the backend to read from
+        """
+        while self._process is process:
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', self.port,
+                                                  timeout=FRAME_TIMEOUT)
+                conn.request('GET', '/?action=stream')
+                self._reader_conn = conn
+                resp = conn.getresponse()
+                length = None
+                while self._process is process:
+                    line = resp.readline()
+                    if not line:
+                        break
+                    name, _, value = line.partition(b':')
+                    if name.strip().lower() == b'content-length':
+                        length = int(value)
+                    elif not line.strip() and length is not None:
+                        buf = self.frames.writable(length)
+                        if buf is None:
+                            resp.read(length)
+                        elif resp.readinto(buf) == length:
+                            self.frames.commit(length)
+                        length = None
+            except (OSError, ValueError, http.client.HTTPException):
+                time.sleep(RETRY_INTERVAL)  # not ready yet or restarting
+            finally:
+                self._reader_conn = None
+                conn.close()
+
+    def _start_reader(self):
+        """Helper function that starts a reader of the running backend.
+        It must be called while holding the lock.
+        """
+        self._reader = threading.Thread(target=self._read_frames,
+                                        args=(self._process, ), daemon=True)
+        self._reader.start()
+
+    def frame(self, after=0):
+        """Returns the latest frame of the stream, starting the backend and
+        the reader if needed. While somebody asks for frames the backend
+        isn't considered idle.
+
+        Args:
+            after (int, optional): sequence number of the last frame seen,
+                to wait for a newer one
+
+        Returns:
+            (int, bytes): the sequence number and the JPEG frame, shared
+                by every viewer.
+
+        Raises:
+            NoFrame: if no frame arrives in time
+        """
+        with self._lock:
+            self._last_seen = time.monotonic()
+            if not self.poll():
+                self.open()
+            if not (self._reader and self._reader.is_alive()):
+                # the frames in the ring are stale, wait for a new one
+                after = max(after, self.frames.seq)
+                self._start_reader()
+            self._waiting += 1
+        try:
+            latest = self.frames.wait_shared(after)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        if latest is None:
+            raise NoFrame('No frame from the camera')
+        return latest
+
+    def _restart(self):
+        """Helper function that restarts the backend with the settings of
+        the current profile. The viewers of `frame` don't notice it, the
+        ones connected to the backend have to reconnect.
+        """
+        with self._lock:
+            self.framerate, self.resolution = self.iris.settings()
+            if not self.poll():
+                return
+            start = time.monotonic()
+            reading = self._reader and self._reader.is_alive()
+            self._process.kill()
+            self._process.wait()
+            self._process = None
+            self.open()
+            if reading:
+                self._start_reader()
+            RESTART_TIME.labels().observe(time.monotonic() - start)
+
+    def set_profile(self, profile):
+        """Pins the profile of the camera, restarting the backend if it's
+        running with different settings.
+
+        Args:
+            profile (str): name of the profile or 'auto' to let the iris
+                adapt it to the load of the rover
+
+        Returns:
+            dict: the status of the backend, see `status`
+
+        Raises:
+            XMValueError: if the profile doesn't exist
+        """
+        with self._lock:
+            self.iris.pin(profile)
+            if self.iris.settings() != (self.framerate, self.resolution):
+                self._restart()
+            return self.status()
+
+    def poll(self):
+        """Checks if the backend is alive. A dead backend is forgotten so
+        that the next `open` starts it again.
+
+        Returns:
+            bool: True if the backend is running
+        """
+        with self._lock:
+            if self._process is None:
+                return False
+            if self._process.poll() is None:
+                return True
+            self.crashes += 1
+            CRASHES.labels().inc()
+            self._process = None
+            self.viewers = 0
+            return False
+
+    def status(self):
+        """Returns the status of the backend.
+
+        Returns:
+            dict: whether it's `running`, the stream `port`, the number of
+                `viewers`, the `startup_ms` of the last start, the number
+                of `crashes`, the sequence number of the last `frame` read,
+                the current `profile`, whether it's `pinned` and the `cpu`
+                usage at the last check.
+        """
+        with self._lock:
+            running = self.poll()
+            return {
+                'running': running,
+                'port': self.port,
+                'viewers': self.viewers,
+                'startup_ms': (int(self.startup_time * 1000)
+                               if self.startup_time is not None else None),
+                'crashes': self.crashes,
+                'frame': self.frames.seq,
+                'profile': self.iris.profile,
+                'pinned': self.iris.pinned,
+                'cpu': self.iris.cpu,
+            }
 
     def open(self):
         """Creates the backend process and starts streaming. If the backend
-        is already open, then no action will be performed.
+        is already open, then no action will be performed but the idle
+        timeout starts again. It returns once the backend accepts
+        connections, so that the viewer can connect right away.
+
+        Returns:
+            dict: the status of the backend, see `status`
         """
-        if self._process:
-            return
+        with self._lock:
+            self._last_seen = time.monotonic()
+            if self.poll():
+                return self.status()
 
-        in_dev = '{ind} -d {dev} {cmd} {yuv} -r {res} -f {fps}'.format(
-            ind=self.in_lib,
-            dev=self.dev,
-            cmd='' if self.commands else '-n',
-            yuv='-y' if self.yuv else '',
-            res='{:d}x{:d}'.format(*self.resolution),
-            fps=self.framerate)
-        out_dev = '{out} -p {port:d} -w {www}'.format(out=self.out_lib,
-                                                      port=self.port,
-                                                      www=self.www)
-        self._process = subprocess.Popen([self.mjpg_streamer, '-i', in_dev,
-                                          '-o', out_dev],
-                                         stdout=self.log, stderr=self.log)
+            in_dev = '{ind} -d {dev} {cmd} {yuv} -r {res} -f {fps}'.format(
+                ind=self.in_lib,
+                dev=self.dev,
+                cmd='' if self.commands else '-n',
+                yuv='-y' if self.yuv else '',
+                res='{:d}x{:d}'.format(*self.resolution),
+                fps=self.framerate)
+            out_dev = '{out} -p {port:d} -w {www}'.format(out=self.out_lib,
+                                                          port=self.port,
+                                                          www=self.www)
+            self._process = subprocess.Popen([self.mjpg_streamer, '-i',
+                                              in_dev, '-o', out_dev],
+                                             stdout=self.log, stderr=self.log)
+            try:
+                os.setpriority(os.PRIO_PROCESS, self._process.pid,
+                               os.getpriority(os.PRIO_PROCESS, 0) +
+                               self.niceness)
+            except OSError:
+                pass  # already dead, the watchdog will notice it
+            self._wait_ready(self._process)
+            self._watchdog = threading.Thread(target=self._watch,
+                                              args=(self._process, ),
+                                              daemon=True)
+            self._watchdog.start()
+            return self.status()
 
     def close(self):
         """Kills the running backend process. If there is no running backend
         process, no actions will be performed.
         """
-        if self._process:
-            self._process.kill()
-            self._process = None
+        with self._lock:
+            if self._process:
+                self._process.kill()
+                self._process.wait()
+                self._process = None
+                self.viewers = 0
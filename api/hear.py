@@ -2,19 +2,141 @@
 GET request to '<host>:<port>/api/' to get the list of all availables functions
 and params. To call one of those do another GET request to
 '<host>:<port>/api/<function>' and pass the parameters via query params.
+The readiness of each part of the rover is on '<host>:<port>/api/health',
+it answers 503 while a part is still starting: the api answers right away
+and the circuits of a part that is missing fail while the others work.
+The metrics of the rover are available in the Prometheus text format on
+'<host>:<port>/api/metrics' and the last events of the serial link on
+'<host>:<port>/api/flight_record'.
+The latest frame of the camera is on '<host>:<port>/api/snapshot' and
+'<host>:<port>/api/stream' is an MJPEG stream shared by all its viewers.
+Each viewer holds a thread of the worker until it disconnects, so each
+worker serves at most `XM_MAX_VIEWERS`(2 by default) of them and answers
+503 to the others, leaving the rest of its threads to the other requests.
+Once `watch_motion` is called '<host>:<port>/api/motion?after=<id>' waits
+for the next motion event.
+The parameters of each function are declared in the help with their type
+and bounds and they are checked before the function runs: if any is wrong
+the api answers 400 with the list of `errors`, one per parameter.
+Several functions can be executed in sequence, without other clients
+interleaving, with a POST request to '<host>:<port>/api/batch' whose JSON
+body is '{"steps": [{"cmd": <function>, "params": {...}}, ...]}'.
+
+For teleoperation there is also a persistent WebSocket control channel on
+'<host>:<port>/api/ws'. Each text frame is a command in the compact form
+'<id>:<function>?<query params>', e.g. '7:forward?async=1', and for each
+frame the channel answers with '<id>:ok'(followed by ':<json>' if the
+function returns data), with '<id>:fail:<error>' if the function failed or
+with '<id>:err:<code>:<error>' if the request is wrong. Stops and
+asynchronous movements are executed as soon as they arrive, even while a
+synchronous movement sent before them is running.
+
+The serial port, the log directory and the directory of the speech cache
+can be overridden with the `XM_PORT`, `XM_LOGDIR` and `XM_CACHEDIR`
+environment variables, e.g. to run the api
+against the emulator. If `XM_SPINE` is set to the socket of a running spine
+the api doesn't own the body and it uses the one of the spine instead, so
+that several workers can run at the same time.
 
 If you run this file a debug server will be started.
 """
-from flask import Flask, request, abort, jsonify
-from flask.ext.cors import CORS
+import os
+import json
+import time
+import threading
 
-from brain import Brain, Body
-from util import XMException
+from queue import Queue
+from urllib.parse import parse_qsl
+from flask import Flask, Response, request, abort, jsonify
+from flask_cors import CORS
+from flask_sock import Sock
+
+from brain import (Brain, Body, DEFAULT_PORT, DEFAULT_LOGDIR,
+                   DEFAULT_CACHEDIR)
+from spine import RemoteBrain
+from schema import InvalidParams
+from util import XMException, XMValueError, str_to_bool
 
 app = application = Flask(__name__)
 cors = CORS(app, origins='*')
+sock = Sock(app)
+
+started = time.monotonic()
+if os.environ.get('XM_SPINE'):
+    brain = RemoteBrain(os.environ['XM_SPINE'])
+else:
+    brain = Brain(Body(port=os.environ.get('XM_PORT', DEFAULT_PORT),
+                       logdir=os.environ.get('XM_LOGDIR', DEFAULT_LOGDIR),
+                       cachedir=os.environ.get('XM_CACHEDIR',
+                                               DEFAULT_CACHEDIR)))
+# time this worker took to get ready to serve
+STARTUP_TIME = time.monotonic() - started
+
+
+ERRORS = {400: 'Bad request!', 404: 'Not found!'}
+
+# the most common response, serialized once
+SUCCESS = json.dumps({'success': True}).encode()
 
-brain = Brain(Body())
+BOUNDARY = 'xmframe'
+
+# viewers of the stream served at the same time by this worker
+MAX_VIEWERS = int(os.environ.get('XM_MAX_VIEWERS', 2))
+viewers = threading.BoundedSemaphore(MAX_VIEWERS)
+
+# (version, etag, payload) of the help, under the spine it's fetched again
+# only when the circuits change
+help_cache = None
+
+# commands of the control channel that don't wait for the previous frames
+IMMEDIATE_CMDS = frozenset(('stop', 'cancel_move', 'drive'))
+
+
+def run_cmd(cmd, params):
+    """Calls the circuit `cmd` with the given parameters mapping the
+    failures to the error codes of the api.
+
+    Args:
+        cmd (str): function to call.
+        params (dict): parameters of the function.
+
+    Returns:
+        (int, str, dict): the error code, the error message and the data.
+            The code is 200 if the circuit has been called, even if it
+            failed, and in that case the message is the one of the raised
+            exception. The data is what the circuit returned if it's a
+            document(e.g. the handle of a timed movement), None otherwise,
+            or the `errors` of the parameters if they are invalid.
+    """
+    try:
+        r = brain.call(cmd, **params)
+        return 200, None, r if isinstance(r, dict) else None
+    except InvalidParams as exc:
+        return 400, str(exc), {'errors': exc.errors}
+    except XMException as exc:
+        return 200, str(exc), None
+    except TypeError:
+        return 400, ERRORS[400], None
+    except KeyError:
+        return 404, ERRORS[404], None
+
+
+def invalid_params(error, errors):
+    """Utility function that builds the response for invalid parameters.
+
+    Args:
+        error (str): the message of the error
+        errors (list of dict): the `param` and the `error` of each invalid
+            parameter
+
+    Returns:
+        (Response, int): the json representation of the error with the
+            `errors` of each parameter and 400
+    """
+    return jsonify({'success': False,
+                    'err_code': 400,
+                    'error': error,
+                    'errors': errors}), 400
 
 
 @app.errorhandler(400)
@@ -44,10 +166,126 @@ def not_found(err):
 def get_help():
     """Main route that provides the documentation for the synapses.
 
+    The response is serialized once, and cached by each worker, and it
+    has an ETag, so clients can revalidate it with 'If-None-Match' and get
+    a 304 until the circuits change.
+
     Returns:
         str: the json representation of all the availables commands
     """
-    return jsonify({'success': True, 'data': brain.get_help()})
+    global help_cache
+    cached = help_cache
+    version = brain.help_version()
+    if cached is None or cached[0] != version:
+        cached = help_cache = (version, ) + tuple(brain.help_payload())
+    _, etag, payload = cached
+    resp = Response(payload, mimetype='application/json')
+    resp.set_etag(etag)
+    return resp.make_conditional(request)
+
+
+@app.route('/api/health', methods=['GET'])
+def get_health():
+    """Route that provides the readiness of each part of the body, the
+    startup time of the body and of this worker. It answers 503 while a
+    part is still starting.
+
+    Returns:
+        str: the json representation of the readiness
+    """
+    health = brain.health()
+    health['worker_startup_ms'] = int(STARTUP_TIME * 1000)
+    starting = any(p['state'] == 'starting'
+                   for p in health['parts'].values())
+    return jsonify({'success': True, 'data': health}), 503 if starting else 200
+
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Route that provides the metrics of the body, e.g. the latency of
+    each circuit, in the Prometheus text format.
+
+    Returns:
+        str: the metrics
+    """
+    return Response(brain.metrics(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/api/flight_record', methods=['GET'])
+def get_flight_record():
+    """Route that provides the last bytes written and read on the serial
+    link of the legs with the outcome of each command. The dump can be
+    replayed against the emulator with `replay.py`.
+
+    Returns:
+        str: the json representation of the flight record
+    """
+    return jsonify({'success': True, 'data': brain.flight_record()})
+
+
+@app.route('/api/snapshot', methods=['GET'])
+def get_snapshot():
+    """Route that provides the latest frame of the camera, starting the
+    stream if needed.
+
+    Returns:
+        bytes: the JPEG frame or the json representation of the error
+    """
+    try:
+        _, frame = brain.frame()
+    except XMException as exc:
+        return jsonify({'success': False, 'error': str(exc)})
+    return Response(frame, mimetype='image/jpeg')
+
+
+@app.route('/api/stream', methods=['GET'])
+def get_stream():
+    """Route that provides the MJPEG stream of the camera. All the viewers
+    share the frames read by a single reader of the backend, each one gets
+    the newest frame as soon as it's ready, skipping the ones it's too slow
+    for, until it disconnects or the camera stops. Above `MAX_VIEWERS` it
+    answers 503.
+
+    Returns:
+        the multipart stream of JPEG frames or the json representation of
+            the error
+    """
+    if not viewers.acquire(blocking=False):
+        resp = jsonify({'success': False,
+                        'error': 'Too many viewers, try again later'})
+        return resp, 503, {'Retry-After': '5'}
+
+    def frames():
+        seq = 0
+        while True:
+            try:
+                seq, frame = brain.frame(seq)
+            except XMException:
+                return
+            yield '--{}\r\nContent-Type: image/jpeg\r\n' \
+                'Content-Length: {:d}\r\n\r\n'.format(
+                    BOUNDARY, len(frame)).encode()
+            yield frame
+            yield b'\r\n'
+
+    resp = Response(frames(), mimetype='multipart/x-mixed-replace; '
+                                        'boundary=' + BOUNDARY)
+    resp.call_on_close(viewers.release)
+    return resp
+
+
+@app.route('/api/motion', methods=['GET'])
+def get_motion():
+    """Route that waits for the next motion seen by the camera, newer than
+    the event whose id is the `after` query parameter.
+
+    Returns:
+        str: the json representation of the event, with null data if no
+            motion happened in time
+    """
+    after = request.args.get('after', 0, type=int)
+    return jsonify({'success': True, 'data': brain.motion(after)})
 
 
 @app.route('/api/<cmd>', methods=['GET'])
@@ -55,7 +293,8 @@ def do_cmd(cmd):
     """Main route. According to which value `cmd` holds,
     the relative 'circuit' is called. Eventual parameters must be
     passed using query parameters. If the command isn't found, then
-    404-not found. If a parameter passing error occured then 400-bad request.
+    404-not found. If a parameter passing error occured then 400-bad request,
+    with the `errors` of the parameters if they don't match the declarations.
 
     Args:
         cmd (str): function to call.
@@ -63,15 +302,161 @@ def do_cmd(cmd):
     Returns:
         str: the json representation of the response
     """
+    code, error, data = run_cmd(cmd, request.args.to_dict(flat=True))
+    if code == 400 and data is not None:
+        return invalid_params(error, data['errors'])
+    if code != 200:
+        abort(code)
+    if error is not None:
+        return jsonify({'success': False, 'error': error})
+    if data is not None:
+        return jsonify({'success': True, 'data': data})
+    return Response(SUCCESS, mimetype='application/json')
+
+
+@app.route('/api/batch', methods=['POST'])
+def do_batch():
+    """Route that executes a sequence of functions as a whole. The body
+    must be a JSON object with the list of `steps` to execute, each one with
+    the name of the function(`cmd`) and optionally its parameters(`params`).
+    Every parameter is validated before executing anything: if a function
+    isn't found then 404-not found, if a parameter is wrong then 400-bad
+    request. The execution stops at the first function that fails.
+
+    Returns:
+        str: the json representation of the response with the result of
+            each step
+    """
+    body = request.get_json(silent=True)
     try:
-        brain.call(cmd, **request.args.to_dict(flat=True))
-        return jsonify({'success': True})
+        calls = [(step['cmd'], step.get('params', {}))
+                 for step in body['steps']]
+    except (TypeError, KeyError, AttributeError):
+        abort(400)
+    if not all(isinstance(params, dict) for _, params in calls):
+        abort(400)
+
+    try:
+        results = brain.call_many(calls)
+    except InvalidParams as exc:
+        return invalid_params(str(exc), exc.errors)
     except XMException as exc:
         return jsonify({'success': False, 'error': str(exc)})
     except TypeError:
         abort(400)
     except KeyError:
         abort(404)
+    return jsonify({'success': all(r['success'] for r in results),
+                    'data': results})
+
+
+@sock.route('/api/ws')
+def control_channel(ws):
+    """Persistent control channel. Each frame is a command in the form
+    '<id>:<function>?<query params>' and it's answered with '<id>:ok' if
+    the circuit succeeded(or '<id>:ok:<json>' if it returned data), with
+    '<id>:fail:<error>' if it failed or with '<id>:err:<code>:<error>' if
+    the frame is a bad request(400) or the function doesn't exist(404).
+    Commands are executed in the same order they are received by a
+    working thread, except stops and asynchronous movements, that are
+    executed right away so that they don't wait for a synchronous movement
+    to finish. Their responses may overtake the ones of earlier frames.
+
+    Args:
+        ws (Server): the websocket connection
+    """
+    send_lock = threading.Lock()
+    frames = Queue()
+
+    def send(response):
+        with send_lock:
+            ws.send(response)
+
+    def work():
+        while True:
+            frame = frames.get()
+            if frame is None:
+                return
+            try:
+                send(handle_frame(*frame))
+            except Exception:
+                return  # the connection has been closed meanwhile
+
+    worker = threading.Thread(target=work, daemon=True)
+    worker.start()
+    try:
+        while True:
+            frame = ws.receive()
+            if frame is None:
+                return
+            frame = parse_frame(frame)
+            if is_immediate(frame):
+                send(handle_frame(*frame))
+            else:
+                frames.put(frame)
+    finally:
+        frames.put(None)
+
+
+def parse_frame(frame):
+    """Splits a frame of the control channel.
+
+    Args:
+        frame (str or bytes): the frame '<id>:<function>?<query params>'
+
+    Returns:
+        (str, str, dict): the id, the function or None if the frame is
+            malformed and the params
+    """
+    if isinstance(frame, bytes):
+        frame = frame.decode(errors='replace')
+    fid, sep, cmd = frame.partition(':')
+    if not sep or not cmd:
+        return fid, None, {}
+    cmd, _, query = cmd.partition('?')
+    return fid, cmd, dict(parse_qsl(query))
+
+
+def is_immediate(frame):
+    """Checks if a frame of the control channel must be executed without
+    waiting for the previous ones.
+
+    Args:
+        frame (str, str, dict): the frame, see `parse_frame`
+
+    Returns:
+        bool: True for stops and asynchronous movements
+    """
+    _, cmd, params = frame
+    if cmd in IMMEDIATE_CMDS:
+        return True
+    try:
+        return str_to_bool(params.get('async', 'false'))
+    except XMValueError:
+        return False
+
+
+def handle_frame(fid, cmd, params):
+    """Executes the command contained in a frame of the control channel.
+
+    Args:
+        fid (str): the id of the frame
+        cmd (str): the function or None if the frame is malformed
+        params (dict): the params of the function
+
+    Returns:
+        str: the response frame
+    """
+    if cmd is None:
+        return '{}:err:400:{}'.format(fid, ERRORS[400])
+    code, error, data = run_cmd(cmd, params)
+    if code != 200:
+        return '{}:err:{:d}:{}'.format(fid, code, error)
+    if error is not None:
+        return '{}:fail:{}'.format(fid, error)
+    if data is not None:
+        return '{}:ok:{}'.format(fid, json.dumps(data, separators=(',', ':')))
+    return '{}:ok'.format(fid)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,225 @@
+"""The iris adapts the camera to the conditions of the rover, like a real
+one does with the light. It steps the framerate and the resolution of the
+stream up or down through a small set of profiles looking at the load of
+the CPU, at the number of viewers and at the bytes the backend hasn't been
+able to send yet(the send backlog).
+
+It steps down as soon as the rover is under pressure and it steps up only
+after the rover has been calm for a while, never above the profile of the
+settings it has been created with, and it never changes profile twice
+within `dwell` seconds, because every change restarts the backend.
+A profile can be pinned by hand, in that case it's never changed.
+
+Attributes:
+    PROFILES (OrderedDict): name -> (framerate, resolution, max_viewers) of
+        each profile, from the cheapest to the most expensive one. A
+        profile isn't used with more than `max_viewers` viewers, None means
+        no limit.
+
+Example:
+    $ iris = Iris(framerate=5, resolution=(320, 240))
+    $ iris.update(viewers=1, backlog=0)     # True if the profile changed
+    $ iris.settings()
+    (5, (320, 240))
+    $ iris.pin('low')
+"""
+
+import time
+
+from collections import OrderedDict
+from util import XMValueError
+
+PROFILES = OrderedDict([
+    ('low', (2, (160, 120), None)),
+    ('medium', (5, (320, 240), 8)),
+    ('high', (10, (640, 480), 2)),
+])
+
+# name to resume adapting the profile
+AUTO = 'auto'
+
+# fraction of the CPU above which the profile is stepped down and below
+# which it can be stepped up
+CPU_HIGH = 0.8
+CPU_LOW = 0.5
+# bytes per viewer waiting to be sent above which the profile is stepped
+# down and below which it can be stepped up
+BACKLOG_HIGH = 64 * 1024
+BACKLOG_LOW = 4 * 1024
+# consecutive calm checks before stepping up
+CALM_CHECKS = 10
+DEFAULT_DWELL = 5
+
+PROC_STAT = '/proc/stat'
+
+
+class CpuMeter:
+    """Measures the fraction of time the CPUs have been busy between two
+    calls, reading '/proc/stat'.
+    """
+
+    def __init__(self):
+        self._last = self._read()
+
+    @staticmethod
+    def _read():
+        """Helper function that reads the time spent by the CPUs.
+
+        Returns:
+            (int, int): the busy and the total time or None if they can't
+                be read
+        """
+        try:
+            with open(PROC_STAT) as f:
+                fields = [int(v) for v in f.readline().split()[1:]]
+        except (OSError, ValueError):
+            return None
+        idle = sum(fields[3:5])  # idle and iowait
+        return sum(fields) - idle, sum(fields)
+
+    def usage(self):
+        """Returns the CPU usage since the last call.
+
+        Returns:
+            float: the busy fraction between 0 and 1 or None if it can't be
+                measured
+        """
+        last, self._last = self._last, self._read()
+        if last is None or self._last is None:
+            return None
+        total = self._last[1] - last[1]
+        if total <= 0:
+            return None
+        return (self._last[0] - last[0]) / total
+
+
+class Iris:
+    """Controller of the profile of the camera. `update` is meant to be
+    called periodically while the backend runs.
+
+    Attributes:
+        profiles (OrderedDict): the available profiles, see `PROFILES`
+        dwell (float): minimum seconds between two changes
+        pinned (bool): whether the profile has been pinned by hand
+        cpu (float): the CPU usage at the last update, None if unknown
+        changes (int): number of changes made by the controller
+    """
+
+    def __init__(self, framerate, resolution, profiles=PROFILES,
+                 dwell=DEFAULT_DWELL):
+        """Creates a new controller starting from the most expensive
+        profile that doesn't exceed the given settings, that is the highest
+        profile it steps up to.
+
+        Args:
+            framerate (int): initial frames per second
+            resolution ((int, int)): initial resolution
+            profiles (OrderedDict, optional): the available profiles
+            dwell (float, optional): minimum seconds between two changes
+        """
+        self.profiles = profiles
+        self.dwell = dwell
+        self.pinned = False
+        self.cpu = None
+        self.changes = 0
+        self._names = list(profiles)
+        self._index = 0
+        for i, (fps, res, _) in enumerate(profiles.values()):
+            if fps <= framerate and res[0] * res[1] <= (resolution[0] *
+                                                        resolution[1]):
+                self._index = i
+        self._top = self._index
+        self._calm = 0
+        self._changed = 0
+        self._cpu_meter = CpuMeter()
+
+    @property
+    def profile(self):
+        """str: name of the current profile"""
+        return self._names[self._index]
+
+    def settings(self):
+        """Returns the settings of the current profile.
+
+        Returns:
+            (int, (int, int)): the framerate and the resolution
+        """
+        framerate, resolution, _ = self.profiles[self.profile]
+        return framerate, resolution
+
+    def pin(self, profile):
+        """Pins a profile so that the controller doesn't change it.
+
+        Args:
+            profile (str): name of the profile or 'auto' to resume adapting
+                the profile
+
+        Raises:
+            XMValueError: if the profile doesn't exist
+        """
+        if profile == AUTO:
+            self.pinned = False
+            return
+        if profile not in self.profiles:
+            raise XMValueError('{} must be one of {}'.format(
+                profile, ', '.join(self._names + [AUTO])))
+        self._index = self._names.index(profile)
+        self.pinned = True
+        self._calm = 0
+        self._changed = time.monotonic()
+
+    def update(self, viewers, backlog):
+        """Steps the profile up or down according to the conditions of the
+        rover.
+
+        Args:
+            viewers (int): number of viewers of the stream
+            backlog (int): bytes the backend hasn't sent yet
+
+        Returns:
+            bool: True if the profile has changed
+        """
+        self.cpu = self._cpu_meter.usage()
+        if self.pinned or not viewers:
+            self._calm = 0
+            return False
+        backlog /= viewers
+        _, _, max_viewers = self.profiles[self.profile]
+        if ((self.cpu is not None and self.cpu > CPU_HIGH) or
+                backlog > BACKLOG_HIGH or
+                (max_viewers is not None and viewers > max_viewers)):
+            self._calm = 0
+            return self._step(-1)
+
+        if self._index < self._top:
+            _, _, max_viewers = self.profiles[self._names[self._index + 1]]
+            if ((self.cpu is None or self.cpu < CPU_LOW) and
+                    backlog < BACKLOG_LOW and
+                    (max_viewers is None or viewers <= max_viewers)):
+                self._calm += 1
+                if self._calm >= CALM_CHECKS:
+                    self._calm = 0
+                    return self._step(1)
+                return False
+        self._calm = 0
+        return False
+
+    def _step(self, delta):
+        """Helper function that moves to the next or the previous profile
+        unless the last change is too recent.
+
+        Args:
+            delta (int): 1 to step up, -1 to step down
+
+        Returns:
+            bool: True if the profile has changed
+        """
+        index = self._index + delta
+        now = time.monotonic()
+        if not 0 <= index < len(self._names) or (now - self._changed <
+                                                  self.dwell):
+            return False
+        self._index = index
+        self._changed = now
+        self.changes += 1
+        return True
@@ -1,12 +1,45 @@
 """This is the interface 'client-side' of the protocol to communicate
 with the motors. It's just a collection of a bunch of utilities.
 To get an overview of the protocol refer to the arduino protocol documentation.
+
+Two versions of the protocol are spoken. In v1 each command is written as
+it is and it's answered with a single ack byte. In v2 the commands can be
+wrapped in frames with a length, a sequence number and a CRC, a frame can
+carry several commands(see `Legs.batch`) and its response carries the ack
+of each one, so responses are matched by sequence number and corrupted
+frames are detected. Single commands are still written as in v1, since a
+frame would cost them 4 bytes each way. The version is negotiated when the
+port is opened and firmwares that don't know v2 are spoken to in v1.
+
+Since v3 the link starts at 9600 baud and it's switched to the fastest
+speed that works reliably: at each candidate speed, from the fastest one,
+a burst of pings measures the round-trip time and the error rate. Arduino
+goes back to 9600 by itself unless the speed is confirmed at the new speed
+within `TRIAL_TIMEOUT`, so a speed that doesn't work can't lose the link.
+At a speed arduino can't read the pings are corrupted and they may be
+executed as other commands, so the rover may move while it's probing:
+once the speed has been chosen the motors are stopped and the speed and
+the move time are sent again.
+
+Running this file benchmarks the two versions on the emulator:
+    $ python3 leg.py --baudrate 9600 --commands 1000 --batch 4
 """
 
-from serial import Serial
+from collections import deque
+from concurrent.futures import Future
+from serial import Serial, SerialException
 from enum import Enum, unique
-from util import (assert_uint8, assert_uint16, assert_bytes, int8_to_byte,
-                  uint8_to_byte, uint16_to_bytes, XMException)
+
+import argparse
+import struct
+import threading
+import time
+
+from metrics import REGISTRY
+from recorder import FlightRecorder, DEFAULT_SIZE
+from util import (assert_uint8, assert_uint16, assert_bytes, assert_int,
+                  assert_in_range, int8_to_byte, uint8_to_byte,
+                  uint16_to_bytes, XMException)
 
 
 @unique
@@ -31,6 +64,13 @@ class ArduinoMessages(Enum):
         Set_Speed: sets the motors speed
         Set_MoveTime: sets the time motors during which motors will move
                     syncronously
+        Version: asks the highest version of the protocol arduino speaks
+        Set_Baudrate: switches the speed of the link, it requires 1
+                    additional byte with the index of the speed in
+                    `BAUDRATES`
+        Ping: answered with its ack followed by its additional byte
+        Drive: sets the direction and the speed of each motor, it requires
+                    3 additional bytes, see `DRIVE`
     """
     Unsupported = int8_to_byte(-2)
     NAck = int8_to_byte(0)
@@ -42,6 +82,10 @@ class ArduinoMessages(Enum):
     Stop = int8_to_byte(ord('Z'))
     Set_Speed = int8_to_byte(ord('X'))
     Set_MoveTime = int8_to_byte(ord('T'))
+    Version = int8_to_byte(ord('V'))
+    Set_Baudrate = int8_to_byte(ord('N'))
+    Ping = int8_to_byte(ord('P'))
+    Drive = int8_to_byte(ord('D'))
 
 
 def create_ack(msg):
@@ -75,51 +119,892 @@ class LegsException(XMException):
     pass
 
 
+class FrameError(LegsException):
+    """Exception raised when a frame of the v2 protocol is truncated or
+    corrupted.
+    """
+    pass
+
+
+DEFAULT_WINDOW = 8
+DEFAULT_MOVETIME = 1000
+DEFAULT_SPEED = 255
+READ_TIMEOUT = 0.1
+
+# highest version of the protocol spoken by `Legs`
+PROTOCOL_VERSION = 3
+# attempts and seconds to wait for the answer to the version request, the
+# arduino may be still booting right after the port is opened
+NEGOTIATE_TRIES = 3
+NEGOTIATE_TIMEOUT = 0.5
+
+# speeds arduino can switch to, the index is sent with the request
+BAUDRATES = (9600, 19200, 38400, 57600, 115200)
+BASE_BAUDRATE = 9600
+# pings sent at each candidate speed and fraction of them that can fail
+PROBE_PINGS = 50
+MAX_ERROR_RATE = 0.02
+PING_TIMEOUT = 0.1
+# seconds after which arduino goes back to `BASE_BAUDRATE` if the new
+# speed hasn't been confirmed
+TRIAL_TIMEOUT = 1
+# seconds to wait for an ack on top of the duration of the command
+ACK_TIMEOUT = 1
+
+# synchronous movements, their ack arrives once the rover stops
+SYNC_MOVES = frozenset((b'F', b'B', b'L', b'R'))
+# layout of the drive command: 'D', the directions of the motors(bit 0 set
+# if the left one goes backward, bit 1 for the right one) and their speeds
+DRIVE = struct.Struct('cBBB')
+
+# start of a frame: STX, length, sequence number, commands, CRC. The length
+# counts the sequence number and the commands, the CRC covers the length,
+# the sequence number and the commands. It's never a v1 command or ack.
+STX = 0x02
+# frames must fit the receive buffer of arduino
+MAX_FRAME = 64
+# seconds to wait for the rest of a frame once its start has been read
+FRAME_TIMEOUT = 0.5
+
+
+def _crc8_table(poly=0x07):
+    """Helper function that computes the lookup table of the CRC-8 with the
+    given polynomial.
+
+    Returns:
+        bytes: the CRC of each byte
+    """
+    table = bytearray(256)
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly if crc & 0x80 else crc << 1) & 0xFF
+        table[i] = crc
+    return bytes(table)
+
+
+CRC8_TABLE = _crc8_table()
+
+
+def crc8(data):
+    """Computes the CRC-8(polynomial 0x07, initial value 0) of `data`, the
+    same computed by the firmware.
+
+    Args:
+        data (bytes-like): the bytes to check
+
+    Returns:
+        int: the CRC
+    """
+    crc = 0
+    for b in data:
+        crc = CRC8_TABLE[crc ^ b]
+    return crc
+
+
+class FrameEncoder:
+    """Encoder of the v2 frames on a buffer allocated once. A frame is
+    built with `begin`, `add` and `finish` and it's valid until the next
+    `begin`.
+
+    Example:
+        $ encoder = FrameEncoder()
+        $ encoder.begin(seq=7)
+        $ encoder.add(b'X\xc8')
+        $ encoder.add(b'f')
+        $ serial.write(encoder.finish())
+    """
+
+    def __init__(self, size=MAX_FRAME):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._len = 0
+
+    def begin(self, seq):
+        """Starts a new frame.
+
+        Args:
+            seq (int): sequence number of the frame, between 0 and 255
+        """
+        self._buf[0] = STX
+        self._buf[2] = seq
+        self._len = 3
+
+    def add(self, msg):
+        """Appends a command to the frame.
+
+        Args:
+            msg (bytes): the command as in v1
+
+        Raises:
+            FrameError: if the frame would be too long
+        """
+        end = self._len + len(msg)
+        if end + 1 > len(self._buf):
+            raise FrameError('Frame too long')
+        self._buf[self._len:end] = msg
+        self._len = end
+
+    def finish(self):
+        """Completes the frame with its length and CRC.
+
+        Returns:
+            memoryview: the frame
+        """
+        buf = self._buf
+        buf[1] = self._len - 2
+        buf[self._len] = crc8(self._view[1:self._len])
+        self._len += 1
+        return self._view[:self._len]
+
+
+class FrameDecoder:
+    """Decoder of the v2 response frames on a buffer allocated once. The
+    views it returns are valid until the next `decode`.
+    """
+
+    def __init__(self, readinto, size=MAX_FRAME):
+        """Creates a new decoder.
+
+        Args:
+            readinto (callable): function that reads into a writable buffer
+                and returns the number of bytes read, e.g. `Serial.readinto`
+            size (int, optional): maximum length of a frame
+        """
+        self._readinto = readinto
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+
+    def _fill(self, start, end):
+        """Helper function that reads the bytes of the frame between `start`
+        and `end`.
+
+        Returns:
+            bool: False if they don't arrive within `FRAME_TIMEOUT`
+        """
+        deadline = time.monotonic() + FRAME_TIMEOUT
+        while start < end:
+            start += self._readinto(self._view[start:end]) or 0
+            if start < end and time.monotonic() > deadline:
+                return False
+        return True
+
+    def decode(self):
+        """Reads the rest of a frame whose STX has already been read.
+
+        Returns:
+            (int, memoryview, memoryview): the sequence number, the ack of
+                each command and the whole frame
+
+        Raises:
+            FrameError: if the frame is truncated or corrupted
+        """
+        view = self._view
+        view[0] = STX
+        if not self._fill(1, 2):
+            raise FrameError('Truncated frame')
+        end = view[1] + 3
+        if view[1] < 1 or end > len(view):
+            raise FrameError('Invalid frame length {}'.format(view[1]))
+        if not self._fill(2, end):
+            raise FrameError('Truncated frame')
+        if crc8(view[1:end - 1]) != view[end - 1]:
+            raise FrameError('Corrupted frame')
+        return view[2], view[3:end - 1], view[:end]
+
+
+SERIAL_RTT = REGISTRY.histogram(
+    'xm_serial_rtt_seconds',
+    'Time from the write of a command to its response, by command byte',
+    ('command', ))
+RESPONSES = REGISTRY.counter(
+    'xm_serial_responses',
+    'Responses of arduino by command byte and kind(ack, nack, unsupported, '
+    'lost, corrupted or timeout)',
+    ('command', 'response'))
+CORRUPTED_FRAMES = REGISTRY.counter(
+    'xm_serial_corrupted_frames',
+    'Frames of the v2 protocol received truncated or corrupted')
+
+
+class _Command:
+    """A command that has been written on the serial and is waiting
+    for its ack.
+
+    Attributes:
+        future(Future): future resolved by the reader with the ack
+        expected(bytes): ack the arduino should answer with
+        nack(bytes): NACK the arduino answers with if it rejects it
+        actionstr(str): name of the action we are performing
+        command(str): the command byte, used to label the metrics
+        sent(float): `time.perf_counter` when the command has been written
+        seq(int): sequence number of the command in the flight recorder
+        msg(bytes): the command
+        frame(int): sequence number of the v2 frame carrying the command,
+            None if it's been sent as in v1
+        duration(float): seconds arduino takes to execute the command
+        deadline(float): `time.perf_counter` after which the ack is late
+    """
+
+    __slots__ = ('future', 'expected', 'nack', 'actionstr', 'command', 'sent',
+                 'seq', 'msg', 'frame', 'duration', 'deadline')
+
+    def __init__(self, msg, expected, actionstr):
+        self.future = Future()
+        self.msg = msg
+        self.expected = expected
+        self.nack = create_nack(msg)
+        self.actionstr = actionstr
+        self.command = msg[:1].decode(errors='replace')
+        self.sent = None
+        self.seq = None
+        self.frame = None
+        self.duration = 0
+        self.deadline = None
+
+
 class Legs:
     """This class manages the communication with Arduino.
     It provides a bunch of simple to use functions, which
     are safe.
 
+    The communication is pipelined: commands are written as soon as
+    they are sent and a dedicated reader thread matches the incoming
+    acks with a FIFO of in-flight commands. Up to `window` commands can
+    be on the wire at the same time and each one is represented by a
+    `Future` that is resolved when its ack arrives.
+    With the v2 protocol each batch is written in a frame and its response
+    is matched by sequence number, while single commands, e.g. `stop` that
+    must cut short a synchronous movement, are written as in v1.
+    A command whose ack doesn't arrive within `ack_timeout` seconds after
+    it should have been executed fails, so that a lost ack never blocks
+    its caller or the window.
+    The round-trip time and the kind of each response are recorded in
+    `SERIAL_RTT` and `RESPONSES`, while every byte written and read and
+    the outcome of each command are kept by the flight recorder.
+
     Attributes:
         serial(Serial): serial port to use for the communication
+        recorder(FlightRecorder): the flight recorder of the link
+        movetime(int): the last move time acknowledged by arduino, by
+            default it's the one of the firmware(1000 ms).
+        speed(int): the last speed acknowledged by arduino, by default
+            it's the one of the firmware(255).
+        protocol(int): highest version of the protocol to negotiate
+        version(int): version of the protocol negotiated with arduino
+        baudrates(tuple of int): speeds to try when connecting
+        baudrate(int): speed of the link
+        probes(list of dict): the stats of each speed tried, see `_ping`
+        ack_timeout(float): seconds to wait for an ack
+        timeouts(int): number of acks that haven't arrived in time
     """
 
-    def __init__(self, port):
+    # methods that send a command, see `batch`
+    COMMANDS = frozenset(('forward', 'backward', 'left', 'right', 'stop',
+                          'drive', 'set_speed', 'set_movetime'))
+
+    def __init__(self, port, window=DEFAULT_WINDOW, record_size=DEFAULT_SIZE,
+                 connect=True, protocol=PROTOCOL_VERSION,
+                 baudrates=BAUDRATES, ack_timeout=ACK_TIMEOUT):
         """Creates a new Legs instance.
 
         Args:
             port(str or int): identifier of the port to use either
                 '/dev/ttyACM0' or 0.
+            window(int, optional): maximum number of commands waiting for
+                their ack at the same time.
+            record_size(int, optional): number of events kept by the flight
+                recorder.
+            connect(bool, optional): if False the serial port isn't opened
+                until `connect` is called.
+            protocol(int, optional): highest version of the protocol to
+                negotiate, 1 to never use frames.
+            baudrates(iterable of int, optional): speeds of the link to try
+                when connecting, the fastest one that works is used. Empty
+                to stay at 9600.
+            ack_timeout(float, optional): seconds to wait for an ack on top
+                of the duration of the command.
+        """
+        self.serial = Serial(baudrate=BASE_BAUDRATE, timeout=READ_TIMEOUT)
+        self.serial.port = port
+        self.movetime = DEFAULT_MOVETIME
+        self.speed = DEFAULT_SPEED
+        self.recorder = FlightRecorder(record_size)
+        self.protocol = protocol
+        self.version = 1
+        self.baudrates = tuple(baudrates)
+        self.baudrate = BASE_BAUDRATE
+        self.probes = []
+        self.ack_timeout = ack_timeout
+        self.timeouts = 0
+        self._next_movetime = DEFAULT_MOVETIME
+        # the ack and the NACK of the v1 commands that timed out, to drop
+        # them if they arrive late
+        self._expired = deque(maxlen=window)
+        self._seq = 0
+        self._frame_seq = 0
+        self._encoder = FrameEncoder()
+        self._decoder = FrameDecoder(self.serial.readinto)
+        self._cork = None
+        self._cork_owner = None
+        self._inflight = deque()
+        self._inflight_lock = threading.Lock()
+        self._window_size = window
+        self._window = threading.BoundedSemaphore(window)
+        self._window_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._reader = None
+        if connect:
+            self.connect()
+
+    def connect(self):
+        """Opens the serial port, negotiates the version of the protocol
+        and the speed of the link and starts reading the acks. If the port
+        is already open no action will be performed.
+
+        Raises:
+            SerialException: if the port can't be opened
+            LegsException: if arduino can't be brought back to a known
+                state after the speed of the link has been probed
+        """
+        with self._inflight_lock:
+            if self._reader is not None:
+                return
+            self.serial.baudrate = BASE_BAUDRATE
+            self.serial.open()
+            try:
+                version = self._negotiate()
+                found = version is None and self._find_arduino()
+                if found:
+                    version = self._negotiate()
+                self.version = version or 1
+                self._negotiate_baudrate()
+                if self.probes or found:
+                    self._restore()
+            except (SerialException, OSError, LegsException):
+                self.serial.close()
+                raise
+            self._reader = threading.Thread(target=self._read_acks,
+                                            daemon=True)
+            self._reader.start()
+
+    def _negotiate(self):
+        """Helper function that asks arduino the highest version of the
+        protocol it speaks. Firmwares that don't know the request answer
+        that it's unsupported, in that case v1 is used.
+
+        Returns:
+            int: the version to use or None if nobody answers
         """
-        self.serial = Serial(port)
+        if self.protocol < 2:
+            return 1
+        msg = ArduinoMessages.Version.value
+        ack = create_ack(msg)
+        for _ in range(NEGOTIATE_TRIES):
+            self.recorder.record('tx', msg, None, 'negotiate version')
+            self.serial.write(msg)
+            deadline = time.monotonic() + NEGOTIATE_TIMEOUT
+            while time.monotonic() < deadline:
+                r = self.serial.read()
+                if not r:
+                    continue
+                self.recorder.record('rx', r)
+                if r == ArduinoMessages.Unsupported.value:
+                    return 1
+                if r == ack:
+                    v = self.serial.read()
+                    self.recorder.record('rx', v)
+                    if v:
+                        return max(1, min(v[0], self.protocol))
+        return None
 
-    def _read_expected(self, expected, actionstr=''):
-        """Helper function that reads from the serial
-        and compares the result with `expected` raising
-        `LegsException` if aren't equal. Now the messages
-        returns only a messages however in the future this may
-        change so just prevent future errors.
+    def _exchange(self, msg, size, timeout, actionstr):
+        """Helper function that writes a request and reads its answer. It
+        can be used only before the reader thread is started.
 
         Args:
-            expected(iterables of bytes): expected result
-            actionstr(str): name of the action we are performing
+            msg(bytes): the request
+            size(int): length of the answer
+            timeout(float): seconds to wait for the answer
+            actionstr(str): action description
+
+        Returns:
+            bytes: the answer, shorter than `size` if it didn't arrive in
+                time
+        """
+        self.recorder.record('tx', msg, None, actionstr)
+        self.serial.write(msg)
+        answer = b''
+        deadline = time.monotonic() + timeout
+        while len(answer) < size and time.monotonic() < deadline:
+            answer += self.serial.read(size - len(answer))
+        if answer:
+            self.recorder.record('rx', answer)
+        return answer
+
+    def _ping(self, count, max_errors=None):
+        """Helper function that measures the link at the current speed with
+        a burst of pings.
+
+        Args:
+            count(int): number of pings
+            max_errors(int, optional): errors after which it gives up
+
+        Returns:
+            dict: the `baudrate`, the number of `pings` and of `errors`, the
+                `error_rate` and the median and maximum round-trip time in
+                ms(`rtt_ms`, `max_rtt_ms`), None if no ping succeeded
+        """
+        ack = create_ack(ArduinoMessages.Ping.value)
+        rtts = []
+        errors = 0
+        for i in range(count):
+            if max_errors is not None and errors > max_errors:
+                count = i
+                break
+            payload = uint8_to_byte((0x55 + i * 73) & 0xFF)
+            start = time.perf_counter()
+            answer = self._exchange(ArduinoMessages.Ping.value + payload, 2,
+                                    PING_TIMEOUT, 'ping')
+            if answer == ack + payload:
+                rtts.append(time.perf_counter() - start)
+            else:
+                errors += 1
+                self.serial.reset_input_buffer()
+        rtts.sort()
+        return {
+            'baudrate': self.serial.baudrate,
+            'pings': count,
+            'errors': errors,
+            'error_rate': errors / count,
+            'rtt_ms': round(rtts[len(rtts) // 2] * 1000, 3) if rtts else None,
+            'max_rtt_ms': round(rtts[-1] * 1000, 3) if rtts else None,
+        }
+
+    def _set_baudrate(self, baudrate):
+        """Helper function that asks arduino to switch to `baudrate`, or to
+        confirm it if it's the speed on trial.
+
+        Returns:
+            bool: True if arduino acknowledged it
+        """
+        msg = (ArduinoMessages.Set_Baudrate.value +
+               uint8_to_byte(BAUDRATES.index(baudrate)))
+        answer = self._exchange(msg, 1, NEGOTIATE_TIMEOUT, 'set baudrate')
+        return answer == create_ack(ArduinoMessages.Set_Baudrate.value)
+
+    def _back_to_base(self, baudrate):
+        """Helper function that waits for arduino to give up `baudrate` at
+        the end of its trial. If it doesn't answer at 9600 then it has
+        kept `baudrate`, e.g. because only the ack of the confirmation
+        has been lost.
+
+        Returns:
+            bool: True if the link is at 9600 again
+        """
+        self.serial.baudrate = BASE_BAUDRATE
+        time.sleep(TRIAL_TIMEOUT)
+        # a corrupted byte may have started a synchronous movement
+        deadline = time.monotonic() + TRIAL_TIMEOUT + DEFAULT_MOVETIME / 1000
+        while time.monotonic() < deadline:
+            self.serial.reset_input_buffer()
+            if not self._ping(1)['errors']:
+                return True
+        self.serial.baudrate = baudrate
+        self.serial.reset_input_buffer()
+        if not self._ping(1)['errors']:
+            self.baudrate = baudrate
+        else:
+            self.serial.baudrate = BASE_BAUDRATE
+        return False
+
+    def _find_arduino(self):
+        """Helper function that looks for arduino at the other speeds it
+        can switch to, when it doesn't answer at 9600: it keeps a confirmed
+        speed until it's reset, e.g. if only the host process restarted.
+        Once found it's switched back to 9600, so that the speed of the link
+        is negotiated again from there.
+
+        Returns:
+            bool: True if arduino has been found and it's at 9600 again
+        """
+        for baudrate in sorted(BAUDRATES, reverse=True):
+            if baudrate == BASE_BAUDRATE:
+                continue
+            self.serial.baudrate = baudrate
+            self.serial.reset_input_buffer()
+            # the garbage sent so far may take the first pings as arguments
+            probe = self._ping(NEGOTIATE_TRIES)
+            if probe['errors'] == probe['pings']:
+                continue
+            switched = self._set_baudrate(BASE_BAUDRATE)
+            self.serial.baudrate = BASE_BAUDRATE
+            return switched and self._set_baudrate(BASE_BAUDRATE)
+        self.serial.baudrate = BASE_BAUDRATE
+        return False
+
+    def _negotiate_baudrate(self):
+        """Helper function that switches the link to the fastest candidate
+        speed whose error rate is at most `MAX_ERROR_RATE`, measuring each
+        one with `_ping`. The link stays at 9600 if no candidate works or
+        arduino speaks a version older than v3.
+        """
+        self.baudrate = BASE_BAUDRATE
+        self.probes = []
+        candidates = sorted((b for b in self.baudrates
+                             if b in BAUDRATES and b != BASE_BAUDRATE),
+                            reverse=True)
+        if self.version < 3 or not candidates:
+            return
+        self.probes.append(self._ping(PROBE_PINGS))
+        for baudrate in candidates:
+            if not self._set_baudrate(baudrate):
+                return  # not even 9600 works
+            self.serial.baudrate = baudrate
+            probe = self._ping(PROBE_PINGS,
+                               int(PROBE_PINGS * MAX_ERROR_RATE))
+            self.probes.append(probe)
+            if (probe['error_rate'] <= MAX_ERROR_RATE and
+                    self._set_baudrate(baudrate)):
+                self.baudrate = baudrate
+                return
+            if not self._back_to_base(baudrate):
+                return
+
+    def _restore(self):
+        """Helper function that undoes what the corrupted pings may have
+        done, since arduino executes them as commands: the motors are
+        stopped, cutting short a synchronous movement, and the speed and the
+        move time known by `Legs` are sent again.
 
         Raises:
-            LegsException: if the what we have read isn't equal
-                to the expected
+            LegsException: if arduino doesn't acknowledge them
         """
-        assert_bytes(expected)
+        commands = (
+            (ArduinoMessages.Stop.value.lower(), 'stop'),
+            (ArduinoMessages.Set_Speed.value + uint8_to_byte(self.speed),
+             'set speed'),
+            (ArduinoMessages.Set_MoveTime.value +
+             uint16_to_bytes(self.movetime), 'set move time'),
+        )
+        for msg, actionstr in commands:
+            ack = create_ack(msg)
+            for _ in range(NEGOTIATE_TRIES):
+                self.serial.reset_input_buffer()
+                answer = self._exchange(msg, 1, NEGOTIATE_TIMEOUT, actionstr)
+                if answer and answer != ack:
+                    # the ack of the movement cut short, then the stop's
+                    answer = self.serial.read()
+                    if answer:
+                        self.recorder.record('rx', answer)
+                if answer == ack:
+                    break
+            else:
+                raise LegsException('Unable to {} after probing the '
+                                    'link'.format(actionstr))
 
-        r = b''
-        for _ in range(len(expected)):
-            r = r + self.serial.read()
-        if r != expected:
-            raise LegsException(
+    def _read_acks(self):
+        """Function the reader thread uses to match the incoming acks
+        with the in-flight commands. When the link is lost every pending
+        command fails with `LegsException`.
+        """
+        while not self._closed.is_set():
+            if self._inflight:
+                self._expire()
+            try:
+                r = self.serial.read()
+                if not r:
+                    continue
+                if r[0] == STX and self.version >= 2:
+                    self._read_frame()
+                else:
+                    self.recorder.record('rx', r)
+                    self._match_ack(r)
+            except (SerialException, OSError, TypeError) as exc:
+                self._fail_inflight(
+                    LegsException('Serial link lost: {}'.format(exc)))
+                return
+        self._fail_inflight(LegsException('Legs have been closed'))
+
+    def _read_frame(self):
+        """Helper function that reads a response frame and resolves the
+        commands it carries. A truncated or corrupted frame is dropped:
+        its commands are found lost as soon as a newer response arrives.
+        """
+        try:
+            seq, acks, raw = self._decoder.decode()
+        except FrameError as exc:
+            CORRUPTED_FRAMES.labels().inc()
+            self.recorder.record('rx', bytes([STX]), None, str(exc))
+            return
+        self.recorder.record('rx', bytes(raw))
+        with self._inflight_lock:
+            idx = next((i for i, c in enumerate(self._inflight)
+                        if c.frame == seq), None)
+            if idx is None:
+                return  # nobody is waiting for it, just drop it
+            lost = [self._inflight.popleft() for _ in range(idx)]
+            cmds = []
+            while self._inflight and self._inflight[0].frame == seq:
+                cmds.append(self._inflight.popleft())
+
+        now = time.perf_counter()
+        for c in lost:
+            self._lost(c)
+        for i, c in enumerate(cmds):
+            # a frame rejected by arduino has no acks
+            self._complete(c, bytes(acks[i:i + 1]) or None, now - c.sent)
+
+    def _match_ack(self, r):
+        """Helper function that resolves the in-flight command `r` is the
+        ack of. Now the messages returns only a byte however in the
+        future this may change so just prevent future errors.
+        `r` may be the ack or the NACK of a command: the NACK of a command
+        is the command byte itself, so it can't be mistaken for an ack.
+        If `r` answers a command that isn't the oldest one, then the
+        answers of the older commands have been lost and they fail.
+        `Unsupported` doesn't tell the command, so it's taken as the answer
+        of the oldest command sent outside a frame, like any other byte
+        that doesn't match a command.
+
+        Args:
+            r(bytes): first byte of the received ack
+        """
+        with self._inflight_lock:
+            if not self._inflight:
+                return  # nobody is waiting for it, just drop it
+            idx = next((i for i, c in enumerate(self._inflight)
+                        if c.frame is None and r in (c.expected[:1], c.nack)),
+                       None)
+            if idx is None:
+                late = next((e for e in self._expired if r in e), None)
+                if late is not None:
+                    self._expired.remove(late)
+                    return  # the late answer of a command that timed out
+                idx = next((i for i, c in enumerate(self._inflight)
+                            if c.frame is None), 0)
+            lost = [self._inflight.popleft() for _ in range(idx)]
+            cmd = self._inflight.popleft()
+
+        # only the ack is followed by the rest of the answer
+        extra = len(cmd.expected) - 1 if r == cmd.expected[:1] else 0
+        for _ in range(extra):
+            b = self.serial.read()
+            self.recorder.record('rx', b)
+            r = r + b
+        rtt = time.perf_counter() - cmd.sent
+        for c in lost:
+            self._lost(c)
+        self._complete(cmd, r, rtt)
+
+    def _expire(self):
+        """Helper function that fails the in-flight commands whose ack is
+        late. Deadlines never decrease along the FIFO, so only the oldest
+        commands have to be checked.
+        """
+        now = time.perf_counter()
+        expired = []
+        with self._inflight_lock:
+            while self._inflight and self._inflight[0].deadline < now:
+                cmd = self._inflight.popleft()
+                if cmd.frame is None:
+                    self._expired.append((cmd.expected[:1], cmd.nack))
+                expired.append(cmd)
+        for cmd in expired:
+            self.timeouts += 1
+            self._window.release()
+            RESPONSES.labels(cmd.command, 'timeout').inc()
+            self.recorder.record('done', b'', cmd.seq, 'timeout')
+            cmd.future.set_exception(LegsException(
+                'Unable to {actionstr} due to error: ack timeout'.format(
+                    actionstr=cmd.actionstr)))
+
+    def _lost(self, cmd):
+        """Helper function that fails a command whose ack has been lost.
+
+        Args:
+            cmd(_Command): the command
+        """
+        self._window.release()
+        RESPONSES.labels(cmd.command, 'lost').inc()
+        self.recorder.record('done', b'', cmd.seq, 'lost')
+        cmd.future.set_exception(LegsException(
+            'Unable to {actionstr} due to error: ack lost'.format(
+                actionstr=cmd.actionstr)))
+
+    def _complete(self, cmd, r, rtt):
+        """Helper function that resolves a command with its ack.
+
+        Args:
+            cmd(_Command): the command
+            r(bytes): the ack or None if the frame of the command has been
+                rejected by arduino because it was corrupted
+            rtt(float): round-trip time in seconds
+        """
+        self._window.release()
+        SERIAL_RTT.labels(cmd.command).observe(rtt)
+        if r == cmd.expected:
+            response = 'ack'
+        elif r is None:
+            response = 'corrupted'
+        elif r == ArduinoMessages.Unsupported.value:
+            response = 'unsupported'
+        else:
+            response = 'nack'
+        RESPONSES.labels(cmd.command, response).inc()
+        self.recorder.record('done', b'', cmd.seq, response)
+        if r != cmd.expected:
+            cmd.future.set_exception(LegsException(
                 'Unable to {actionstr} due to error: {errcode}'.format(
-                    actionstr=actionstr,
-                    errcode=str(r)))
+                    actionstr=cmd.actionstr,
+                    errcode='corrupted frame' if r is None else str(r))))
+        else:
+            cmd.future.set_result(r)
+
+    def _fail_inflight(self, exc):
+        """Helper function that fails every in-flight command with `exc`.
+
+        Args:
+            exc(LegsException): exception to set on the pending futures
+        """
+        with self._inflight_lock:
+            pending = list(self._inflight)
+            self._inflight.clear()
+        for c in pending:
+            self._window.release()
+            self.recorder.record('done', b'', c.seq, 'failed')
+            c.future.set_exception(exc)
+
+    def _send(self, msg, actionstr, ack):
+        """Helper function that writes `msg` and puts it in the in-flight
+        FIFO. It blocks while the window is full. Inside `batch` the
+        command is kept until the whole batch is written.
+
+        Args:
+            msg(bytes): message to send
+            actionstr(str): action description
+            ack(bytes): expected ack
+
+        Returns:
+            Future: future resolved with the ack
+
+        Raises:
+            LegsException: if the legs have been closed or they aren't
+                connected
+        """
+        if self._closed.is_set():
+            raise LegsException(
+                'Unable to {} because legs have been closed'.format(actionstr))
+        if self._reader is None:
+            raise LegsException(
+                'Unable to {} because legs are not connected'.format(
+                    actionstr))
+        cmd = _Command(msg, ack, actionstr)
+        if msg[:1] in SYNC_MOVES:
+            cmd.duration = max(self.movetime, self._next_movetime) / 1000
+        if (self._cork is not None and
+                self._cork_owner == threading.get_ident()):
+            self._cork.append(cmd)
+        else:
+            self._write([cmd], False)  # a frame would just add latency
+        return cmd.future
 
-    def _send_n_read(self, msg, actionstr, async=False, ack=None):
+    def _write(self, cmds, framed):
+        """Helper function that writes some commands at once, in a single
+        frame if `framed`, and puts them in the in-flight FIFO.
+
+        Args:
+            cmds(list of _Command): the commands
+            framed(bool): whether to write them in a v2 frame
+
+        Raises:
+            LegsException: if the write fails or the commands don't fit a
+                frame
+        """
+        if len(cmds) == 1:
+            self._window.acquire()
+        else:
+            with self._window_lock:  # never hold a part of the window
+                for _ in cmds:
+                    self._window.acquire()
+        with self._inflight_lock:
+            try:
+                if framed:
+                    self._frame_seq = (self._frame_seq + 1) & 0xFF
+                    self._encoder.begin(self._frame_seq)
+                    for cmd in cmds:
+                        self._encoder.add(cmd.msg)
+                    data = self._encoder.finish()
+                else:
+                    data = b''.join(cmd.msg for cmd in cmds)
+            except FrameError:
+                for _ in cmds:
+                    self._window.release()
+                raise
+            sent = time.perf_counter()
+            # arduino executes the commands in order, so each ack can't
+            # arrive before the previous one
+            tail = self._inflight[-1].deadline if self._inflight else 0
+            # enqueue before writing so that the reader always finds the
+            # command its ack belongs to
+            for cmd in cmds:
+                self._inflight.append(cmd)
+                self._seq += 1
+                cmd.seq = self._seq
+                cmd.frame = self._frame_seq if framed else None
+                self.recorder.record('tx', cmd.msg, cmd.seq, cmd.actionstr)
+                cmd.sent = sent
+                tail = cmd.deadline = (max(sent + self.ack_timeout, tail) +
+                                       cmd.duration)
+            try:
+                self.serial.write(data)
+            except (SerialException, OSError) as exc:
+                for cmd in cmds:
+                    self._inflight.pop()
+                    self._window.release()
+                    self.recorder.record('done', b'', cmd.seq, 'failed')
+                raise LegsException('Unable to {actionstr} due to error: '
+                                    '{exc}'.format(actionstr=cmds[0].actionstr,
+                                                   exc=exc))
+
+    def batch(self, calls):
+        """Sends several commands with a single write, in a single frame if
+        v2 has been negotiated and there's more than one command, without
+        waiting for their acks. Arduino
+        executes them in order.
+
+        Args:
+            calls(list of (str, dict)): the name of the method of each
+                command and its keyword arguments, e.g.
+                [('set_speed', {'speed_value': 200}),
+                 ('forward', {'asynchronous': True})]
+
+        Returns:
+            list of Future: the future of the ack of each command
+
+        Raises:
+            LegsException: if a method doesn't send a command, if there are
+                more commands than the window or they don't fit a frame
+        """
+        if len(calls) > self._window_size:
+            raise LegsException('Unable to send more than {} commands in a '
+                                'batch'.format(self._window_size))
+        for name, _ in calls:
+            if name not in self.COMMANDS:
+                raise LegsException('{} is not a command'.format(name))
+        self._cork, self._cork_owner = [], threading.get_ident()
+        try:
+            for name, kwargs in calls:
+                getattr(self, name)(wait=False, **kwargs)
+            cmds = self._cork
+        finally:
+            self._cork = self._cork_owner = None
+        if cmds:
+            self._write(cmds, self.version >= 2 and len(cmds) > 1)
+        return [c.future for c in cmds]
+
+    def _send_n_read(self, msg, actionstr, asynchronous=False, ack=None,
+                     wait=True):
         """Helper function that sends the given `msg` and reads
         the `ack` or if it is None it will use `create_ack` on
         `msg` to get the expected result.
@@ -127,87 +1012,254 @@ class Legs:
         Args:
             msg(byte): message to send
             actionstr(str): action description
-            async(bool): if True the `msg` will be lowered, otherwise
+            asynchronous(bool): if True the `msg` will be lowered, otherwise
                 Nothing will be performed
             ack(byte): if None the expected byte will be created calling
                 `create_ack` on `msg` otherwise it will be used as the
                 expected value.
+            wait(bool): if True it waits for the ack, otherwise it
+                returns immediatly after the write.
+
+        Returns:
+            Future: the future of the ack if `wait` is False
+
+        Raises:
+            LegsException: if `wait` is True and the ack isn't the
+                expected one
         """
         assert_bytes(msg)
-        if async:
+        if asynchronous:
             msg = msg.lower()
-        self.serial.write(msg)
         ack = ack or create_ack(msg)
-        self._read_expected(ack, actionstr)
+        fut = self._send(msg, actionstr, ack)
+        if not wait:
+            return fut
+        fut.result()
 
-    def forward(self, async=False):
+    def close(self):
+        """Closes the serial port. Every command still waiting for its
+        ack fails with `LegsException`.
+        """
+        self._closed.set()
+        if self._reader is not None:
+            self._reader.join()
+        self.serial.close()
+
+    def forward(self, asynchronous=False, wait=True):
         """Utility function that makes the rover move forward.
 
         Args:
-            async(bool): if True it will return immediatly, otherwise
+            asynchronous(bool): if True it will return immediatly, otherwise
                 it will wait until the rover stops.
+            wait(bool): if False it returns the `Future` of the ack
+                without waiting for it.
         """
-        self._send_n_read(ArduinoMessages.Forward.value, 'move forward',
-                          async=async)
+        return self._send_n_read(ArduinoMessages.Forward.value,
+                                 'move forward',
+                                 asynchronous=asynchronous, wait=wait)
 
-    def backward(self, async=False):
+    def backward(self, asynchronous=False, wait=True):
         """Utility function that makes the rover move backward.
 
         Args:
-            async(bool): if True it will return immediatly, otherwise
+            asynchronous(bool): if True it will return immediatly, otherwise
                 it will wait until the rover stops.
+            wait(bool): if False it returns the `Future` of the ack
+                without waiting for it.
         """
-        self._send_n_read(ArduinoMessages.Backward.value, 'move backward',
-                          async=async)
+        return self._send_n_read(ArduinoMessages.Backward.value,
+                                 'move backward',
+                                 asynchronous=asynchronous, wait=wait)
 
-    def left(self, async=False):
+    def left(self, asynchronous=False, wait=True):
         """Utility function that makes the rover move left.
 
         Args:
-            async(bool): if True it will return immediatly, otherwise
+            asynchronous(bool): if True it will return immediatly, otherwise
                 it will wait until the rover stops.
+            wait(bool): if False it returns the `Future` of the ack
+                without waiting for it.
         """
-        self._send_n_read(ArduinoMessages.Left.value, 'rotate left',
-                          async=async)
+        return self._send_n_read(ArduinoMessages.Left.value,
+                                 'rotate left',
+                                 asynchronous=asynchronous, wait=wait)
 
-    def right(self, async=False):
+    def right(self, asynchronous=False, wait=True):
         """Utility function that makes the rover move right.
 
         Args:
-            async(bool): if True it will return immediatly, otherwise
+            asynchronous(bool): if True it will return immediatly, otherwise
                 it will wait until the rover stops.
+            wait(bool): if False it returns the `Future` of the ack
+                without waiting for it.
+        """
+        return self._send_n_read(ArduinoMessages.Right.value,
+                                 'rotate right',
+                                 asynchronous=asynchronous, wait=wait)
+
+    def stop(self, wait=True):
+        """Utility function that stops the rover. Out of a batch it's
+        written as in v1, so arduino sees it while it's executing a
+        synchronous movement.
+
+        Args:
+            wait(bool): if False it returns the `Future` of the ack
+                without waiting for it.
         """
-        self._send_n_read(ArduinoMessages.Right.value, 'rotate right',
-                          async=async)
+        return self._send_n_read(ArduinoMessages.Stop.value, 'stop',
+                                 asynchronous=True, wait=wait)
+
+    def drive(self, left, right, wait=True):
+        """Utility function that sets the direction and the speed of both
+        motors with a single command, e.g. once per tick of a joystick.
+        The rover keeps moving until the next movement or stop and the
+        speed set by `set_speed` doesn't apply.
 
-    def stop(self):
-        """Utility function that stops the rover.
+        Args:
+            left(int): speed of the left motor between -255 and 255,
+                negative to go backward.
+            right(int): speed of the right motor between -255 and 255.
+            wait(bool): if False it returns the `Future` of the ack
+                without waiting for it.
         """
-        self._send_n_read(ArduinoMessages.Stop.value, 'stop', async=True)
+        for speed in (left, right):
+            assert_int(speed)
+            assert_in_range(speed, -0xFF, 0xFF)
+        msg = DRIVE.pack(ArduinoMessages.Drive.value,
+                         (left < 0) | (right < 0) << 1,
+                         abs(left), abs(right))
+        return self._send_n_read(msg, 'drive',
+                                 ack=create_ack(ArduinoMessages.Drive.value),
+                                 wait=wait)
 
-    def set_speed(self, speed_value):
+    def set_speed(self, speed_value, wait=True):
         """Utility function that sets the speed of the rover.
         The value must be between 0 and 255
 
         Args:
             speed_value(int): speed value
+            wait(bool): if False it returns the `Future` of the ack
+                without waiting for it.
         """
         assert_uint8(speed_value)
-        speed_value = uint8_to_byte(speed_value)
-        self._send_n_read(ArduinoMessages.Set_Speed.value + speed_value,
-                          'set speed',
-                          ack=create_ack(ArduinoMessages.Set_Speed.value))
+        fut = self._send_n_read(
+            ArduinoMessages.Set_Speed.value + uint8_to_byte(speed_value),
+            'set speed', ack=create_ack(ArduinoMessages.Set_Speed.value),
+            wait=False)
+        fut.add_done_callback(
+            lambda f: f.exception() or setattr(self, 'speed', speed_value))
+        if not wait:
+            return fut
+        fut.result()
 
-    def set_movetime(self, time):
+    def set_movetime(self, time, wait=True):
         """Utility function that sets the time during which
         the rover will move if syncronous mode. The value must
         be between 0 and 65535.
 
         Args:
             time(int): time to wait in syncronous mode.
+            wait(bool): if False it returns the `Future` of the ack
+                without waiting for it.
         """
         assert_uint16(time)
-        time = uint16_to_bytes(time)
-        self._send_n_read(ArduinoMessages.Set_MoveTime.value + time,
-                          'set move time',
-                          ack=create_ack(ArduinoMessages.Set_MoveTime.value))
+        self._next_movetime = time
+        fut = self._send_n_read(
+            ArduinoMessages.Set_MoveTime.value + uint16_to_bytes(time),
+            'set move time',
+            ack=create_ack(ArduinoMessages.Set_MoveTime.value), wait=False)
+        fut.add_done_callback(
+            lambda f: f.exception() or setattr(self, 'movetime', time))
+        if not wait:
+            return fut
+        fut.result()
+
+    def link_status(self):
+        """Utility function that returns the state of the serial link.
+
+        Returns:
+            dict: the `version` of the protocol, the `baudrate`, the stats
+                of each speed tried when connecting(`probes`, see `_ping`),
+                the number of commands `in_flight` and of acks that haven't
+                arrived in time(`timeouts`).
+        """
+        return {
+            'version': self.version,
+            'baudrate': self.baudrate,
+            'probes': self.probes,
+            'in_flight': len(self._inflight),
+            'timeouts': self.timeouts,
+        }
+
+    def get_movetime(self):
+        """Utility function that returns the time during which the rover
+        moves in syncronous mode.
+
+        Returns:
+            int: the last move time acknowledged by arduino.
+        """
+        return self.movetime
+
+
+def bench_link(legs, commands, batch):
+    """Sends `commands` set speed commands, `batch` with each write, and
+    waits for all their acks.
+
+    Args:
+        legs(Legs): the legs to use
+        commands(int): number of commands
+        batch(int): number of commands written at once
+
+    Returns:
+        (float, int): the commands per second and the failed commands
+    """
+    futures = []
+    start = time.perf_counter()
+    for i in range(0, commands, batch):
+        calls = [('set_speed', {'speed_value': (i + j) & 0xFF})
+                 for j in range(min(batch, commands - i))]
+        if len(calls) == 1:
+            futures.append(legs.set_speed(calls[0][1]['speed_value'],
+                                          wait=False))
+        else:
+            futures.extend(legs.batch(calls))
+    errors = 0
+    for fut in futures:
+        errors += fut.exception() is not None
+    return commands / (time.perf_counter() - start), errors
+
+
+def main():
+    from emulator import ArduinoEmulator
+
+    parser = argparse.ArgumentParser(
+        description='Measures the commands per second of the v1 and v2 '
+                    'protocols of XM-Legs on the emulator')
+    parser.add_argument('--baudrate', type=int, default=9600,
+                        help='speed of the emulated link')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='latency of the emulated arduino in seconds')
+    parser.add_argument('--commands', type=int, default=1000,
+                        help='number of commands to send')
+    parser.add_argument('--batch', type=int, default=4,
+                        help='commands written at once in the batched runs')
+    args = parser.parse_args()
+
+    arduino = ArduinoEmulator(args.baudrate, args.latency)
+    arduino.start()
+    try:
+        for protocol, batch in ((1, 1), (1, args.batch), (2, args.batch)):
+            legs = Legs(arduino.port, protocol=protocol, baudrates=())
+            try:
+                rate, errors = bench_link(legs, args.commands, batch)
+            finally:
+                legs.close()
+            print('v{} {} per write at {} baud: {:8.1f} cmd/s, '
+                  '{} errors'.format(legs.version, batch, args.baudrate,
+                                     rate, errors), flush=True)
+    finally:
+        arduino.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+"""Module that collects the metrics of the rover and renders them in the
+Prometheus text format. It's a tiny subset of `prometheus_client`, enough
+to record latencies and counters on the hot path with a low overhead:
+the children of a family are created once and observing a value is just
+a bisection and a couple of additions under a lock.
+
+Attributes:
+    REGISTRY (Registry): the registry used by every part of the body.
+    LATENCY_BUCKETS (tuple of float): default upper bounds of the buckets
+        of the histograms, in seconds.
+
+Example:
+    $ RTT = REGISTRY.histogram('xm_serial_rtt_seconds', 'Round-trip time',
+                               ('command', ))
+    $ RTT.labels('f').observe(0.004)
+    $ print(REGISTRY.render())
+"""
+
+import threading
+
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_value(value):
+    """Helper function that formats a sample value.
+
+    Args:
+        value (int or float): the value
+
+    Returns:
+        str: the value as Prometheus expects it
+    """
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(names, values, extra=''):
+    """Helper function that formats a set of labels.
+
+    Args:
+        names (tuple of str): names of the labels
+        values (tuple of str): values of the labels
+        extra (str, optional): an already formatted label to append
+
+    Returns:
+        str: the labels between braces or an empty string if there are none
+    """
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', r'\\')
+                              .replace('"', r'\"').replace('\n', r'\n'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{{{}}}'.format(','.join(pairs)) if pairs else ''
+
+
+class Counter:
+    """Monotonic counter.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        """Increments the counter.
+
+        Args:
+            amount (int, optional): how much to add
+        """
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        """Returns the samples of the counter.
+
+        Args:
+            name (str): name of the family
+            labels (str): formatted labels of the counter
+
+        Returns:
+            list of str: the lines to render
+        """
+        return ['{}_total{} {}'.format(name, labels,
+                                       _format_value(self.value))]
+
+
+class Histogram:
+    """Histogram with fixed buckets.
+    """
+
+    def __init__(self, buckets):
+        """Creates an empty histogram.
+
+        Args:
+            buckets (tuple of float): sorted upper bounds of the buckets
+        """
+        self._lock = threading.Lock()
+        self._bounds = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        """Records a value.
+
+        Args:
+            value (float): the value, e.g. a latency in seconds
+        """
+        i = bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def samples(self, name, names, values):
+        """Returns the samples of the histogram, with cumulative buckets.
+
+        Args:
+            name (str): name of the family
+            names (tuple of str): names of the labels
+            values (tuple of str): values of the labels
+
+        Returns:
+            list of str: the lines to render
+        """
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        lines = []
+        acc = 0
+        for bound, count in zip(self._bounds + (float('inf'), ), counts):
+            acc += count
+            le = 'le="{}"'.format(_format_value(float(bound)))
+            lines.append('{}_bucket{} {:d}'.format(
+                name, _format_labels(names, values, le), acc))
+        labels = _format_labels(names, values)
+        lines.append('{}_sum{} {}'.format(name, labels, repr(total)))
+        lines.append('{}_count{} {:d}'.format(name, labels, acc))
+        return lines
+
+
+class Family:
+    """A metric with a set of labels, each combination of label values is
+    a child metric.
+
+    Attributes:
+        name (str): name of the metric
+        doc (str): help of the metric
+        kind (str): 'counter' or 'histogram'
+        labelnames (tuple of str): names of the labels
+    """
+
+    def __init__(self, name, doc, kind, labelnames, factory):
+        """Creates a new family without children.
+
+        Args:
+            name (str): name of the metric
+            doc (str): help of the metric
+            kind (str): 'counter' or 'histogram'
+            labelnames (tuple of str): names of the labels
+            factory (callable): function that creates a child
+        """
+        self.name = name
+        self.doc = doc
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self._factory = factory
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """Returns the child with the given label values, creating it if
+        needed. Children should be kept by the callers on the hot path.
+
+        Args:
+            values (str): values of the labels, in the order of `labelnames`
+
+        Returns:
+            Counter or Histogram: the child
+        """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('{} expects the labels {}'.format(
+                    self.name, ', '.join(self.labelnames)))
+            with self._lock:
+                child = self._children.setdefault(values, self._factory())
+        return child
+
+    def render(self):
+        """Renders the family.
+
+        Returns:
+            list of str: the lines of the family
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.doc),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for values, child in sorted(self._children.copy().items()):
+            if self.kind == 'histogram':
+                lines += child.samples(self.name, self.labelnames, values)
+            else:
+                lines += child.samples(
+                    self.name, _format_labels(self.labelnames, values))
+        return lines
+
+
+class Gauge:
+    """Gauge whose value is read from a callback when the metrics are
+    rendered, so that it costs nothing on the hot path.
+
+    Attributes:
+        name (str): name of the metric
+        doc (str): help of the metric
+        callback (callable): function that returns the current value
+    """
+
+    def __init__(self, name, doc, callback):
+        self.name = name
+        self.doc = doc
+        self.callback = callback
+
+    def render(self):
+        """Renders the gauge.
+
+        Returns:
+            list of str: the lines of the gauge
+        """
+        return ['# HELP {} {}'.format(self.name, self.doc),
+                '# TYPE {} gauge'.format(self.name),
+                '{} {}'.format(self.name, _format_value(self.callback()))]
+
+
+class Registry:
+    """Collection of metrics. Registering a metric with a name that already
+    exists returns the existing one, so modules can be reloaded and parts
+    recreated.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        """Helper function that registers `metric` unless a metric with the
+        same name already exists.
+
+        Returns:
+            the registered metric
+        """
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, doc, labelnames=()):
+        """Registers a family of counters. The samples are named
+        '<name>_total'.
+
+        Args:
+            name (str): name of the metric
+            doc (str): help of the metric
+            labelnames (tuple of str, optional): names of the labels
+
+        Returns:
+            Family: the family
+        """
+        return self._register(Family(name, doc, 'counter', labelnames,
+                                     Counter))
+
+    def histogram(self, name, doc, labelnames=(), buckets=LATENCY_BUCKETS):
+        """Registers a family of histograms.
+
+        Args:
+            name (str): name of the metric
+            doc (str): help of the metric
+            labelnames (tuple of str, optional): names of the labels
+            buckets (tuple of float, optional): sorted upper bounds of the
+                buckets, by default `LATENCY_BUCKETS`
+
+        Returns:
+            Family: the family
+        """
+        buckets = tuple(buckets)
+        return self._register(Family(name, doc, 'histogram', labelnames,
+                                     lambda: Histogram(buckets)))
+
+    def gauge(self, name, doc, callback):
+        """Registers a gauge. A gauge registered again with the same name
+        gets the new callback.
+
+        Args:
+            name (str): name of the metric
+            doc (str): help of the metric
+            callback (callable): function that returns the current value
+
+        Returns:
+            Gauge: the gauge
+        """
+        gauge = self._register(Gauge(name, doc, callback))
+        gauge.callback = callback
+        return gauge
+
+    def render(self):
+        """Renders every metric in the Prometheus text format.
+
+        Returns:
+            str: the metrics
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        lines = []
+        for _, metric in metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
@@ -2,31 +2,323 @@
 the rover will use to make some noise.
 By default it uses as backend `espeak` but it should
 be easy to switch to `festival` or similar.
+
+Sentences can be rendered to WAV once and kept in a `SpeechCache`, so
+that the sentences said again and again are just played by `aplay`
+instead of being synthesized every time. The other sentences can be given
+to a long-lived `Synthesizer`, so that they don't pay for starting the
+backend and loading the voice.
+
+Long texts are split into sentences and clauses that are said one at a
+time, so that the first one starts sooner and a `shutup` or a sentence
+with higher priority can cut in between them.
+
+The texts waiting to be said are kept in a bounded `SpeechQueue` that
+merges the identical ones, so that a client spamming the mouth can't
+grow its memory nor bury the urgent texts.
 """
 
-from queue import Queue
+from collections import OrderedDict
+from itertools import count
 
+import os
+import re
+import time
+import json
+import fcntl
+import struct
+import hashlib
+import termios
 import threading
 import subprocess
 
+from metrics import REGISTRY
 from util import XMException
 
+DEFAULT_CACHE_SIZE = 50 * 2 ** 20
+
+# number of missed sentences remembered by the cache
+MAX_SEEN = 256
+
+# longest chunk of a text said at once
+MAX_CHUNK = 150
+
+# maximum number of texts waiting to be said
+DEFAULT_QUEUE_SIZE = 16
+
+OVERFLOW_POLICIES = ('reject', 'drop_oldest', 'drop_lowest')
+
+SENTENCE_END = re.compile(r'(?<=[.!?;:])\s+')
+CLAUSE_END = re.compile(r'(?<=,)\s+')
+
+# program used to play the cached sentences
+PLAYER = ['aplay', '-q']
+
+CACHE_LOOKUPS = REGISTRY.counter('xm_speech_cache_lookups',
+                                 'Lookups of the speech cache by result',
+                                 ('result', ))
+CACHE_EVICTIONS = REGISTRY.counter('xm_speech_cache_evictions',
+                                   'Sentences evicted from the speech cache')
+SPEECH_DROPPED = REGISTRY.counter(
+    'xm_speech_dropped',
+    'Texts dropped or rejected because the speech queue was full')
+SPEECH_MERGED = REGISTRY.counter(
+    'xm_speech_merged',
+    'Texts merged with an identical one waiting to be said')
+SYNTH_RESTARTS = REGISTRY.counter('xm_speech_synth_restarts',
+                                  'Restarts of the synthesizer after a crash')
+
+# seconds between the checks of the pipes of the synthesizer
+SYNTH_POLL = 0.02
+
+# embedded commands of espeak that set amplitude and speed inline
+EMBEDDED = '\x01{amplitude:d}A\x01{wpm:d}S{text}\n'
+
 
 class UnableToSay(XMException):
     """Exception raised if you want to add a new sentence
-    to the mouth queue that has been shut down.
+    to the mouth queue that is full.
     """
     pass
 
 
+def split_text(text, max_len=MAX_CHUNK):
+    """Splits a text into the chunks to say one at a time: the sentences,
+    then the clauses of the sentences longer than `max_len` and then the
+    words of the clauses still too long.
+
+    Args:
+        text (str): text to split
+        max_len (int, optional): maximum length of a chunk
+
+    Returns:
+        list of str: the chunks
+    """
+    chunks = []
+    for sentence in SENTENCE_END.split(text.strip()):
+        parts = [sentence]
+        if len(sentence) > max_len:
+            parts = CLAUSE_END.split(sentence)
+        for part in parts:
+            while len(part) > max_len:
+                cut = part.rfind(' ', 0, max_len + 1)
+                if cut <= 0:
+                    cut = max_len
+                chunks.append(part[:cut])
+                part = part[cut:].lstrip()
+            if part:
+                chunks.append(part)
+    return chunks
+
+
+class Speech:
+    """A text waiting to be said, split into chunks.
+
+    Attributes:
+        priority (int): texts with higher priority are said first
+        seq (int): order of arrival, to say first the oldest texts with
+            the same priority
+        key (str): identifies identical texts, see `Sentence.key`
+        chunks (list of Sentence): the chunks still to say
+        cancelled (bool): whether the rest of the text must be skipped
+    """
+
+    __slots__ = ('priority', 'seq', 'key', 'chunks', 'cancelled')
+
+    def __init__(self, priority, seq, key, chunks):
+        self.priority = priority
+        self.seq = seq
+        self.key = key
+        self.chunks = chunks
+        self.cancelled = False
+
+    def order(self):
+        """Returns the key to sort the texts, the first to say first.
+        """
+        return (-self.priority, self.seq)
+
+
+class SpeechQueue:
+    """Bounded priority queue of the texts to say. A text identical to one
+    still waiting is merged with it, raising its priority if needed. When
+    the queue is full the overflow policy decides:
+        'reject': the new text is rejected;
+        'drop_oldest': the oldest text is dropped;
+        'drop_lowest': the oldest text with the lowest priority is dropped,
+            unless its priority is higher than the new one that is rejected.
+    The text being said isn't counted and, after each chunk, its rest goes
+    back to the queue with its original order.
+
+    Attributes:
+        max_size (int): maximum number of texts waiting
+        overflow (str): the overflow policy
+        dropped (int): number of texts dropped or rejected
+        merged (int): number of texts merged
+        current (Speech): the text being said
+    """
+
+    def __init__(self, max_size=DEFAULT_QUEUE_SIZE, overflow='drop_lowest'):
+        """Creates an empty queue.
+
+        Args:
+            max_size (int, optional): maximum number of texts waiting
+            overflow (str, optional): the overflow policy, one of
+                `OVERFLOW_POLICIES`
+
+        Raises:
+            ValueError: if the policy doesn't exist
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('{} must be one of {}'.format(
+                overflow, ', '.join(OVERFLOW_POLICIES)))
+        self.max_size = max_size
+        self.overflow = overflow
+        self.dropped = 0
+        self.merged = 0
+        self.current = None
+        self._items = []
+        self._seq = count(1)
+        self._wakeups = 0
+        self._cond = threading.Condition()
+
+    def _drop(self):
+        """Helper function that counts a dropped text. It must be called
+        while holding the condition.
+        """
+        self.dropped += 1
+        SPEECH_DROPPED.labels().inc()
+
+    def put(self, chunks, priority=0, key=None):
+        """Adds a text to the queue.
+
+        Args:
+            chunks (list of Sentence): the chunks of the text
+            priority (int, optional): priority of the text
+            key (str, optional): key to merge identical texts
+
+        Returns:
+            bool: False if the text has been rejected
+        """
+        with self._cond:
+            same = next((i for i in self._items
+                         if key is not None and i.key == key), None)
+            if same:
+                same.priority = max(same.priority, priority)
+                self.merged += 1
+                SPEECH_MERGED.labels().inc()
+                return True
+            if len(self._items) >= self.max_size:
+                if self.overflow == 'reject' or not self._items:
+                    self._drop()
+                    return False
+                if self.overflow == 'drop_oldest':
+                    victim = min(self._items, key=lambda i: i.seq)
+                else:
+                    victim = min(self._items,
+                                 key=lambda i: (i.priority, i.seq))
+                    if victim.priority > priority:
+                        self._drop()
+                        return False
+                self._items.remove(victim)
+                self._drop()
+            self._items.append(Speech(priority, next(self._seq), key, chunks))
+            self._cond.notify()
+            return True
+
+    def put_back(self, speech):
+        """Puts back the rest of the text being said, unless it has been
+        cancelled. It's never rejected.
+
+        Args:
+            speech (Speech): the text
+        """
+        with self._cond:
+            if not speech.cancelled and speech.chunks:
+                self._items.append(speech)
+                self._cond.notify()
+
+    def said(self, speech):
+        """Drops the chunk of the text that has just been said and puts
+        back the rest, like `put_back`.
+
+        Args:
+            speech (Speech): the text
+        """
+        with self._cond:
+            speech.chunks.pop(0)
+            self.put_back(speech)
+
+    def get(self):
+        """Removes the first text to say, waiting for it if the queue is
+        empty. The text becomes the `current` one.
+
+        Returns:
+            Speech: the text or None if the waiting thread has been woken
+                up by `wakeup`
+        """
+        with self._cond:
+            self.current = None
+            self._cond.wait_for(lambda: self._items or self._wakeups)
+            if self._wakeups:
+                self._wakeups -= 1
+                return None
+            speech = min(self._items, key=Speech.order)
+            self._items.remove(speech)
+            self.current = speech
+            return speech
+
+    def wakeup(self):
+        """Makes the next `get` return None, to wake up the worker.
+        """
+        with self._cond:
+            self._wakeups += 1
+            self._cond.notify()
+
+    def cancel_current(self):
+        """Marks the rest of the text being said as cancelled.
+
+        Returns:
+            tuple: the text being said and its chunk being said, they are
+                None if nothing is being said
+        """
+        with self._cond:
+            if not self.current:
+                return None, None
+            self.current.cancelled = True
+            chunks = self.current.chunks
+            return self.current, chunks[0] if chunks else None
+
+    def clear(self):
+        """Drops every text waiting to be said.
+
+        Returns:
+            int: the number of texts dropped
+        """
+        with self._cond:
+            n = len(self._items)
+            self._items.clear()
+            return n
+
+    def qsize(self):
+        """Returns the number of texts waiting to be said.
+        """
+        return len(self._items)
+
+
 class Mouth:
     """Manager of a queue of sententeces to pronounce.
-    Sentences are stored in thread safe queue that a working
-    thread will use to retrieve the current sentence and play it.
+    Sentences are stored in a thread safe bounded priority queue(see
+    `SpeechQueue`) that a working thread will use to retrieve the current
+    sentence and play it.
+    Each text is split into chunks(see `split_text`) and after each chunk
+    the rest of the text goes back to the queue, so that texts with
+    higher priority cut in and then the text is resumed.
 
     To add a new sentence to the queue just call `say` and pass the
-    given sentence. If you want to stop the working thread (therefore
-    it will not speak anymore) call `shutup`.
+    given sentence. To skip the sentence being said call `interrupt`, to
+    drop the ones waiting call `clear`. If you want to stop the working
+    thread (therefore it will not speak anymore) call `shutup`, the next
+    `say` starts it again.
 
     Example:
         mouth = Mouth()
@@ -41,18 +333,47 @@ class Mouth:
         mouth.shutup()
     """
 
-    def __init__(self):
+    def __init__(self, cache=None, synthesizer=None,
+                 max_size=DEFAULT_QUEUE_SIZE, overflow='drop_lowest'):
         """Default constructor
+
+        Args:
+            cache (SpeechCache, optional): cache of the rendered sentences.
+                By default every sentence is synthesized when played.
+            synthesizer (Synthesizer, optional): long-lived backend to use
+                instead of starting one for each sentence.
+            max_size (int, optional): maximum number of texts waiting to
+                be said
+            overflow (str, optional): what to do when too many texts are
+                waiting, see `SpeechQueue`
         """
-        self.sentences = Queue()
+        self.sentences = SpeechQueue(max_size, overflow)
         self.stop_speaking = threading.Event()
-        thread = threading.Thread(target=process_sentences,
-                                  args=(self.stop_speaking, self.sentences))
-        thread.start()
+        self.cache = cache
+        self.synthesizer = synthesizer
+        self._thread = None
+        self._lock = threading.Lock()
+        self._start()
 
-    def say(self, text, amplitude=40, wpm=130, prog='espeak'):
-        """Creates a new Sentence that when played will say `text`
-        with a given `amplitude` and words per minute.
+    def _start(self):
+        """Helper function that starts the working thread unless it's
+        already running.
+        """
+        with self._lock:
+            if self._thread and not self.stop_speaking.is_set():
+                return
+            if self._thread:
+                self._thread.join()  # it has been shut up
+            self.stop_speaking.clear()
+            self._thread = threading.Thread(
+                target=process_sentences,
+                args=(self.stop_speaking, self.sentences, self.cache,
+                      self.synthesizer))
+            self._thread.start()
+
+    def say(self, text, amplitude=40, wpm=130, prog='espeak', priority=0):
+        """Creates the Sentences that when played will say `text`
+        with a given `amplitude` and words per minute, one for each chunk.
         By default the program that will be used to process the sentences
         is `espeak` but it should be possible to call it with `festival`.
 
@@ -61,36 +382,65 @@ class Mouth:
             prog (str, optional): backend program that will actually say the text
             amplitude (int, optional): amplitude level of the sentence
             wpm (int, optional): words per minute(aka speed) to pronounce
+            priority (int, optional): texts with higher priority are said
+                first, cutting in between the chunks of the text being
+                said. By default it's 0.
 
         Raises:
-            UnableToSay: if the mouth has been shut down
+            UnableToSay: if too many texts are waiting to be said
+        """
+        self._start()
+        chunks = [Sentence(chunk, prog, amplitude, wpm)
+                  for chunk in split_text(text)]
+        if not chunks:
+            return
+        key = Sentence(text, prog, amplitude, wpm).key()
+        if not self.sentences.put(chunks, priority, key):
+            raise UnableToSay('Too many sentences to say, try again later')
+
+    def interrupt(self):
+        """Stops the sentence being said skipping the rest of its text.
+        The mouth goes on with the next one.
+        """
+        _, chunk = self.sentences.cancel_current()
+        if chunk:
+            chunk.stop()
+        if self.synthesizer:
+            self.synthesizer.close()
+
+    def clear(self):
+        """Drops the sentences waiting to be said. The one being said goes
+        on, call `interrupt` to stop it as well.
         """
-        if self.stop_speaking.is_set():
-            raise UnableToSay('''Mouth has been shut down.
-                You can' t add a new sentence, it will not be played''')
-        self.sentences.put(Sentence(text, prog, amplitude, wpm))
+        self.sentences.clear()
 
     def shutup(self):
         """Close the mouth.
-        If you close the mouth you will be unable to play new sentences on it.
+        The sentences are dropped and the working thread stops until the
+        next sentence.
         """
         self.stop_speaking.set()
-        self.sentences.put(None)  # just to wake up working thread if waiting
+        self.sentences.clear()
+        self.sentences.wakeup()  # just to wake up working thread if waiting
+        self.interrupt()
 
 
-def process_sentences(stop_speaking, sentences):
+def process_sentences(stop_speaking, sentences, cache=None,
+                      synthesizer=None):
     """Function the working thread will use to process sentences.
 
     Args:
         stop_speaking (threading.Event): flag used to check it the
             thread should stop
-        sentences (iterable of Sentence): sentences to play
+        sentences (SpeechQueue): the texts to play
+        cache (SpeechCache, optional): cache of the rendered sentences
+        synthesizer (Synthesizer, optional): long-lived backend
     """
     while not stop_speaking.is_set():
-        snt = sentences.get()
-        if snt:
-            snt.play()
-            sentences.task_done()
+        speech = sentences.get()
+        if speech:
+            speech.chunks[0].play(cache, synthesizer)
+            sentences.said(speech)
 
 
 class Sentence:
@@ -112,17 +462,400 @@ class Sentence:
         self.amplitude = amplitude
         self.wpm = wpm
         self.prog = prog
+        self._process = None
+        self._stopped = False
+
+    def options(self):
+        """Returns the amplitude and words per minute options of the
+        backend.
+
+        Returns:
+            list of str: the options
+        """
+        return ['-a {:d}'.format(self.amplitude), '-s {:d}'.format(self.wpm)]
+
+    def key(self):
+        """Returns the key of the sentence in a `SpeechCache`, that
+        depends on the text, the amplitude, the words per minute and the
+        backend.
 
-    def play(self):
+        Returns:
+            str: the hex digest of the sentence
+        """
+        desc = json.dumps([self.prog, self.text, self.amplitude, self.wpm])
+        return hashlib.sha1(desc.encode()).hexdigest()
+
+    def render(self, path):
+        """Calls the backend to write the sentence to a WAV file instead
+        of playing it.
+
+        Args:
+            path (str): path of the WAV file
+
+        Returns:
+            int: the return code of the backend
+        """
+        return subprocess.call([self.prog] + self.options() +
+                               ['-w', path, self.text])
+
+    def play(self, cache=None, synthesizer=None):
         """Calls the backend with the amplitude and words per minute
-        options.
+        options. If a cache is given the sentence is rendered once and
+        then the WAV file is played. If a synthesizer running the same
+        backend is given, the sentences that aren't cached yet are said by
+        it and they are rendered to the cache only if they are said again.
+
+        Args:
+            cache (SpeechCache, optional): cache of the rendered sentences
+            synthesizer (Synthesizer, optional): long-lived backend
 
         Returns:
             int: the return code of the backend
         """
-        amp = '-a {:d}'.format(self.amplitude)
-        wpm = '-s {:d}'.format(self.wpm)
-        return subprocess.call([self.prog, amp, wpm, self.text])
+        if synthesizer and synthesizer.prog != self.prog:
+            synthesizer = None
+        path = cache.lookup(self) if cache else None
+        if path:
+            return self._call(PLAYER + [path])
+        if synthesizer and synthesizer.say(self):
+            if cache and cache.seen(self):
+                cache.store(self)
+            return 0
+        path = cache.store(self) if cache else None
+        if path:
+            return self._call(PLAYER + [path])
+        return self._call([self.prog] + self.options() + [self.text])
+
+    def _call(self, args):
+        """Helper function that runs a program and waits for it, so that
+        it can be killed by `stop`.
+
+        Args:
+            args (list of str): the program and its arguments
+
+        Returns:
+            int: the return code of the program
+        """
+        if self._stopped:
+            return -1
+        self._process = subprocess.Popen(args)
+        if self._stopped:  # stopped while starting
+            self._process.kill()
+        try:
+            return self._process.wait()
+        finally:
+            self._process = None
+
+    def stop(self):
+        """Stops the sentence if it's being played by a program.
+        """
+        self._stopped = True
+        process = self._process
+        if process:
+            process.kill()
+
+
+class Synthesizer:
+    """Long-lived backend that reads the sentences from its stdin, one for
+    each line, with the amplitude and the speed set inline by embedded
+    commands, and writes their audio to a long-lived player.
+    Without '--stdin' the backend synthesizes each line as soon as it has
+    read it, and with '--stdout' it reads the next line only when it's done
+    with the previous one. So an empty line follows each sentence and the
+    sentence is over when the backend has read the empty line and the
+    player has read the audio, both seen with FIONREAD on the pipes.
+    The backend and the player live until `close` or a crash, in which
+    case they are started again when the next sentence comes.
+
+    Attributes:
+        prog (str): the backend program, it must understand '--stdout' and
+            the embedded commands of `espeak`
+        restarts (int): number of restarts after a crash
+    """
+
+    def __init__(self, prog='espeak'):
+        """Creates a new synthesizer. The backend is started lazily.
+
+        Args:
+            prog (str, optional): the backend program
+        """
+        self.prog = prog
+        self.restarts = 0
+        self._process = None
+        self._player = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        """Helper function that starts the player and the backend writing
+        to it. It must be called while holding the lock.
+        """
+        self._kill()
+        self._player = subprocess.Popen(PLAYER, stdin=subprocess.PIPE,
+                                        stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL)
+        self._process = subprocess.Popen([self.prog, '--stdout'],
+                                         stdin=subprocess.PIPE,
+                                         stdout=self._player.stdin,
+                                         stderr=subprocess.DEVNULL,
+                                         universal_newlines=True)
+
+    def _kill(self):
+        """Helper function that kills the backend and the player. It must
+        be called while holding the lock.
+        """
+        for process in (self._process, self._player):
+            if process is not None:
+                process.kill()
+                process.wait()
+                try:
+                    process.stdin.close()
+                except OSError:
+                    pass
+        self._process = self._player = None
+
+    def _write(self, line):
+        """Helper function that writes a line to the backend, starting it
+        again if it has crashed.
+
+        Args:
+            line (str): the line
+
+        Returns:
+            subprocess.Popen: the backend and the player, None if the
+                backend can't be started
+        """
+        with self._lock:
+            for _ in range(2):
+                try:
+                    if self._process is None:
+                        self._start()
+                    elif self._process.poll() is not None:
+                        self.restarts += 1
+                        SYNTH_RESTARTS.labels().inc()
+                        self._start()
+                    self._process.stdin.write(line)
+                    self._process.stdin.flush()
+                    return self._process, self._player
+                except OSError:  # crashed meanwhile or missing
+                    self._kill()
+        return None
+
+    def say(self, sentence):
+        """Says a sentence, starting the backend again if it has crashed.
+        It returns when the sentence has been said or `close` has been
+        called.
+
+        Args:
+            sentence (Sentence): the sentence
+
+        Returns:
+            bool: True if the sentence has been said, False if the
+                backend can't be started
+        """
+        text = sentence.text.replace('\x01', ' ').replace('\n', ' ')
+        line = EMBEDDED.format(amplitude=sentence.amplitude,
+                               wpm=sentence.wpm, text=text)
+        for chunk in (line, '\n'):
+            processes = self._write(chunk)
+            if processes is None:
+                return False
+            # the backend reads the empty line only after the sentence
+            _wait_read(processes[0], processes[0].stdin)
+        _wait_read(processes[0], processes[1].stdin)
+        return True
+
+    def close(self):
+        """Kills the backend interrupting the sentence being said.
+        The next sentence starts it again.
+        """
+        with self._lock:
+            self._kill()
+
+
+def _wait_read(process, pipe):
+    """Helper function that waits until everything written to a pipe has
+    been read or until the backend is gone.
+
+    Args:
+        process (subprocess.Popen): the backend
+        pipe (file): the pipe
+    """
+    while process.poll() is None:
+        try:
+            unread = fcntl.ioctl(pipe.fileno(), termios.FIONREAD,
+                                 bytes(4))
+        except (OSError, ValueError):  # closed meanwhile
+            return
+        if not struct.unpack('i', unread)[0]:
+            return
+        time.sleep(SYNTH_POLL)
+
+
+class SpeechCache:
+    """Content addressed cache of rendered sentences. Each sentence is
+    stored as '<key>.wav' in `directory` and, when the size of the files
+    exceeds `max_size`, the least recently played ones are removed.
+    The directory is created lazily and, if the sentence can't be rendered
+    or stored, `get` returns None so that the sentence is synthesized as
+    usual.
+
+    Attributes:
+        directory (str): where the WAV files are stored
+        max_size (int): maximum size of the files in bytes
+        size (int): current size of the files in bytes
+        hits (int): number of sentences found in the cache
+        misses (int): number of sentences rendered
+        evictions (int): number of sentences removed
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_CACHE_SIZE):
+        """Creates a new cache, taking the files already in `directory`
+        ordered by last access.
+
+        Args:
+            directory (str): where to store the WAV files
+            max_size (int, optional): maximum size of the files in bytes
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._seen = OrderedDict()
+        try:
+            files = [e for e in os.scandir(directory)
+                     if e.name.endswith('.wav') and e.is_file()]
+        except OSError:
+            files = []
+        for entry in sorted(files, key=lambda e: e.stat().st_atime):
+            self._entries[entry.name[:-4]] = entry.stat().st_size
+            self.size += entry.stat().st_size
+        REGISTRY.gauge('xm_speech_cache_bytes',
+                       'Size of the rendered sentences in the speech cache',
+                       lambda: self.size)
+
+    def _path(self, key):
+        """Helper function that returns the path of the file of `key`.
+        """
+        return os.path.join(self.directory, key + '.wav')
+
+    def _evict(self):
+        """Helper function that removes the least recently played
+        sentences until the cache fits `max_size`. It must be called
+        while holding the lock.
+        """
+        while self.size > self.max_size and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            CACHE_EVICTIONS.labels().inc()
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def get(self, sentence):
+        """Returns the WAV file of `sentence`, rendering it if it isn't in
+        the cache.
+
+        Args:
+            sentence (Sentence): the sentence
+
+        Returns:
+            str: the path of the WAV file or None if it can't be rendered
+        """
+        return self.lookup(sentence) or self.store(sentence)
+
+    def lookup(self, sentence):
+        """Returns the WAV file of `sentence` if it's in the cache.
+
+        Args:
+            sentence (Sentence): the sentence
+
+        Returns:
+            str: the path of the WAV file or None if it isn't cached
+        """
+        key = sentence.key()
+        path = self._path(key)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                CACHE_LOOKUPS.labels('hit').inc()
+                try:
+                    os.utime(path)  # keep the order across restarts
+                    return path
+                except OSError:  # removed behind our back
+                    self.size -= self._entries.pop(key)
+            self.misses += 1
+            CACHE_LOOKUPS.labels('miss').inc()
+            self._seen[key] = self._seen.pop(key, 0) + 1
+            if len(self._seen) > MAX_SEEN:
+                self._seen.popitem(last=False)
+        return None
+
+    def seen(self, sentence):
+        """Tells whether `sentence` has been missed more than once
+        recently, i.e. if it's worth storing.
+
+        Args:
+            sentence (Sentence): the sentence
+
+        Returns:
+            bool: True if it has been missed at least twice
+        """
+        with self._lock:
+            return self._seen.get(sentence.key(), 0) > 1
+
+    def store(self, sentence):
+        """Renders `sentence` and stores it in the cache.
+
+        Args:
+            sentence (Sentence): the sentence
+
+        Returns:
+            str: the path of the WAV file or None if it can't be rendered
+        """
+        key = sentence.key()
+        path = self._path(key)
+        tmp = '{}.{:d}.tmp'.format(path, threading.get_ident())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            if sentence.render(tmp) != 0:
+                return None
+            size = os.path.getsize(tmp)
+            os.replace(tmp, path)
+        except OSError:
+            return None
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        with self._lock:
+            self._seen.pop(key, None)
+            if key not in self._entries:
+                self.size += size
+            self._entries[key] = size
+            self._entries.move_to_end(key)
+            self._evict()
+        return path
+
+    def stats(self):
+        """Returns the statistics of the cache.
+
+        Returns:
+            dict: `hits`, `misses`, `evictions`, the number of `sentences`
+                and their `size` in bytes.
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'sentences': len(self._entries),
+                    'size': self.size}
 
 
 if __name__ == '__main__':
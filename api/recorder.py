@@ -0,0 +1,90 @@
+"""Flight recorder of the serial link. It's a fixed-size ring buffer of
+timestamped events that `Legs` keeps always on: the bytes written(tx), the
+bytes read(rx) and the outcome of each command(done), so that when the
+rover behaves oddly it's possible to see what actually went over the
+link. Recording an event is just an append to a bounded `deque`, so it's
+cheap enough for production.
+
+Each command has a sequence number shared by its tx and done events.
+The dump can be replayed against the emulator with `replay.py`.
+
+Example:
+    $ recorder = FlightRecorder(size=1024)
+    $ recorder.record('tx', b'f', 1, 'move forward')
+    $ recorder.record('rx', b'g')
+    $ recorder.record('done', b'', 1, 'ack')
+    $ recorder.dump()['events'][0]['kind']
+    'tx'
+"""
+
+import time
+import itertools
+
+from collections import deque
+
+DEFAULT_SIZE = 4096
+
+KINDS = ('tx', 'rx', 'done')
+
+
+class FlightRecorder:
+    """Ring buffer of the events of the serial link. When it's full the
+    oldest events are overwritten.
+
+    Attributes:
+        size (int): maximum number of events kept
+        recorded (int): number of events recorded since the creation
+    """
+
+    def __init__(self, size=DEFAULT_SIZE):
+        """Creates an empty recorder.
+
+        Args:
+            size (int, optional): maximum number of events kept
+        """
+        self.size = size
+        # the index of each event, next() on a count is atomic
+        self._index = itertools.count(1)
+        self._events = deque(maxlen=size)
+
+    @property
+    def recorded(self):
+        """Number of events recorded since the creation."""
+        # threads may append their events out of order
+        return max((e[0] for e in list(self._events)), default=0)
+
+    def record(self, kind, data, seq=None, note=None):
+        """Records an event. It's thread safe and it never blocks.
+
+        Args:
+            kind (str): 'tx', 'rx' or 'done'
+            data (bytes): the bytes written or read, empty for 'done'
+            seq (int, optional): sequence number of the command
+            note (str, optional): the action of a 'tx' event or the
+                outcome('ack', 'nack', 'unsupported', 'lost' or 'failed')
+                of a 'done' event
+        """
+        self._events.append((next(self._index), time.monotonic(), kind,
+                             data, seq, note))
+
+    def dump(self):
+        """Returns the recorded events, the oldest first.
+
+        Returns:
+            dict: the `size` of the buffer, the number of events overwritten
+                (`dropped`) and the `events`. Each event is a dict with the
+                unix time(`t`), the `kind`, the bytes as hex string(`data`),
+                the sequence number(`seq`) and the `note`.
+        """
+        events = list(self._events)
+        offset = time.time() - time.monotonic()
+        return {
+            'size': self.size,
+            'dropped': max((e[0] for e in events), default=0) - len(events),
+            'events': [{'t': t + offset,
+                        'kind': kind,
+                        'data': data.hex(),
+                        'seq': seq,
+                        'note': note}
+                       for _, t, kind, data, seq, note in events]
+        }
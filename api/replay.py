@@ -0,0 +1,259 @@
+"""Replays a flight record of the serial link against the emulated arduino.
+Each command written in the record is mapped back to its circuit and it's
+called through `Brain` at the same relative time it was sent, or faster
+with `--speed`, so that latency spikes and ack mismatches can be
+reproduced offline.
+
+At the end it compares the round-trip time of each command byte and the
+outcome of each command with the ones of the record. It exits with 1 if
+the outcome of at least a command is different.
+
+The record can be either a file with the response of '/api/flight_record'
+(or just its data) or the url of the endpoint.
+
+Example:
+    $ curl http://xm/api/flight_record > record.json
+    $ python3 replay.py record.json --speed 4 --latency 0.005
+"""
+
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
+from emulator import ArduinoEmulator
+from brain import Brain, Body
+from bench import percentile
+from util import XMException
+
+# command byte -> circuit
+MOVES = {'F': 'forward', 'B': 'backward', 'L': 'left', 'R': 'right'}
+
+
+def load(source):
+    """Loads a flight record.
+
+    Args:
+        source (str): path of a file or url of the endpoint
+
+    Returns:
+        dict: the dump of the flight recorder
+    """
+    if source.startswith(('http://', 'https://')):
+        with urllib.request.urlopen(source) as resp:
+            doc = json.loads(resp.read().decode())
+    else:
+        with open(source) as f:
+            doc = json.load(f)
+    return doc.get('data', doc)
+
+
+def to_call(data):
+    """Maps the bytes of a command back to the circuit that sends them.
+
+    Args:
+        data (bytes): the command
+
+    Returns:
+        (str, dict): the name of the circuit and its parameters or None
+            if the command isn't sent by any circuit
+    """
+    cmd = chr(data[0])
+    if cmd in MOVES:
+        return MOVES[cmd], {}
+    if cmd.upper() in MOVES:
+        return MOVES[cmd.upper()], {'async': '1'}
+    if cmd == 'z':
+        return 'stop', {}
+    if cmd == 'X' and len(data) == 2:
+        return 'set_speed', {'speed_value': str(data[1])}
+    if cmd == 'T' and len(data) == 3:
+        return 'set_movetime', {'time': str(int.from_bytes(data[1:], 'big'))}
+    if cmd == 'D' and len(data) == 4:
+        # approximately the joystick vector the speeds came from
+        left = -data[2] if data[1] & 1 else data[2]
+        right = -data[3] if data[1] & 2 else data[3]
+        return 'drive', {'x': str(round((left - right) * 50 / 0xFF)),
+                         'y': str(round((left + right) * 50 / 0xFF))}
+    return None
+
+
+def round_trips(events):
+    """Pairs the tx and done events of each command.
+
+    Args:
+        events (list of dict): events of a flight record
+
+    Returns:
+        list of (int, str, float, str): sequence number, command byte,
+            round-trip time in seconds and outcome of each completed
+            command, in the order they have been sent
+    """
+    sent = {}
+    trips = []
+    for e in events:
+        if e['kind'] == 'tx':
+            sent[e['seq']] = e
+        elif e['kind'] == 'done' and e['seq'] in sent:
+            tx = sent.pop(e['seq'])
+            trips.append((e['seq'], bytes.fromhex(tx['data'])[:1].decode(
+                errors='replace'), e['t'] - tx['t'], e['note']))
+    trips.sort()
+    return trips
+
+
+def timed_call(brain, name, params):
+    """Calls a circuit measuring how long it takes.
+
+    Returns:
+        (float, str): the time in seconds and the error if the circuit
+            failed, None otherwise
+    """
+    start = time.perf_counter()
+    try:
+        brain.call(name, **params)
+        error = None
+    except XMException as exc:
+        error = str(exc) or type(exc).__name__
+    return time.perf_counter() - start, error
+
+
+def replay(brain, record, speed, workers):
+    """Replays the commands of `record`.
+
+    Args:
+        brain (Brain): brain of a body connected to the emulator
+        record (dict): the dump of the flight recorder
+        speed (float): how faster than the record to go, 0 to send the
+            commands as fast as possible
+        workers (int): maximum number of commands waiting for their
+            response at the same time
+
+    Returns:
+        list of (dict, float, str): the tx event of each replayed command,
+            how long its circuit took and its error
+    """
+    # the requests without a sequence number, e.g. the negotiation of the
+    # version, aren't commands
+    txs = [e for e in record['events']
+           if e['kind'] == 'tx' and e['seq'] is not None]
+    if not txs:
+        return []
+    pending = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        t0 = txs[0]['t']
+        start = time.monotonic()
+        for e in txs:
+            call = to_call(bytes.fromhex(e['data']))
+            if call is None:
+                print('skipping #{} {}: no circuit sends it'.format(
+                    e['seq'], e['data']), file=sys.stderr)
+                continue
+            if speed:
+                time.sleep(max(0, start + (e['t'] - t0) / speed -
+                               time.monotonic()))
+            pending.append((e, executor.submit(timed_call, brain, *call)))
+    return [(e, ) + fut.result() for e, fut in pending]
+
+
+def summary(trips):
+    """Groups the round-trip times by command byte.
+
+    Args:
+        trips (list): result of `round_trips`
+
+    Returns:
+        dict: command byte -> sorted round-trip times in ms
+    """
+    by_cmd = {}
+    for _, cmd, rtt, _ in trips:
+        by_cmd.setdefault(cmd, []).append(rtt * 1000)
+    for values in by_cmd.values():
+        values.sort()
+    return by_cmd
+
+
+def report(record, replayed, trips):
+    """Prints the comparison between the record and the replay.
+
+    Args:
+        record (dict): the dump of the flight recorder
+        replayed (list): result of `replay`
+        trips (list): result of `round_trips` on the replay
+
+    Returns:
+        int: number of commands whose outcome is different
+    """
+    old = summary(round_trips(record['events']))
+    new = summary(trips)
+    print('cmd  recorded p50/p99/max ms        replayed p50/p99/max ms')
+    for cmd in sorted(set(old) | set(new)):
+        cols = []
+        for rtts in (old.get(cmd, []), new.get(cmd, [])):
+            cols.append('{:>4} x {:7.2f} {:7.2f} {:7.2f}'.format(
+                len(rtts), percentile(rtts, 50), percentile(rtts, 99),
+                rtts[-1]) if rtts else '{:>26}'.format('-'))
+        print('{:3}  {}    {}'.format(cmd, *cols))
+
+    outcomes = {e['seq']: e['note'] for e in record['events']
+                if e['kind'] == 'done'}
+    mismatches = 0
+    for e, elapsed, error in replayed:
+        recorded = outcomes.get(e['seq'])
+        if recorded is None or (recorded == 'ack') == (error is None):
+            continue
+        mismatches += 1
+        print('MISMATCH #{} {} ({}): recorded {}, replayed {} in '
+              '{:.2f}ms'.format(e['seq'], e['note'], e['data'], recorded,
+                                error or 'ack', elapsed * 1000))
+    print('{} commands replayed, {} mismatches'.format(len(replayed),
+                                                       mismatches))
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replays a flight record of the XM legs on the emulator')
+    parser.add_argument('record', help='file or url of the flight record')
+    parser.add_argument('--speed', type=float, default=1,
+                        help='how faster than the record to go, '
+                             '0 for as fast as possible')
+    parser.add_argument('--workers', type=int, default=16,
+                        help='commands waiting for a response at once')
+    parser.add_argument('--baudrate', type=int, default=9600,
+                        help='speed of the emulated link')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='latency of the emulated arduino in seconds')
+    parser.add_argument('--output', default=None,
+                        help='file where to save the flight record of the '
+                             'replay')
+    args = parser.parse_args()
+
+    record = load(args.record)
+    arduino = ArduinoEmulator(args.baudrate, args.latency)
+    arduino.start()
+    logdir = tempfile.mkdtemp(prefix='xm-replay-')
+    brain = Brain(Body(port=arduino.port, logdir=logdir, cachedir=logdir))
+    try:
+        replayed = replay(brain, record, args.speed, args.workers)
+        time.sleep(0.5)  # let the last responses arrive
+        dump = brain.flight_record()
+    finally:
+        brain.call('shutup')
+        brain.body.safe_legs.close()
+        arduino.close()
+        shutil.rmtree(logdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dump, f, indent=2)
+    if report(record, replayed, round_trips(dump['events'])):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,13 @@
 # needed by mjpg-streamer binary
 echo "export LD_LIBRARY_PATH=/usr/local/lib/"
 
-sudo gunicorn --pid "/var/run/xm.pid" --bind 0.0.0.0:80  hear:app
+SPINE="/var/run/xm-spine.sock"
+
+# the spine owns the hardware, the workers reach it through $SPINE
+sudo python3 spine.py --socket "$SPINE" --pidfile "/var/run/xm-spine.pid" &
+until [ -S "$SPINE" ]; do
+  sleep 0.1
+done
+
+sudo XM_SPINE="$SPINE" gunicorn --pid "/var/run/xm.pid" --bind 0.0.0.0:80 \
+  --workers "$(nproc)" --threads 8 hear:app
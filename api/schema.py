@@ -0,0 +1,211 @@
+"""Declarative parameters of the circuits. Each circuit declares the type
+and the bounds of its parameters once, and the declarations are compiled
+into a validator that converts the strings of a query(or the values of a
+JSON body) and checks them before the circuit runs, so that invalid input
+never reaches the locks or the hardware. The declarations are also the
+documentation of the parameters in the help of the api.
+
+Example:
+    $ validate = compile_schema((Param('speed_value', int, min=0, max=255),
+                                 Param('async', bool, required=False,
+                                       arg='asynchronous')))
+    $ validate((), {'speed_value': '120', 'async': '1'})
+    {'speed_value': 120, 'asynchronous': True}
+    $ validate((), {'speed_value': '300'})
+    InvalidParams: speed_value must be between 0 and 255
+"""
+
+from util import XMValueError
+
+TYPE_NAMES = {bool: 'bool', int: 'int', str: 'str'}
+
+
+class InvalidParams(XMValueError):
+    """Exception raised if the parameters of a circuit are invalid.
+
+    Attributes:
+        errors (list of dict): the `param` and the `error` of each invalid
+            parameter
+    """
+
+    def __init__(self, errors):
+        super().__init__('; '.join(e['error'] for e in errors))
+        self.errors = errors
+
+    def __reduce__(self):
+        # rebuilt from the errors, e.g. when it's forwarded by the spine
+        return type(self), (self.errors,)
+
+
+class Param:
+    """Declaration of a parameter of a circuit.
+
+    Attributes:
+        name (str): name of the parameter
+        type (type): bool, int or str
+        required (bool): whether it must be given
+        default: the value if it isn't given, None to let the target use
+            its own default
+        min, max (int): bounds of an int or of the length of a str,
+            included
+        choices (tuple): the allowed values
+        doc (str): description of the parameter
+        arg (str): keyword argument the target receives the value as, by
+            default the `name`, e.g. for names that aren't identifiers
+    """
+
+    __slots__ = ('name', 'type', 'required', 'default', 'min', 'max',
+                 'choices', 'doc', 'arg')
+
+    def __init__(self, name, type, required=True, default=None, min=None,
+                 max=None, choices=None, doc=None, arg=None):
+        if type not in TYPE_NAMES:
+            raise ValueError('Unsupported type {}'.format(type))
+        self.name = name
+        self.type = type
+        self.required = required
+        self.default = default
+        self.min = min
+        self.max = max
+        self.choices = tuple(choices) if choices is not None else None
+        self.doc = doc
+        self.arg = arg or name
+
+    def describe(self):
+        """Returns the declaration for the help.
+
+        Returns:
+            dict: the `name`, the `type`, whether it's `required` and the
+                `default`, `min`, `max`, `choices` and `doc` if given
+        """
+        ret = {'name': self.name,
+               'type': TYPE_NAMES[self.type],
+               'required': self.required}
+        for key in ('default', 'min', 'max', 'choices', 'doc'):
+            value = getattr(self, key)
+            if value is not None:
+                ret[key] = list(value) if key == 'choices' else value
+        return ret
+
+    def compile(self):
+        """Compiles the declaration into a converter.
+
+        Returns:
+            callable: function that takes a raw value and returns the
+                converted one or raises ValueError with the reason
+        """
+        name, lo, hi, choices = self.name, self.min, self.max, self.choices
+
+        if self.type is bool:
+            def convert(value):
+                if isinstance(value, bool):
+                    return value
+                s = str(value).lower()
+                if s == 'true':
+                    return True
+                if s == 'false':
+                    return False
+                try:
+                    return int(s) != 0
+                except ValueError:
+                    raise ValueError('{} must be a boolean'.format(name))
+        elif self.type is int:
+            def convert(value):
+                if isinstance(value, bool) or not isinstance(value,
+                                                             (int, str)):
+                    raise ValueError('{} must be an integer'.format(name))
+                try:
+                    value = int(value)
+                except ValueError:
+                    raise ValueError('{} must be an integer'.format(name))
+                if (lo is not None and value < lo or
+                        hi is not None and value > hi):
+                    if hi is None:
+                        bounds = '>= {}'.format(lo)
+                    elif lo is None:
+                        bounds = '<= {}'.format(hi)
+                    else:
+                        bounds = 'between {} and {}'.format(lo, hi)
+                    raise ValueError('{} must be {}'.format(name, bounds))
+                return value
+        else:
+            def convert(value):
+                if not isinstance(value, str):
+                    raise ValueError('{} must be a string'.format(name))
+                if (lo is not None and len(value) < lo or
+                        hi is not None and len(value) > hi):
+                    if hi is None:
+                        bounds = 'at least {}'.format(lo)
+                    elif lo is None:
+                        bounds = 'at most {}'.format(hi)
+                    else:
+                        bounds = 'between {} and {}'.format(lo, hi)
+                    raise ValueError('{} must be {} characters'.format(
+                        name, bounds))
+                return value
+
+        if choices is None:
+            return convert
+
+        def convert_choice(value):
+            value = convert(value)
+            if value not in choices:
+                raise ValueError('{} must be one of {}'.format(
+                    name, ', '.join(str(c) for c in choices)))
+            return value
+
+        return convert_choice
+
+
+def compile_schema(params):
+    """Compiles the declarations of the parameters of a circuit into a
+    validator.
+
+    Args:
+        params (iterable of Param): the parameters
+
+    Returns:
+        callable: `validate(args, kwargs)` that returns the converted
+            keyword arguments, named after the `arg` of each parameter.
+            Positional arguments are taken in the order of the
+            declarations. It raises `InvalidParams` with every invalid,
+            missing or unknown parameter.
+    """
+    params = tuple(params)
+    names = tuple(p.name for p in params)
+    known = frozenset(names)
+    compiled = tuple((p.name, p.arg, p.compile(), p.required, p.default)
+                     for p in params)
+
+    def validate(args, kwargs):
+        if args:
+            if len(args) > len(names):
+                raise InvalidParams([{'param': None,
+                                      'error': 'too many parameters'}])
+            kwargs = dict(kwargs, **dict(zip(names, args)))
+        errors = None
+        if not known.issuperset(kwargs):
+            errors = [{'param': name,
+                       'error': 'unknown parameter {}'.format(name)}
+                      for name in kwargs if name not in known]
+        ret = {}
+        for name, arg, convert, required, default in compiled:
+            value = kwargs.get(name)
+            if value is None or value == '':
+                if required:
+                    errors = errors or []
+                    errors.append({'param': name,
+                                   'error': '{} is required'.format(name)})
+                elif default is not None:
+                    ret[arg] = default
+                continue
+            try:
+                ret[arg] = convert(value)
+            except ValueError as exc:
+                errors = errors or []
+                errors.append({'param': name, 'error': str(exc)})
+        if errors:
+            raise InvalidParams(errors)
+        return ret
+
+    return validate
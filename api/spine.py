@@ -0,0 +1,367 @@
+"""The spine is the only process that owns the hardware. It keeps the
+`Body` (therefore the serial port, the mouth thread and the eyes process)
+and the `Brain` in a single long-running process, while the HTTP workers
+reach it through a `RemoteBrain` over a Unix domain socket. In this way the
+HTTP tier can run as many workers as the cores of the PI and the access to
+the serial port is still serialized in one place.
+
+Each message is a 4 bytes big endian length followed by a pickle of the
+payload. The message of a frame of the camera is encoded once and sent as
+it is to every worker asking for it. A request is the tuple
+(method, args, kwargs) and the response is (True, result) or
+(False, exception), so that the exceptions raised by the brain are raised
+again in the worker as they are.
+
+The spine runs as root and the socket can be written by its group, so the
+requests are unpickled without loading any class: they can be made only
+of the builtin containers, strings, numbers, booleans and None, and a
+request that needs anything else is rejected before anything is built.
+The responses are unpickled as they are, since the workers trust the
+spine.
+
+If you run this file the spine is started.
+
+Example:
+    $ python3 spine.py --socket /var/run/xm-spine.sock
+    $ brain = RemoteBrain('/var/run/xm-spine.sock')
+    $ brain.call('forward', **{'async': '1'})
+"""
+
+import io
+import os
+import signal
+import socket
+import struct
+import pickle
+import argparse
+import threading
+import socketserver
+
+from concurrent.futures import Future
+from brain import (Brain, Body, DEFAULT_PORT, DEFAULT_LOGDIR,
+                   DEFAULT_CACHEDIR)
+from util import XMException
+
+DEFAULT_SOCKET = '/var/run/xm-spine.sock'
+
+# methods of the brain the workers can call
+EXPORTED = frozenset(['call', 'call_many', 'get_help', 'help_payload',
+                      'help_version', 'metrics', 'flight_record', 'frame',
+                      'motion', 'health'])
+
+HEADER = struct.Struct('!I')
+
+
+class SpineException(XMException):
+    """Exception raised whenever the communication with the
+    spine fails.
+    """
+    pass
+
+
+def _recv_exactly(sock, size):
+    """Helper function that reads exactly `size` bytes from `sock`.
+
+    Args:
+        sock (socket): socket to read from
+        size (int): number of bytes to read
+
+    Returns:
+        bytes: the data or None if the connection has been closed
+    """
+    buf = bytearray(size)
+    view = memoryview(buf)
+    while size:
+        n = sock.recv_into(view, size)
+        if not n:
+            return None
+        view = view[n:]
+        size -= n
+    return buf
+
+
+def send_msg(sock, payload):
+    """Sends a message made by `payload`.
+
+    Args:
+        sock (socket): socket to write to
+        payload: any picklable object
+    """
+    sock.sendall(encode_msg(payload))
+
+
+def encode_msg(payload):
+    """Encodes a message made by `payload`.
+
+    Args:
+        payload: any picklable object
+
+    Returns:
+        bytes: the message
+    """
+    data = pickle.dumps(payload, pickle.HIGHEST_PROTOCOL)
+    return HEADER.pack(len(data)) + data
+
+
+class _PlainUnpickler(pickle.Unpickler):
+    """Unpickler that refuses to load any class or function, so that only
+    the builtin containers, strings, numbers, booleans and None can be
+    unpickled.
+    """
+
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError('{}.{} is not allowed'.format(module,
+                                                                   name))
+
+
+def recv_msg(sock, plain=False):
+    """Receives a message.
+
+    Args:
+        sock (socket): socket to read from
+        plain (bool, optional): if True the payload can be made only of
+            builtin values, see `_PlainUnpickler`
+
+    Returns:
+        the payload of the message or None if the connection has been
+            closed
+
+    Raises:
+        pickle.UnpicklingError: if `plain` is True and the payload isn't
+            made of builtin values
+    """
+    header = _recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    data = _recv_exactly(sock, HEADER.unpack(header)[0])
+    if data is None:
+        return None
+    if plain:
+        return _PlainUnpickler(io.BytesIO(data)).load()
+    return pickle.loads(data)
+
+
+class _SpineHandler(socketserver.BaseRequestHandler):
+    """Handler of a single worker connection. It serves requests until
+    the worker closes the connection.
+    """
+
+    def handle(self):
+        brain = self.server.brain
+        while True:
+            try:
+                req = recv_msg(self.request, plain=True)
+            except (pickle.UnpicklingError, EOFError, ValueError) as exc:
+                send_msg(self.request, (False, SpineException(
+                    'Invalid request: {}'.format(exc))))
+                return
+            if req is None:
+                return
+            try:
+                method, args, kwargs = req
+                args, kwargs = tuple(args), dict(kwargs)
+            except (TypeError, ValueError):
+                send_msg(self.request, (False, SpineException(
+                    'Invalid request')))
+                return
+            msg = None
+            try:
+                if method not in EXPORTED:
+                    raise SpineException(
+                        'Method {} is not exported'.format(method))
+                result = getattr(brain, method)(*args, **kwargs)
+                if isinstance(result, Future):
+                    # acks of pipelined commands are already resolved by
+                    # the post-workers, just send what they hold
+                    result = result.result()
+                elif method == 'frame':
+                    msg = self.server.encode_frame(result)
+                resp = (True, result)
+            except Exception as exc:  # forwarded to the worker
+                resp = (False, exc)
+            try:
+                if msg is not None:
+                    self.request.sendall(msg)
+                else:
+                    send_msg(self.request, resp)
+            except (pickle.PicklingError, TypeError, AttributeError) as exc:
+                send_msg(self.request, (False, SpineException(
+                    'Unable to send the result of {}: {}'.format(method,
+                                                                 exc))))
+
+
+class Spine(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Server that exposes a `Brain` over a Unix domain socket. Each worker
+    connection is served by its own thread.
+
+    Attributes:
+        brain (Brain): the brain to expose
+    """
+
+    daemon_threads = True
+
+    def __init__(self, brain, path=DEFAULT_SOCKET):
+        """Creates the server and binds it to `path`, removing a stale
+        socket if present.
+
+        Args:
+            brain (Brain): the brain to expose
+            path (str): path of the socket
+        """
+        self.brain = brain
+        self._frame_msg = (0, None)
+        self._frame_lock = threading.Lock()
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, _SpineHandler)
+        os.chmod(path, 0o660)
+
+    def encode_frame(self, latest):
+        """Returns the response carrying a frame of the camera, encoded
+        only by the first worker asking for it.
+
+        Args:
+            latest (int, bytes): the sequence number and the frame
+
+        Returns:
+            bytes: the message
+        """
+        with self._frame_lock:
+            if self._frame_msg[0] != latest[0]:
+                self._frame_msg = (latest[0], encode_msg((True, latest)))
+            return self._frame_msg[1]
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+class RemoteBrain:
+    """Proxy of the `Brain` living in the spine. It has the same exported
+    methods of `Brain` and it can be used by several threads, each of them
+    with its own connection.
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET):
+        """Creates a new proxy. Connections are opened lazily.
+
+        Args:
+            path (str): path of the socket of the spine
+        """
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        """Helper function that returns the connection of the current
+        thread opening it if needed.
+
+        Returns:
+            socket: the connection
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.connect(self.path)
+            self._local.conn = conn
+        return conn
+
+    def _drop_connection(self):
+        """Helper function that closes the connection of the current thread.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _rpc(self, method, args, kwargs):
+        """Calls `method` on the brain of the spine. If the request can't
+        be sent, e.g. because the spine has been restarted, it connects
+        again once. A request that has been sent is never repeated.
+
+        Args:
+            method (str): name of the method
+            args: argument list to pass to the method
+            kwargs: keyword arguments to pass to the method
+
+        Returns:
+            Whatever the method returns.
+
+        Raises:
+            SpineException: if the spine can't be reached
+            Whatever the method raises.
+        """
+        for attempt in range(2):
+            try:
+                conn = self._connection()
+                send_msg(conn, (method, args, kwargs))
+                break
+            except OSError:
+                self._drop_connection()
+        else:
+            raise SpineException('Unable to reach the spine')
+
+        try:
+            resp = recv_msg(conn)
+        except OSError:
+            resp = None
+        if resp is None:
+            self._drop_connection()
+            raise SpineException('Connection to the spine lost')
+
+        ok, value = resp
+        if not ok:
+            raise value
+        return value
+
+    def __getattr__(self, method):
+        if method not in EXPORTED:
+            raise AttributeError(method)
+
+        def call(*args, **kwargs):
+            return self._rpc(method, args, kwargs)
+
+        call.__name__ = method
+        return call
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Starts the XM spine')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET,
+                        help='path of the Unix domain socket')
+    parser.add_argument('--port',
+                        default=os.environ.get('XM_PORT', DEFAULT_PORT),
+                        help='serial port of the legs')
+    parser.add_argument('--logdir',
+                        default=os.environ.get('XM_LOGDIR', DEFAULT_LOGDIR),
+                        help='directory where to store logs')
+    parser.add_argument('--cachedir',
+                        default=os.environ.get('XM_CACHEDIR',
+                                               DEFAULT_CACHEDIR),
+                        help='directory where to cache the rendered sentences')
+    parser.add_argument('--pidfile', default=None,
+                        help='file where to write the pid')
+    args = parser.parse_args()
+
+    brain = Brain(Body(port=args.port, logdir=args.logdir,
+                       cachedir=args.cachedir))
+    server = Spine(brain, args.socket)
+    if args.pidfile:
+        with open(args.pidfile, 'w') as f:
+            f.write(str(os.getpid()))
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        brain.call('shutup')
+        brain.call('close_eyes')
+        brain.body.safe_legs.close()
+        if args.pidfile and os.path.exists(args.pidfile):
+            os.remove(args.pidfile)
@@ -0,0 +1,202 @@
+"""Tests of the scheduling of the movements by the cerebellum: the latest
+asynchronous movement wins, `stop` is never dropped, `hold` sends the
+movements of the holder in order and the timed movements are stopped by
+the host.
+
+    $ python3 -m unittest test_cerebellum
+"""
+
+import time
+import threading
+import unittest
+
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+from cerebellum import Cerebellum, UnknownMove
+
+
+class FakeLegs:
+    """Legs that record the commands sent. Their acks arrive when the test
+    resolves the futures, or right away if `auto_ack` is True.
+    """
+
+    def __init__(self, auto_ack=False):
+        self.auto_ack = auto_ack
+        self.sent = []
+        self._cond = threading.Condition()
+        self._lock = threading.Lock()
+
+    def _send(self, name, **kwargs):
+        fut = Future()
+        if self.auto_ack:
+            fut.set_result(b'')
+        with self._cond:
+            self.sent.append((name, kwargs, fut))
+            self._cond.notify_all()
+        return fut
+
+    def wait_sent(self, count, timeout=5):
+        """Waits until `count` commands have been sent and returns them.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: len(self.sent) >= count, timeout)
+            return list(self.sent)
+
+    def names(self):
+        return [name for name, _, _ in self.sent]
+
+    @contextmanager
+    def hold(self):
+        with self._lock:
+            yield self
+
+    def get_movetime(self):
+        return 1000
+
+    def stop(self, wait=True):
+        return self._send('stop')
+
+    def drive(self, left, right, wait=True):
+        return self._send('drive', left=left, right=right)
+
+    def __getattr__(self, name):
+        if name not in ('forward', 'backward', 'left', 'right'):
+            raise AttributeError(name)
+        return lambda asynchronous=False, wait=True: self._send(
+            name, asynchronous=asynchronous)
+
+
+class TestLatestWins(unittest.TestCase):
+
+    def setUp(self):
+        self.legs = FakeLegs()
+        self.cerebellum = Cerebellum(self.legs)
+
+    def test_pending_movement_is_replaced(self):
+        first = self.cerebellum.forward(asynchronous=True, wait=False)
+        sent = self.legs.wait_sent(1)  # waiting for its ack
+        left = self.cerebellum.left(asynchronous=True, wait=False)
+        right = self.cerebellum.right(asynchronous=True, wait=False)
+        self.assertIsNone(left.result(timeout=5))
+        sent[0][2].set_result(b'g')
+        self.assertIsNone(first.result(timeout=5))
+        sent = self.legs.wait_sent(2)
+        sent[1][2].set_result(b's')
+        self.assertIsNone(right.result(timeout=5))
+        self.assertEqual(self.legs.names(), ['forward', 'right'])
+        self.assertEqual(sent[1][1], {'asynchronous': True})
+        self.assertEqual(self.cerebellum.dropped, 1)
+        self.assertEqual(self.cerebellum.executed, 2)
+
+    def test_stop_drops_the_pending_movement(self):
+        self.cerebellum.forward(asynchronous=True, wait=False)
+        sent = self.legs.wait_sent(1)
+        left = self.cerebellum.left(asynchronous=True, wait=False)
+        stop = self.cerebellum.stop(wait=False)
+        self.assertEqual(self.legs.names(), ['forward', 'stop'])
+        self.assertIsNone(left.result(timeout=5))
+        self.assertFalse(stop.done())
+        sent[0][2].set_result(b'g')
+        time.sleep(0.05)
+        self.assertEqual(self.legs.names(), ['forward', 'stop'])
+        self.assertEqual(self.cerebellum.dropped, 1)
+
+    def test_failure_reaches_the_caller(self):
+        fut = self.cerebellum.forward(asynchronous=True, wait=False)
+        error = RuntimeError('ack lost')
+        self.legs.wait_sent(1)[0][2].set_exception(error)
+        self.assertIs(fut.exception(timeout=5), error)
+        self.assertEqual(self.cerebellum.errors, 1)
+        self.assertIs(self.cerebellum.last_error, error)
+
+    def test_drive_replaces_the_pending_movement(self):
+        self.cerebellum.forward(asynchronous=True, wait=False)
+        sent = self.legs.wait_sent(1)
+        self.cerebellum.drive(-10, 20, wait=False)
+        self.cerebellum.steer(x=100, y=100, wait=False)
+        sent[0][2].set_result(b'g')
+        sent = self.legs.wait_sent(2)
+        self.assertEqual(sent[1][:2], ('drive', {'left': 255, 'right': 0}))
+        self.assertEqual(self.cerebellum.dropped, 1)
+
+    def test_synchronous_movement_is_sent_right_away(self):
+        self.cerebellum.forward(asynchronous=True, wait=False)
+        sent = self.legs.wait_sent(1)
+        left = self.cerebellum.left(asynchronous=True, wait=False)
+        back = self.cerebellum.backward(wait=False)
+        self.assertEqual(self.legs.names(), ['forward', 'backward'])
+        self.assertIs(back, self.legs.sent[1][2])
+        self.assertIsNone(left.result(timeout=5))
+        sent[0][2].set_result(b'g')
+
+
+class TestHold(unittest.TestCase):
+
+    def test_holder_sends_in_order(self):
+        legs = FakeLegs()
+        cerebellum = Cerebellum(legs)
+        cerebellum.forward(asynchronous=True, wait=False)
+        sent = legs.wait_sent(1)
+        pending = cerebellum.left(asynchronous=True, wait=False)
+        with cerebellum.hold():
+            # the pending movement is flushed before the sequence
+            self.assertEqual(legs.names(), ['forward', 'left'])
+            fut = cerebellum.right(asynchronous=True, wait=False)
+            self.assertIs(fut, legs.sent[2][2])
+            legs.stop()
+        for _, _, f in legs.sent:
+            f.set_result(b'')
+        self.assertIsNone(pending.result(timeout=5))
+        time.sleep(0.05)
+        self.assertEqual(legs.names(), ['forward', 'left', 'right', 'stop'])
+        self.assertTrue(sent[0][2].done())
+
+    def test_others_wait_for_the_holder(self):
+        legs = FakeLegs(auto_ack=True)
+        cerebellum = Cerebellum(legs)
+        futures = []
+        with cerebellum.hold():
+            other = threading.Thread(target=lambda: futures.append(
+                cerebellum.forward(asynchronous=True, wait=False)))
+            other.start()
+            other.join(5)
+            time.sleep(0.05)
+            self.assertEqual(legs.names(), [])
+        self.assertIsNone(futures[0].result(timeout=5))
+        self.assertEqual(legs.names(), ['forward'])
+
+
+class TestTimedMoves(unittest.TestCase):
+
+    def setUp(self):
+        self.legs = FakeLegs(auto_ack=True)
+        self.cerebellum = Cerebellum(self.legs)
+
+    def test_the_host_stops_the_rover(self):
+        status = self.cerebellum.move('forward', 50)
+        self.assertEqual(status['state'], 'running')
+        self.legs.wait_sent(2)
+        self.assertEqual(self.legs.names(), ['forward', 'stop'])
+        self.assertEqual(self.cerebellum.move_status(status['id'])['state'],
+                         'done')
+
+    def test_newer_movement_preempts(self):
+        status = self.cerebellum.move('left', 50)
+        self.cerebellum.forward(asynchronous=True)
+        time.sleep(0.1)
+        self.assertEqual(self.legs.names(), ['left', 'forward'])
+        self.assertEqual(self.cerebellum.move_status(status['id'])['state'],
+                         'preempted')
+
+    def test_cancel(self):
+        status = self.cerebellum.move('right', 5000)
+        status = self.cerebellum.cancel_move(status['id'])
+        self.assertEqual(status['state'], 'cancelled')
+        self.assertEqual(status['remaining'], 0)
+        self.assertEqual(self.legs.names(), ['right', 'stop'])
+        self.assertRaises(UnknownMove, self.cerebellum.move_status, 99)
+
+
+if __name__ == '__main__':
+    unittest.main()
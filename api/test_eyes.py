@@ -0,0 +1,80 @@
+"""Tests of the ring of the frames of the camera shared by the viewers.
+
+    $ python3 -m unittest test_eyes
+"""
+
+import threading
+import unittest
+
+from eyes import FrameRing
+
+
+class TestFrameRing(unittest.TestCase):
+
+    def setUp(self):
+        self.ring = FrameRing(slots=3, slot_size=8)
+
+    def push(self, frame):
+        """Helper function that writes a frame like the reader does.
+        """
+        buf = self.ring.writable(len(frame))
+        if buf is None:
+            return False
+        buf[:] = frame
+        self.ring.commit(len(frame))
+        return True
+
+    def test_latest_frame(self):
+        self.assertIsNone(self.ring.wait(timeout=0))
+        self.push(b'one')
+        self.push(b'two!')
+        seq, frame = self.ring.wait()
+        self.assertEqual((seq, bytes(frame)), (2, b'two!'))
+        self.assertIsNone(self.ring.wait(after=2, timeout=0.01))
+
+    def test_buffers_are_reused(self):
+        for i in range(7):
+            self.push(bytes([i]) * 4)
+        self.assertEqual(self.ring.seq, 7)
+        seq, frame = self.ring.wait(after=6)
+        self.assertEqual(bytes(frame), b'\x06' * 4)
+
+    def test_view_is_valid_until_the_ring_wraps(self):
+        self.push(b'abc')
+        _, frame = self.ring.wait()
+        self.push(b'def')
+        self.push(b'ghi')
+        self.assertEqual(bytes(frame), b'abc')
+        self.push(b'jkl')
+        self.assertEqual(bytes(frame), b'jkl')
+
+    def test_oversized_frames_are_dropped(self):
+        self.assertFalse(self.push(b'123456789'))
+        self.assertEqual(self.ring.oversized, 1)
+        self.assertEqual(self.ring.seq, 0)
+
+    def test_shared_frame_is_copied_once(self):
+        self.push(b'abc')
+        first = self.ring.wait_shared()
+        self.assertEqual(first, (1, b'abc'))
+        self.assertIs(self.ring.wait_shared()[1], first[1])
+        for frame in (b'def', b'ghi', b'jkl'):
+            self.push(frame)
+        self.assertEqual(first[1], b'abc')  # it outlives its buffer
+        self.assertEqual(self.ring.wait_shared(after=1), (4, b'jkl'))
+
+    def test_readers_wait_for_a_new_frame(self):
+        got = []
+        readers = [threading.Thread(
+            target=lambda: got.append(self.ring.wait_shared(timeout=5)))
+            for _ in range(3)]
+        for reader in readers:
+            reader.start()
+        self.push(b'abc')
+        for reader in readers:
+            reader.join(5)
+        self.assertEqual(got, [(1, b'abc')] * 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
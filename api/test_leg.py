@@ -0,0 +1,219 @@
+"""Tests of `Legs` against the emulator of the XM-Legs firmware: the
+pipelined matching of the acks, the window, the acks that are lost or late,
+`stop` cutting short a synchronous movement and the negotiation of the
+version of the protocol and of the speed of the link.
+
+They need only pyserial:
+    $ python3 -m unittest test_leg
+"""
+
+import time
+import unittest
+
+from emulator import ArduinoEmulator
+from leg import ArduinoMessages, Legs, LegsException
+
+
+class EmulatorTestCase(unittest.TestCase):
+    """Base class of the tests that talk to an emulator started for each
+    test.
+    """
+
+    emulator_args = {'baudrate': 0}
+
+    def setUp(self):
+        self.arduino = ArduinoEmulator(**self.emulator_args)
+        self.arduino.start()
+        self.addCleanup(self.arduino.close)
+
+    def legs(self, **kwargs):
+        """Helper function that connects new legs to the emulator, without
+        probing the speed of the link unless asked to.
+        """
+        kwargs.setdefault('baudrates', ())
+        legs = Legs(self.arduino.port, **kwargs)
+        self.addCleanup(legs.close)
+        return legs
+
+
+class TestAcks(EmulatorTestCase):
+
+    emulator_args = {'baudrate': 9600, 'latency': 0.05}
+
+    def test_pipelined_acks_are_matched_in_order(self):
+        legs = self.legs(window=4)
+        futures = [legs.set_speed(speed, wait=False)
+                   for speed in (10, 20, 30, 40, 50, 60)]
+        for fut in futures:
+            self.assertEqual(fut.result(timeout=5), b'Y')
+        self.assertEqual(self.arduino.motor_speed, 60)
+        self.assertEqual(legs.speed, 60)
+        done = [e for e in legs.recorder.dump()['events']
+                if e['kind'] == 'done']
+        self.assertEqual([e['note'] for e in done], ['ack'] * 6)
+        self.assertEqual([e['seq'] for e in done],
+                         sorted(e['seq'] for e in done))
+
+    def test_window_limits_commands_in_flight(self):
+        legs = self.legs(window=2)
+        start = time.monotonic()
+        futures = [legs.set_speed(100, wait=False) for _ in range(3)]
+        # the third write waits for the ack of the first command
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+        self.assertLessEqual(len(legs._inflight), 2)
+        for fut in futures:
+            fut.result(timeout=5)
+
+    def test_batch_is_acked_per_command(self):
+        legs = self.legs()
+        self.assertEqual(legs.version, 3)
+        futures = legs.batch([('set_speed', {'speed_value': 100}),
+                              ('set_movetime', {'time': 500}),
+                              ('stop', {})])
+        self.assertEqual([f.result(timeout=5) for f in futures],
+                         [b'Y', b'U', b'{'])
+        self.assertEqual(self.arduino.frames, 1)
+        self.assertEqual(legs.movetime, 500)
+
+
+class TestLostAcks(EmulatorTestCase):
+
+    def test_lost_ack_fails_and_frees_the_window(self):
+        legs = self.legs(window=1, ack_timeout=0.2)
+        self.arduino.loss = 1
+        fut = legs.set_speed(100, wait=False)
+        self.assertRaises(LegsException, fut.result, 5)
+        self.assertEqual(legs.timeouts, 1)
+        self.arduino.loss = 0
+        legs.set_speed(120)
+        self.assertEqual(self.arduino.motor_speed, 120)
+
+    def test_nack_fails_its_own_command(self):
+        legs = self.legs()
+        self.arduino.loss = 1
+        lost = legs.set_speed(100, wait=False)
+        time.sleep(0.1)  # the command never reaches arduino
+        self.arduino.loss = 0
+        # arduino knows no speed at index 99
+        invalid = legs._send_n_read(
+            ArduinoMessages.Set_Baudrate.value + bytes([99]),
+            'set baudrate', wait=False)
+        move = legs.forward(asynchronous=True, wait=False)
+        self.assertEqual(move.result(timeout=5), b'g')
+        with self.assertRaisesRegex(LegsException, 'ack lost'):
+            lost.result(timeout=5)
+        with self.assertRaisesRegex(LegsException, "b'N'"):
+            invalid.result(timeout=5)
+
+    def test_unsupported_command_fails(self):
+        legs = self.legs()
+        unknown = legs._send_n_read(b'Q', 'query', wait=False)
+        move = legs.forward(asynchronous=True, wait=False)
+        self.assertEqual(move.result(timeout=5), b'g')
+        self.assertRaises(LegsException, unknown.result, 5)
+        done = [e['note'] for e in legs.recorder.dump()['events']
+                if e['kind'] == 'done']
+        self.assertEqual(done[-2:], ['unsupported', 'ack'])
+
+    def test_late_ack_is_dropped(self):
+        legs = self.legs(ack_timeout=0.1)
+        self.arduino.latency = 0.3
+        late = legs.set_speed(100, wait=False)
+        self.assertRaises(LegsException, late.result, 5)
+        time.sleep(0.4)  # the late ack arrives meanwhile
+        self.arduino.latency = 0
+        fut = legs.set_speed(120, wait=False)
+        self.assertEqual(fut.result(timeout=5), b'Y')
+        self.assertEqual(legs.timeouts, 1)
+
+
+class TestStop(EmulatorTestCase):
+
+    def test_stop_cuts_short_a_synchronous_movement(self):
+        legs = self.legs()
+        legs.set_movetime(5000)
+        start = time.monotonic()
+        move = legs.forward(wait=False)
+        time.sleep(0.1)
+        self.assertNotEqual(self.arduino.motors[1], 0)
+        legs.stop()
+        self.assertEqual(move.result(timeout=5), b'G')
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(self.arduino.motors[1], 0)
+        self.assertEqual(self.arduino.motors[3], 0)
+
+
+class TestNegotiation(unittest.TestCase):
+
+    def connect(self, protocol=3, baudrates=(), **kwargs):
+        """Helper function that connects to an emulator of a firmware that
+        speaks up to `protocol`.
+        """
+        arduino = ArduinoEmulator(baudrate=0, protocol=protocol, **kwargs)
+        arduino.start()
+        self.addCleanup(arduino.close)
+        legs = Legs(arduino.port, baudrates=baudrates)
+        self.addCleanup(legs.close)
+        return arduino, legs
+
+    def test_v1_firmware(self):
+        _, legs = self.connect(protocol=1)
+        self.assertEqual(legs.version, 1)
+        legs.set_speed(100)
+        self.assertEqual(legs.batch([('set_speed', {'speed_value': 1}),
+                                     ('stop', {})])[1].result(5), b'{')
+
+    def test_v2_firmware(self):
+        arduino, legs = self.connect(protocol=2, baudrates=(115200, ))
+        self.assertEqual(legs.version, 2)
+        self.assertEqual(legs.baudrate, 9600)
+        legs.batch([('set_speed', {'speed_value': 1}), ('stop', {})])[1] \
+            .result(5)
+        self.assertEqual(arduino.frames, 1)
+
+    def test_v1_only_client(self):
+        arduino = ArduinoEmulator(baudrate=0)
+        arduino.start()
+        self.addCleanup(arduino.close)
+        legs = Legs(arduino.port, protocol=1, baudrates=())
+        self.addCleanup(legs.close)
+        self.assertEqual(legs.version, 1)
+
+    def test_v3_picks_the_fastest_speed(self):
+        _, legs = self.connect(baudrates=(19200, 115200))
+        self.assertEqual(legs.version, 3)
+        self.assertEqual(legs.baudrate, 115200)
+        legs.set_speed(100)
+
+    def test_v3_finds_arduino_at_a_confirmed_speed(self):
+        arduino, legs = self.connect(baudrates=(115200, ), seed=1)
+        self.assertEqual(legs.baudrate, 115200)
+        legs.set_speed(100)
+        legs.close()
+        # arduino isn't reset when only the host process restarts
+        legs = Legs(arduino.port, baudrates=(115200, ))
+        self.addCleanup(legs.close)
+        self.assertEqual(legs.version, 3)
+        self.assertEqual(legs.baudrate, 115200)
+        # what the garbage sent at 9600 may have done has been undone
+        self.assertEqual(arduino.motors[1], 0)
+        self.assertEqual(arduino.move_time, legs.movetime)
+        self.assertEqual(arduino.motor_speed, legs.speed)
+        legs.set_speed(120)
+        self.assertEqual(arduino.motor_speed, 120)
+
+    def test_v3_skips_the_speeds_that_corrupt_bytes(self):
+        arduino, legs = self.connect(baudrates=(38400, 115200),
+                                     max_baudrate=38400, noise=0.5, seed=1)
+        self.assertEqual(legs.baudrate, 38400)
+        self.assertEqual(legs.probes[1]['baudrate'], 115200)
+        self.assertGreater(legs.probes[1]['error_rate'], 0.02)
+        # the corrupted pings have been undone
+        self.assertEqual(arduino.motors[1], 0)
+        self.assertEqual(arduino.move_time, legs.movetime)
+        self.assertEqual(arduino.motor_speed, legs.speed)
+        legs.set_speed(100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+"""Tests of the metrics and of their rendering in the Prometheus text
+format.
+
+    $ python3 -m unittest test_metrics
+"""
+
+import unittest
+
+from metrics import Registry
+
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        family = self.registry.counter('xm_test', 'Test counter',
+                                       ('command', ))
+        family.labels('f').inc()
+        family.labels('f').inc(2)
+        family.labels('b"\\').inc()
+        self.assertEqual(self.registry.render().splitlines(), [
+            '# HELP xm_test Test counter',
+            '# TYPE xm_test counter',
+            'xm_test_total{command="b\\"\\\\"} 1',
+            'xm_test_total{command="f"} 3',
+        ])
+
+    def test_histogram_buckets_are_cumulative(self):
+        family = self.registry.histogram('xm_rtt', 'Test histogram',
+                                         buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            family.labels().observe(value)
+        self.assertEqual(self.registry.render().splitlines()[2:], [
+            'xm_rtt_bucket{le="0.1"} 2',
+            'xm_rtt_bucket{le="1"} 3',
+            'xm_rtt_bucket{le="+Inf"} 4',
+            'xm_rtt_sum 2.65',
+            'xm_rtt_count 4',
+        ])
+
+    def test_labels_must_match(self):
+        family = self.registry.counter('xm_test', 'Test', ('a', 'b'))
+        self.assertRaises(ValueError, family.labels, 'x')
+
+    def test_gauge_reads_the_last_callback(self):
+        self.registry.gauge('xm_gauge', 'Test gauge', lambda: 1)
+        self.registry.gauge('xm_gauge', 'Test gauge', lambda: 2.0)
+        self.assertEqual(self.registry.render().splitlines()[-1],
+                         'xm_gauge 2')
+
+    def test_registering_again_returns_the_same_family(self):
+        first = self.registry.counter('xm_test', 'Test')
+        first.labels().inc()
+        second = self.registry.counter('xm_test', 'Test')
+        self.assertIs(first, second)
+        self.assertIn('xm_test_total 1', self.registry.render())
+
+    def test_metrics_are_sorted_by_name(self):
+        self.registry.counter('xm_b', 'B').labels().inc()
+        self.registry.counter('xm_a', 'A').labels().inc()
+        lines = self.registry.render().splitlines()
+        self.assertEqual(lines[0], '# HELP xm_a A')
+        self.assertEqual(lines[3], '# HELP xm_b B')
+
+
+if __name__ == '__main__':
+    unittest.main()
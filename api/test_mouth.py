@@ -0,0 +1,148 @@
+"""Tests of the splitting of the texts and of the queue of the texts to
+say, its merging and its overflow policies.
+
+    $ python3 -m unittest test_mouth
+"""
+
+import threading
+import unittest
+
+from mouth import SpeechQueue, split_text
+
+
+class TestSplitText(unittest.TestCase):
+
+    def test_sentences(self):
+        self.assertEqual(split_text('Hi there. How are you?  Fine!'),
+                         ['Hi there.', 'How are you?', 'Fine!'])
+
+    def test_long_sentences_are_split_into_clauses(self):
+        self.assertEqual(split_text('one two, three four.', max_len=12),
+                         ['one two,', 'three four.'])
+        self.assertEqual(split_text('one, two.', max_len=12), ['one, two.'])
+
+    def test_long_clauses_are_split_into_words(self):
+        self.assertEqual(split_text('aaa bbb ccc ddd', max_len=8),
+                         ['aaa bbb', 'ccc ddd'])
+        self.assertEqual(split_text('abcdefghij', max_len=4),
+                         ['abcd', 'efgh', 'ij'])
+
+
+class TestSpeechQueue(unittest.TestCase):
+
+    def texts(self, queue):
+        """Helper function that empties the queue and returns its texts in
+        the order they would be said.
+        """
+        texts = []
+        while queue.qsize():
+            texts.append(queue.get().chunks)
+        return texts
+
+    def test_priority_then_arrival(self):
+        queue = SpeechQueue()
+        queue.put('a')
+        queue.put('b', priority=1)
+        queue.put('c')
+        queue.put('d', priority=1)
+        self.assertEqual(self.texts(queue), ['b', 'd', 'a', 'c'])
+
+    def test_identical_texts_are_merged(self):
+        queue = SpeechQueue()
+        self.assertTrue(queue.put('a', key='a'))
+        queue.put('b', key='b')
+        self.assertTrue(queue.put('a', priority=5, key='a'))
+        self.assertEqual(queue.merged, 1)
+        self.assertEqual(self.texts(queue), ['a', 'b'])
+
+    def test_reject(self):
+        queue = SpeechQueue(max_size=2, overflow='reject')
+        queue.put('a')
+        queue.put('b')
+        self.assertFalse(queue.put('c', priority=100))
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual(self.texts(queue), ['a', 'b'])
+
+    def test_drop_oldest(self):
+        queue = SpeechQueue(max_size=2, overflow='drop_oldest')
+        queue.put('a', priority=10)
+        queue.put('b')
+        self.assertTrue(queue.put('c'))
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual(self.texts(queue), ['b', 'c'])
+
+    def test_drop_lowest(self):
+        queue = SpeechQueue(max_size=2)
+        queue.put('a', priority=1)
+        queue.put('b')
+        self.assertTrue(queue.put('c', priority=1))
+        self.assertEqual(self.texts(queue), ['a', 'c'])
+
+    def test_drop_lowest_rejects_a_lower_text(self):
+        queue = SpeechQueue(max_size=2)
+        queue.put('a', priority=1)
+        queue.put('b', priority=1)
+        self.assertFalse(queue.put('c'))
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual(self.texts(queue), ['a', 'b'])
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, SpeechQueue, overflow='drop_newest')
+
+    def test_rest_of_the_current_text_keeps_its_order(self):
+        queue = SpeechQueue()
+        queue.put(['a1', 'a2'])
+        queue.put(['b'])
+        speech = queue.get()
+        self.assertIs(queue.current, speech)
+        speech.chunks.pop(0)
+        queue.put_back(speech)
+        self.assertEqual(self.texts(queue), [['a2'], ['b']])
+
+    def test_said_chunk_is_dropped(self):
+        queue = SpeechQueue()
+        queue.put(['a1', 'a2'])
+        queue.said(queue.get())
+        self.assertEqual(self.texts(queue), [['a2']])
+
+    def test_cancelled_text_isnt_put_back(self):
+        queue = SpeechQueue()
+        queue.put(['a1', 'a2'])
+        speech = queue.get()
+        self.assertEqual(queue.cancel_current(), (speech, 'a1'))
+        queue.said(speech)
+        self.assertEqual(queue.qsize(), 0)
+        self.assertEqual(speech.chunks, ['a2'])
+
+    def test_cancel_while_the_last_chunk_is_dropped(self):
+        queue = SpeechQueue()
+        self.assertEqual(queue.cancel_current(), (None, None))
+        for _ in range(200):
+            queue.put(['a'])
+            speech = queue.get()
+            worker = threading.Thread(target=queue.said, args=(speech, ))
+            worker.start()
+            current, chunk = queue.cancel_current()
+            worker.join(5)
+            self.assertIs(current, speech)
+            self.assertIn(chunk, ('a', None))
+
+    def test_clear(self):
+        queue = SpeechQueue()
+        queue.put('a')
+        queue.put('b')
+        self.assertEqual(queue.clear(), 2)
+        self.assertEqual(queue.qsize(), 0)
+
+    def test_wakeup(self):
+        queue = SpeechQueue()
+        got = []
+        worker = threading.Thread(target=lambda: got.append(queue.get()))
+        worker.start()
+        queue.wakeup()
+        worker.join(5)
+        self.assertEqual(got, [None])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""Tests of the declarations of the parameters of the circuits and of
+their validators.
+
+    $ python3 -m unittest test_schema
+"""
+
+import pickle
+import unittest
+
+from schema import InvalidParams, Param, compile_schema
+
+
+class TestCompileSchema(unittest.TestCase):
+
+    def setUp(self):
+        self.validate = compile_schema((
+            Param('speed_value', int, min=0, max=255),
+            Param('async', bool, required=False, arg='asynchronous'),
+            Param('text', str, required=False, min=1, max=4),
+            Param('profile', str, required=False, choices=('low', 'high')),
+            Param('time', int, required=False, default=1000, min=0),
+        ))
+
+    def errors(self, args=(), **kwargs):
+        """Helper function that returns the errors of the validation.
+        """
+        with self.assertRaises(InvalidParams) as ctx:
+            self.validate(args, kwargs)
+        return [e['error'] for e in ctx.exception.errors]
+
+    def test_conversion(self):
+        self.assertEqual(
+            self.validate((), {'speed_value': '120', 'async': 'True',
+                               'text': 'hi', 'profile': 'low'}),
+            {'speed_value': 120, 'asynchronous': True, 'text': 'hi',
+             'profile': 'low', 'time': 1000})
+
+    def test_positional_args_follow_the_declarations(self):
+        self.assertEqual(self.validate((7, '0'), {}),
+                         {'speed_value': 7, 'asynchronous': False,
+                          'time': 1000})
+        self.assertEqual(self.errors(tuple(range(6))),
+                         ['too many parameters'])
+
+    def test_empty_values_are_missing(self):
+        self.assertEqual(self.errors(speed_value=''),
+                         ['speed_value is required'])
+        self.assertEqual(self.validate((), {'speed_value': 1, 'text': ''}),
+                         {'speed_value': 1, 'time': 1000})
+
+    def test_bounds(self):
+        self.assertEqual(self.errors(speed_value='256'),
+                         ['speed_value must be between 0 and 255'])
+        self.assertEqual(self.errors(speed_value=1, time=-1),
+                         ['time must be >= 0'])
+        self.assertEqual(self.errors(speed_value=1, text='hello'),
+                         ['text must be between 1 and 4 characters'])
+
+    def test_types(self):
+        self.assertEqual(self.errors(speed_value='fast',
+                                     **{'async': 'maybe'}),
+                         ['speed_value must be an integer',
+                          'async must be a boolean'])
+        self.assertEqual(self.errors(speed_value=True),
+                         ['speed_value must be an integer'])
+
+    def test_choices(self):
+        self.assertEqual(self.errors(speed_value=1, profile='medium'),
+                         ['profile must be one of low, high'])
+
+    def test_unknown_params_are_reported_first(self):
+        self.assertEqual(self.errors(speed_value='x', speed=1),
+                         ['unknown parameter speed',
+                          'speed_value must be an integer'])
+
+    def test_every_error_is_reported(self):
+        with self.assertRaises(InvalidParams) as ctx:
+            self.validate((), {'time': 'x'})
+        self.assertEqual(ctx.exception.errors, [
+            {'param': 'speed_value', 'error': 'speed_value is required'},
+            {'param': 'time', 'error': 'time must be an integer'},
+        ])
+        self.assertEqual(str(ctx.exception),
+                         'speed_value is required; time must be an integer')
+
+    def test_invalid_params_survive_pickling(self):
+        exc = InvalidParams([{'param': 'x', 'error': 'x is required'}])
+        copy = pickle.loads(pickle.dumps(exc))
+        self.assertIsInstance(copy, InvalidParams)
+        self.assertEqual(copy.errors, exc.errors)
+        self.assertEqual(str(copy), 'x is required')
+
+    def test_describe(self):
+        self.assertEqual(
+            Param('async', bool, required=False, arg='asynchronous',
+                  doc='returns immediatly').describe(),
+            {'name': 'async', 'type': 'bool', 'required': False,
+             'doc': 'returns immediatly'})
+
+    def test_unsupported_type(self):
+        self.assertRaises(ValueError, Param, 'ratio', float)
+
+
+if __name__ == '__main__':
+    unittest.main()
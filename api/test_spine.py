@@ -0,0 +1,167 @@
+"""Tests of the calls of the workers to the brain living in the spine:
+the round trip of the results and of the exceptions over the Unix domain
+socket, the methods that aren't exported, the requests that aren't made
+of builtin values and the reconnection when the connection is broken.
+
+    $ python3 -m unittest test_spine
+"""
+
+import os
+import socket
+import shutil
+import tempfile
+import threading
+import unittest
+
+from concurrent.futures import Future
+
+from schema import InvalidParams
+from spine import RemoteBrain, Spine, SpineException, recv_msg, send_msg
+from util import XMValueError
+
+
+EXECUTED = []
+
+
+class Payload:
+    """Object that runs code when it's unpickled.
+    """
+
+    def __reduce__(self):
+        return EXECUTED.append, ('unpickled', )
+
+
+class FakeBrain:
+    """Brain with a few circuits that exercise the spine.
+    """
+
+    def __init__(self):
+        self.seq = 0
+
+    def call(self, name, *args, **kwargs):
+        if name == 'echo':
+            return {'args': args, 'kwargs': kwargs}
+        if name == 'ack':
+            fut = Future()
+            fut.set_result(b'g')
+            return fut
+        if name == 'invalid':
+            raise InvalidParams([{'param': 'x', 'error': 'x is required'}])
+        if name == 'unpicklable':
+            return threading.Lock()
+        raise XMValueError('unknown circuit {}'.format(name))
+
+    def frame(self, after=0):
+        self.seq += 1
+        return self.seq // 2, b'jpeg'
+
+    def close(self):
+        raise AssertionError('not exported')
+
+
+class TestSpine(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'spine.sock')
+        self.spine = Spine(FakeBrain(), self.path)
+        thread = threading.Thread(target=self.spine.serve_forever,
+                                  kwargs={'poll_interval': 0.01})
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.spine.server_close)
+        self.addCleanup(self.spine.shutdown)
+        self.remote = RemoteBrain(self.path)
+        self.addCleanup(self.remote._drop_connection)
+
+    def test_result(self):
+        self.assertEqual(self.remote.call('echo', 1, **{'async': '1'}),
+                         {'args': (1, ), 'kwargs': {'async': '1'}})
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o660)
+
+    def test_future_is_resolved_in_the_spine(self):
+        self.assertEqual(self.remote.call('ack'), b'g')
+
+    def test_exceptions_are_raised_again(self):
+        with self.assertRaises(InvalidParams) as ctx:
+            self.remote.call('invalid')
+        self.assertEqual(ctx.exception.errors,
+                         [{'param': 'x', 'error': 'x is required'}])
+        self.assertRaisesRegex(XMValueError, 'unknown circuit foo',
+                               self.remote.call, 'foo')
+        # the connection is still usable
+        self.assertEqual(self.remote.call('echo')['args'], ())
+
+    def test_unpicklable_result(self):
+        self.assertRaisesRegex(SpineException, 'Unable to send',
+                               self.remote.call, 'unpicklable')
+        self.assertEqual(self.remote.call('echo')['args'], ())
+
+    def test_only_exported_methods(self):
+        self.assertRaises(AttributeError, getattr, self.remote, 'close')
+        self.assertRaisesRegex(SpineException, 'not exported',
+                               self.remote._rpc, 'close', (), {})
+
+    def test_requests_cant_load_classes(self):
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(conn.close)
+        conn.connect(self.path)
+        send_msg(conn, ('call', ('echo', Payload()), {}))
+        ok, exc = recv_msg(conn)
+        self.assertFalse(ok)
+        self.assertIsInstance(exc, SpineException)
+        self.assertIn('is not allowed', str(exc))
+        self.assertEqual(EXECUTED, [])
+        self.assertIsNone(recv_msg(conn))  # the connection is closed
+
+    def test_malformed_request(self):
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(conn.close)
+        conn.connect(self.path)
+        send_msg(conn, ['call'])
+        ok, exc = recv_msg(conn)
+        self.assertFalse(ok)
+        self.assertEqual(str(exc), 'Invalid request')
+
+    def test_frame_is_encoded_once_per_sequence_number(self):
+        first = self.remote.frame()
+        msg = self.spine._frame_msg[1]
+        self.assertEqual(first, (0, b'jpeg'))
+        self.assertEqual(self.remote.frame(), (1, b'jpeg'))
+        self.assertIsNot(self.spine._frame_msg[1], msg)
+        msg = self.spine._frame_msg[1]
+        self.assertEqual(self.remote.frame(), (1, b'jpeg'))
+        self.assertIs(self.spine._frame_msg[1], msg)
+
+    def test_each_thread_has_its_connection(self):
+        results = []
+
+        def call(i):
+            results.append(self.remote.call('echo', i)['args'][0])
+            self.remote._drop_connection()
+
+        threads = [threading.Thread(target=call, args=(i, ))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(sorted(results), list(range(8)))
+
+    def test_reconnects_when_the_connection_is_broken(self):
+        self.assertEqual(self.remote.call('echo')['args'], ())
+        broken = self.remote._local.conn
+        broken.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(self.remote.call('echo')['args'], ())
+        self.assertIsNot(self.remote._local.conn, broken)
+        broken.close()
+
+    def test_unreachable_spine(self):
+        remote = RemoteBrain(self.path + '.missing')
+        self.assertRaisesRegex(SpineException, 'Unable to reach',
+                               remote.call, 'echo')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,8 +3,10 @@ It's just a collection of a bunch utilities functions. Most
 of them are assertion for types.
 """
 
-from threading import Lock
+from contextlib import contextmanager
+from threading import Condition, get_ident
 import struct
+import time
 
 
 class XMException(Exception):
@@ -201,12 +203,78 @@ class UnableToLock(XMException):
     pass
 
 
+class PriorityLock:
+    """Reentrant lock where priority waiters are served before the others.
+    While there is at least a priority waiter, the other threads can't
+    acquire the lock even if it's free.
+    """
+
+    def __init__(self):
+        """Creates a new unlocked PriorityLock.
+        """
+        self._cond = Condition()
+        self._owner = None
+        self._count = 0
+        self._priority_waiters = 0
+
+    def acquire(self, priority=False, timeout=-1):
+        """Acquires the lock, blocking for at most `timeout` seconds.
+        If the current thread already owns the lock it returns immediatly.
+
+        Args:
+          priority (bool, optional): whether to jump the queue
+          timeout (float, optional): seconds to wait, negative to wait
+            forever
+
+        Returns:
+          bool: True if the lock has been acquired
+        """
+        me = get_ident()
+        with self._cond:
+            if self._owner == me:
+                self._count += 1
+                return True
+            if priority:
+                self._priority_waiters += 1
+            try:
+                acquired = self._cond.wait_for(
+                    lambda: self._owner is None and
+                    (priority or not self._priority_waiters),
+                    None if timeout < 0 else timeout)
+            finally:
+                if priority:
+                    self._priority_waiters -= 1
+                    if not self._priority_waiters:
+                        self._cond.notify_all()
+            if acquired:
+                self._owner = me
+                self._count = 1
+            return acquired
+
+    def release(self):
+        """Releases the lock.
+        """
+        with self._cond:
+            self._count -= 1
+            if not self._count:
+                self._owner = None
+                self._cond.notify_all()
+
+
 class LockAdapter:
     """Class that wraps every method not starting with '_' in such a way
     that it will be possible to call those methods on the istance of
     LockAdapter with thread safety.
     It's possible to set a timeout if blocking for an undefined period
     is not acceptable. If locking failed then UnableToLock is raised.
+    The lock is reentrant and it can be held across several calls with
+    `hold`, so that no other thread can interleave.
+
+    Some methods can be given priority: they jump the queue of the waiting
+    calls and, if the lock is busy, their `preempt` function is called to
+    make the owner release it sooner, e.g. cutting short a running movement.
+    The time each method waits for the lock is recorded, see `wait_stats`,
+    and it's observed by the optional `wait_histogram` as well.
 
     Example:
 
@@ -215,7 +283,8 @@ class LockAdapter:
     $ i.to_bytes(1, byteorder='little')   // threadsafe
     """
 
-    def __init__(self, obj, timeout=0.005):
+    def __init__(self, obj, timeout=0.005, priority=(), preempt=None,
+                 priority_timeout=1, wait_histogram=None):
         """Create a new LockAdapter that wraps the methods in `obj`.
         After creation the instance will have all the methods of `obj` so
         to use it just call the method you want to.
@@ -223,14 +292,30 @@ class LockAdapter:
         Args:
           obj: object to wrap
           timeout (int, optional): optional timeout to lock
+          priority (iterable of str, optional): names of the methods that
+            jump the queue
+          preempt (dict, optional): functions called without the lock
+            when the priority method with the same name finds the lock busy
+          priority_timeout (int, optional): timeout to lock for the
+            priority methods
+          wait_histogram (metrics.Family, optional): histograms labelled by
+            method name where to observe the wait for the lock
         """
-        self._lock = Lock()
+        self._lock = PriorityLock()
         self._timeout = timeout
+        self._priority = frozenset(priority)
+        self._preempt = preempt or {}
+        self._priority_timeout = priority_timeout
+        self._wait_stats = {}
         self._obj = obj
         methods = [
             md for md in self._obj.__dir__()
             if not md.startswith('_') and callable(getattr(self._obj, md))
         ]
+        self._wait_histograms = {
+            method: wait_histogram.labels(method)
+            for method in methods
+        } if wait_histogram else {}
 
         dic = {}
         for method in methods:
@@ -239,6 +324,41 @@ class LockAdapter:
             dic[method].__doc__ = getattr(self._obj, method).__doc__
         self.__dict__.update(dic)
 
+    def _acquire(self, method):
+        """Helper function that acquires the lock for `method` recording
+        how long it waited. The wait is recorded while holding the lock.
+
+        Args:
+          method (str): name of the method
+
+        Raises:
+          UnableToLock: if locking was impossible in the given timeout.
+        """
+        start = time.perf_counter()
+        if method in self._priority:
+            acquired = self._lock.acquire(priority=True, timeout=0)
+            if not acquired:
+                if method in self._preempt:
+                    self._preempt[method]()
+                acquired = self._lock.acquire(
+                    priority=True, timeout=self._priority_timeout or -1)
+        else:
+            acquired = self._lock.acquire(timeout=self._timeout or -1)
+        waited = time.perf_counter() - start
+        if not acquired:
+            raise UnableToLock('Unable to lock for method {}'.format(method))
+
+        stats = self._wait_stats.get(method)
+        if stats is None:
+            stats = self._wait_stats[method] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += waited
+        if waited > stats[2]:
+            stats[2] = waited
+        histogram = self._wait_histograms.get(method)
+        if histogram:
+            histogram.observe(waited)
+
     def _gen_call(self, method):
         """Helper function that generates a new thread safe callable
         wrapping the given `method`.
@@ -262,16 +382,39 @@ class LockAdapter:
               UnableToLock: if locking was impossible in the given
               timeout.
             """
-            if not self._timeout:
-                with self._lock:
-                    return getattr(self._obj, method)(*args, **kwargs)
-            else:
-                if not self._lock.acquire(timeout=self._timeout):
-                    raise UnableToLock(
-                        'Unable to lock for method {}'.format(method.__name__))
-                try:
-                    return getattr(self._obj, method)(*args, **kwargs)
-                finally:
-                    self._lock.release()
+            self._acquire(method)
+            try:
+                return getattr(self._obj, method)(*args, **kwargs)
+            finally:
+                self._lock.release()
 
         return call
+
+    @contextmanager
+    def hold(self):
+        """Context manager that holds the lock for its whole body. Calls
+        made by the same thread inside the body don't wait while the other
+        threads can't call any method until the end of the body.
+
+        Raises:
+            UnableToLock: if locking was impossible in the given timeout.
+        """
+        if not self._lock.acquire(timeout=self._timeout or -1):
+            raise UnableToLock('Unable to hold the lock')
+        try:
+            yield self
+        finally:
+            self._lock.release()
+
+    def wait_stats(self):
+        """Returns how long each method waited for the lock.
+
+        Returns:
+            dict: a dictionary with the method name as the key and a dict
+                with the number of locks(`count`), the total wait(`total`)
+                and the longest wait(`max`) in seconds as value.
+        """
+        return {
+            method: {'count': count, 'total': total, 'max': longest}
+            for method, (count, total, longest) in self._wait_stats.items()
+        }
@@ -11,7 +11,7 @@ int M1_DIR_CONTROL = 4;
 int M2_CONTROL = 6;
 int M2_DIR_CONTROL = 7;
 
-int SERIAL_BAUDRATE = 9600;      // baudrate for the serial connection
+long SERIAL_BAUDRATE = 9600;     // baudrate at startup and after a failed trial
 
 int moveTime = 1000;             // ms
 int motorSpeed = 255;
@@ -51,6 +51,45 @@ const char ASYNC_STOP           = 'z';
 // setters
 const char SET_SPEED            = 'X';       //requires 1 additional Byte for the speed value
 const char SET_MOVE_TIME        = 'T';       //requires 2 additional Bytes(big endian order) for mtimeout value
+const char DRIVE                = 'D';       //requires 3 additional Bytes: directions(bit 0 left, bit 1 right, set for backward), left and right speed
+
+// answered with its ACK followed by PROTOCOL_VERSION
+const char VERSION              = 'V';
+// link, since v3
+const char SET_BAUDRATE         = 'N';       //requires 1 additional Byte with the index in BAUDRATES
+const char PING                 = 'P';       //requires 1 additional Byte answered after the ACK
+
+/*
+ *    *** PROTOCOL V2 ***
+ * A frame is STX, LEN, SEQ, the commands as in v1 and a CRC-8(polynomial
+ * 0x07) of LEN, SEQ and the commands. LEN counts SEQ and the commands.
+ * The commands are executed in order and the response is a frame with the
+ * same SEQ whose commands are replaced by their responses, without any if
+ * the frame is corrupted. Any byte other than STX is a v1 command.
+ */
+const byte PROTOCOL_VERSION     = 3;
+const byte STX                  = 0x02;
+const int MAX_FRAME             = 64;
+const unsigned long FRAME_TIMEOUT = 100;     // ms to wait for each byte of a frame
+
+byte frame[MAX_FRAME];           // SEQ, commands and CRC of the frame
+int frameLen = -1;               // SEQ and commands, -1 outside a frame
+int framePos = 0;                // next byte of the frame to execute
+
+/*
+ *    *** LINK ***
+ * SET_BAUDRATE switches to a new speed once its ACK has been sent. The new
+ * speed is on trial: if it isn't requested again at the new speed within
+ * TRIAL_TIMEOUT ms, SERIAL_BAUDRATE is restored, so that a speed that
+ * doesn't work can't cut off the client.
+ */
+const long BAUDRATES[]          = {9600, 19200, 38400, 57600, 115200};
+const int BAUDRATES_COUNT       = 5;
+const unsigned long TRIAL_TIMEOUT = 1000;    // ms
+
+long baudrate = SERIAL_BAUDRATE;
+bool onTrial = false;
+unsigned long trialStart = 0;
 
 
 void setup()
@@ -62,9 +101,22 @@ void setup()
 
 void loop()
 {
+  if (onTrial && millis() - trialStart > TRIAL_TIMEOUT)
+  {
+    switchBaudrate(SERIAL_BAUDRATE);
+    onTrial = false;
+  }
   dispatch();
 }
 
+void switchBaudrate(long value)
+{
+  Serial.flush();       // the ACK must be sent at the old speed
+  Serial.end();
+  Serial.begin(value);
+  baudrate = value;
+}
+
 void setMotors(int m1dir, int m1speed, int m2dir, int m2speed)
 {
   digitalWrite(M1_DIR_CONTROL, m1dir);
@@ -79,6 +131,23 @@ void stopMotors()
   analogWrite(M2_CONTROL, 0);
 }
 
+/*
+ * Waits `time` ms like delay, but it returns as soon as the next
+ * command on the serial is ASYNC_STOP, so that a running movement can be
+ * cut short. The stop is left on the serial and it's dispatched as usual.
+ */
+void waitMove(unsigned int time)
+{
+  unsigned long start = millis();
+  while (millis() - start < time)
+  {
+    if (Serial.available() > 0 && Serial.peek() == ASYNC_STOP)
+    {
+      return;
+    }
+  }
+}
+
 void start_forward(int spd)
 {
   setMotors(LOW, spd, LOW, spd);
@@ -87,7 +156,7 @@ void start_forward(int spd)
 void forward(int spd, int time)
 {
   start_forward(spd);
-  delay(time);
+  waitMove(time);
   stopMotors();
 }
 
@@ -99,7 +168,7 @@ void start_backward(int spd)
 void backward(int spd, int time)
 {
   start_backward(spd);
-  delay(time);
+  waitMove(time);
   stopMotors();
 }
 
@@ -111,7 +180,7 @@ void start_left(int spd)
 void left(int spd, int time)
 {
   start_left(spd);
-  delay(time);
+  waitMove(time);
   stopMotors();
 }
 
@@ -123,7 +192,7 @@ void start_right(int spd)
 void right(int spd, int time)
 {
   start_right(spd);
-  delay(time);
+  waitMove(time);
   stopMotors();
 }
 
@@ -161,11 +230,159 @@ int readFirstValid()
     return v;
 }
 
+/*
+ * Like readFirstValid, but it returns -1 if nothing arrives within
+ * `timeout` ms.
+ */
+int readByte(unsigned long timeout)
+{
+    unsigned long start = millis();
+    int v = Serial.read();
+    while (v < 0 && millis() - start < timeout) {
+       v = Serial.read();
+    }
+    return v;
+}
+
+/*
+ * Reads the next argument of a command: from the frame being executed, or
+ * from the serial outside a frame. It returns -1 if the frame is over.
+ */
+int readArg()
+{
+    if (frameLen < 0) {
+       return readFirstValid();
+    }
+    if (framePos >= frameLen) {
+       return -1;
+    }
+    return frame[framePos++];
+}
+
+byte crc8(byte crc, byte b)
+{
+  crc ^= b;
+  for (int i = 0; i < 8; i++)
+  {
+    crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : crc << 1;
+  }
+  return crc;
+}
+
 void dispatch()
 {
   if (Serial.available() > 0)
   {
     const char cmd = Serial.read();
+
+    if (cmd == STX)
+    {
+      dispatchFrame();
+    }
+    else if (cmd == VERSION)
+    {
+      Serial.write(createAck(cmd));
+      Serial.write(PROTOCOL_VERSION);
+    }
+    else if (cmd == PING)
+    {
+      const int value = readFirstValid();
+      Serial.write(createAck(cmd));
+      Serial.write(value);
+    }
+    else if (cmd == SET_BAUDRATE)
+    {
+      const int index = readFirstValid();
+      if (index >= BAUDRATES_COUNT)
+      {
+        Serial.write(createNack(cmd));
+      }
+      else
+      {
+        Serial.write(createAck(cmd));
+        if (BAUDRATES[index] == baudrate)
+        {
+          onTrial = false;    // confirmed
+        }
+        else
+        {
+          switchBaudrate(BAUDRATES[index]);
+          onTrial = true;
+          trialStart = millis();
+        }
+      }
+    }
+    else
+    {
+      Serial.write(execute(cmd));
+    }
+  }
+}
+
+void dispatchFrame()
+{
+  // a frame whose bytes stop arriving is dropped, e.g. if the STX was a
+  // corrupted byte
+  const int len = readByte(FRAME_TIMEOUT);
+  if (len < 0)
+  {
+    return;
+  }
+  for (int i = 0; i < len + 1; i++)
+  {
+    const int b = readByte(FRAME_TIMEOUT);
+    if (b < 0)
+    {
+      return;
+    }
+    if (i < MAX_FRAME)
+    {
+      frame[i] = b;
+    }
+  }
+
+  char acks[MAX_FRAME];
+  int count = 0;
+  bool valid = len > 0 && len <= MAX_FRAME - 3;
+  if (valid)
+  {
+    byte crc = crc8(0, len);
+    for (int i = 0; i < len; i++)
+    {
+      crc = crc8(crc, frame[i]);
+    }
+    valid = crc == frame[len];
+  }
+  if (valid)
+  {
+    frameLen = len;
+    framePos = 1;
+    while (framePos < frameLen)
+    {
+      const char cmd = frame[framePos++];
+      acks[count++] = execute(cmd);
+    }
+    frameLen = -1;
+  }
+
+  const byte seq = len > 0 ? frame[0] : 0;
+  byte crc = crc8(crc8(0, count + 1), seq);
+  Serial.write(STX);
+  Serial.write(count + 1);
+  Serial.write(seq);
+  for (int i = 0; i < count; i++)
+  {
+    Serial.write(acks[i]);
+    crc = crc8(crc, acks[i]);
+  }
+  Serial.write(crc);
+}
+
+/*
+ * Executes a single command and returns its response.
+ */
+char execute(const char cmd)
+{
     char resp = createAck(cmd); // by default the response is ACK
 
     if (cmd == FORWARD)
@@ -201,22 +418,40 @@ void dispatch()
     }
     else if (cmd == SET_SPEED)
     {
-      int value = readFirstValid();
+      int value = readArg();
+      if (value < 0)
+      {
+        return createNack(cmd);
+      }
       setMotorSpeed(value);
     }
     else if (cmd == SET_MOVE_TIME)
     {      
-      const int b1 = readFirstValid();
-      const int b2 = readFirstValid();
+      const int b1 = readArg();
+      const int b2 = readArg();
+      if (b1 < 0 || b2 < 0)
+      {
+        return createNack(cmd);
+      }
       
       int time = assembleUShort(b1, b2);
       setMoveTime(time);
         
     }
+    else if (cmd == DRIVE)
+    {
+      const int dirs = readArg();
+      const int m1speed = readArg();
+      const int m2speed = readArg();
+      if (dirs < 0 || m1speed < 0 || m2speed < 0)
+      {
+        return createNack(cmd);
+      }
+      setMotors(dirs & 1 ? HIGH : LOW, m1speed, dirs & 2 ? HIGH : LOW, m2speed);
+    }
     else
     {
       resp = createNack(UNSUPPORTED_CMD); // overwrite default resp
     }
-    Serial.write(resp);
-  }
+    return resp;
 }
@@ -13,6 +13,7 @@ XMAPI="/home/pi/XM/api"         # xm api dir
 SCRIPT=$XMAPI/"runapi.sh"
 
 PIDFILE="/var/run/xm.pid"
+SPINE_PIDFILE="/var/run/xm-spine.pid"
 
 start() {
   if [ -f "/var/run/$PIDNAME" ] && kill -0 "$(cat /var/run/"$PIDNAME")"; then
@@ -23,12 +24,7 @@ start() {
   cd $XMAPI
   $SCRIPT &
   echo 'Service started' >&2
-
-  sleep 2
-  until curl --fail http://127.0.0.1/api/open_eyes; do
-    sleep 2
-  done
-
+  # the camera is started by the first viewer calling /api/open_eyes
 }
 
 stop() {
@@ -42,6 +38,9 @@ stop() {
   curl http://127.0.0.1/api/shutup
   curl http://127.0.0.1/api/close_eyes
   kill -15 "$(cat "$PIDFILE")" && rm -f "$PIDFILE"
+  if [ -f "$SPINE_PIDFILE" ]; then
+    kill -15 "$(cat "$SPINE_PIDFILE")"
+  fi
   echo 'Service stopped' >&2
 }
 